@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+Scaling benchmarks of the main subsystems on synthetic corridors
+
+Usage:
+    python -m benchmarks.run_benchmarks --sizes 2 5 10 --output output/benchmarks/results.json
+    python -m benchmarks.run_benchmarks --baseline output/benchmarks/previous.json
+"""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from time import perf_counter, strftime
+
+import numpy as np
+
+from benchmarks.synthetic_network import generate_synthetic_network, generate_synthetic_corridor, \
+    SYNTHETIC_TOD_NAME
+
+DEFAULT_SIZES = [2, 5, 10]
+DEFAULT_OUTPUT_PATH = Path("output/benchmarks/results.json")
+REGRESSION_THRESHOLD = 1.2
+
+# key: import benchmark name, val: modules imported in a fresh interpreter
+IMPORT_BENCHMARK_DICT = {
+    "import prediction core": ["models.net_dict_classes", "models.net_model"],
+    "import plotting": ["plot.draw_ts"],
+}
+# modules that should not be loaded by the prediction core
+HEAVY_MODULE_LIST = ["scipy", "pandas", "matplotlib", "networkx"]
+
+_IMPORT_SCRIPT = """
+import json, sys
+from time import perf_counter
+start_time = perf_counter()
+for module_name in {module_list}:
+    __import__(module_name)
+import_time = perf_counter() - start_time
+print(json.dumps({{"time": import_time,
+                   "heavy_modules": [val for val in {heavy_module_list} if val in sys.modules]}}))
+"""
+
+
+def bench_network_prediction(net_dict, corridor):
+    from models.net_model import update_network_prediction
+    # the repeated runs should not reuse the arrival calibration of the previous ones
+    net_dict.calibration_cache.clear()
+    update_network_prediction(net_dict, SYNTHETIC_TOD_NAME)
+
+
+def bench_arrival_calibration(net_dict, corridor):
+    from models.net_calibration import arrival_curve_calibration
+    arrival_curve_calibration(net_dict, tod_name=SYNTHETIC_TOD_NAME, use_cache=False)
+
+
+def bench_pts(net_dict, corridor):
+    from plot.draw_ts import get_pts_components
+    for movement_id in corridor.oneways["E"].distance_by_movement.keys():
+        movement_curve = net_dict.get_movement_tod_curve(movement_id, SYNTHETIC_TOD_NAME)
+        get_pts_components(movement_curve, stop_bar_distance=3, upstream_prediction=True,
+                           y_location=0, jam_density=7, upstream_length=400, downstream_length=0,
+                           repeat_cycles=3, direction=1)
+
+
+def bench_corridor_time_space_diagram(net_dict, corridor):
+    from plot.draw_ts import corridor_time_space_diagram
+    with tempfile.TemporaryDirectory() as output_path:
+        corridor_time_space_diagram(net_dict, SYNTHETIC_TOD_NAME, corridor,
+                                    output_path=Path(output_path), prefix="bench")
+
+
+BENCHMARK_DICT = {
+    "update_network_prediction": bench_network_prediction,
+    "arrival_curve_calibration": bench_arrival_calibration,
+    "pts": bench_pts,
+    "corridor_time_space_diagram": bench_corridor_time_space_diagram,
+}
+
+
+def run_benchmarks(sizes=None, benchmarks=None, repeats=3, disp=True, **network_kwargs):
+    """
+    Time each benchmark on synthetic corridors of different sizes
+
+    :param sizes: list of number of intersections
+    :param benchmarks: list of benchmark names in BENCHMARK_DICT, all if None
+    :param repeats: number of timed runs (the minimum and mean are reported)
+    :param disp:
+    :param network_kwargs: other arguments of generate_synthetic_network
+    :return: list of result dict
+    """
+    if sizes is None:
+        sizes = DEFAULT_SIZES
+    if benchmarks is None:
+        benchmarks = list(BENCHMARK_DICT.keys())
+
+    result_list = []
+    for num_intersections in sizes:
+        net_dict = generate_synthetic_network(num_intersections=num_intersections, **network_kwargs)
+        corridor = generate_synthetic_corridor(net_dict)
+        # untimed run, the predicted curves are needed by the pts & time-space diagram benchmarks
+        bench_network_prediction(net_dict, corridor)
+        for benchmark_name in benchmarks:
+            benchmark_fn = BENCHMARK_DICT[benchmark_name]
+            time_list = []
+            for _ in range(repeats):
+                start_time = perf_counter()
+                benchmark_fn(net_dict, corridor)
+                time_list.append(perf_counter() - start_time)
+            result = {"benchmark": benchmark_name,
+                      "num_intersections": num_intersections,
+                      "num_movements": len(net_dict.dict),
+                      "repeats": repeats,
+                      "min_time": float(np.min(time_list)),
+                      "mean_time": float(np.mean(time_list))}
+            result_list.append(result)
+            if disp:
+                print(f"{benchmark_name:<30s} intersections={num_intersections:<4d} "
+                      f"movements={result['num_movements']:<5d} min={result['min_time']:.4f}s "
+                      f"mean={result['mean_time']:.4f}s")
+    return result_list
+
+
+def run_import_benchmarks(repeats=3, disp=True):
+    """
+    Time the imports in fresh interpreters (e.g., the startup of a worker process)
+
+    :param repeats:
+    :param disp:
+    :return: list of result dict, with the heavy modules loaded by the imports
+    """
+    result_list = []
+    for benchmark_name, module_list in IMPORT_BENCHMARK_DICT.items():
+        script = _IMPORT_SCRIPT.format(module_list=module_list, heavy_module_list=HEAVY_MODULE_LIST)
+        time_list = []
+        heavy_module_list = []
+        for _ in range(repeats):
+            output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True)
+            output_dict = json.loads(output.stdout.strip().split("\n")[-1])
+            time_list.append(output_dict["time"])
+            heavy_module_list = output_dict["heavy_modules"]
+        result = {"benchmark": benchmark_name,
+                  "num_intersections": 0,
+                  "num_movements": 0,
+                  "repeats": repeats,
+                  "min_time": float(np.min(time_list)),
+                  "mean_time": float(np.mean(time_list)),
+                  "heavy_modules": heavy_module_list}
+        result_list.append(result)
+        if disp:
+            print(f"{benchmark_name:<30s} min={result['min_time']:.4f}s mean={result['mean_time']:.4f}s "
+                  f"heavy modules loaded: {heavy_module_list}")
+    return result_list
+
+
+def compare_with_baseline(result_list, baseline_list, threshold=REGRESSION_THRESHOLD):
+    """
+    Compare the min time with a previous run
+
+    :param result_list:
+    :param baseline_list:
+    :param threshold: ratio above which a benchmark is reported as a regression
+    :return: list of (benchmark, num_intersections, ratio) of the regressions
+    """
+    baseline_dict = {(val["benchmark"], val["num_intersections"]): val for val in baseline_list}
+    regression_list = []
+    for result in result_list:
+        baseline = baseline_dict.get((result["benchmark"], result["num_intersections"]))
+        if baseline is None:
+            continue
+        ratio = result["min_time"] / max(baseline["min_time"], 1e-9)
+        result["baseline_ratio"] = ratio
+        if ratio > threshold:
+            regression_list.append((result["benchmark"], result["num_intersections"], ratio))
+    return regression_list
+
+
+def get_environment_info():
+    return {"python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "time": strftime("%Y-%m-%d %H:%M:%S")}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scaling benchmarks on synthetic corridors")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES,
+                        help="number of intersections of the corridors")
+    parser.add_argument("--benchmarks", nargs="+", default=None, choices=list(BENCHMARK_DICT.keys()))
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--movements-per-junction", type=int, default=4)
+    parser.add_argument("--left-turn-permissive-share", type=float, default=0.5)
+    parser.add_argument("--cycle-length", type=float, default=120)
+    parser.add_argument("--resolution", type=float, default=2)
+    parser.add_argument("--trajs-per-movement", type=int, default=60)
+    parser.add_argument("--output", type=Path, default=DEFAULT_OUTPUT_PATH)
+    parser.add_argument("--baseline", type=Path, default=None,
+                        help="previous result file, regressions are reported")
+    parser.add_argument("--skip-imports", action="store_true", help="do not run the import benchmarks")
+    args = parser.parse_args()
+
+    network_kwargs = {"movements_per_junction": args.movements_per_junction,
+                      "left_turn_permissive_share": args.left_turn_permissive_share,
+                      "cycle_length": args.cycle_length,
+                      "resolution": args.resolution,
+                      "trajs_per_movement": args.trajs_per_movement}
+    result_list = []
+    if not args.skip_imports:
+        result_list += run_import_benchmarks(repeats=args.repeats)
+    result_list += run_benchmarks(sizes=args.sizes, benchmarks=args.benchmarks,
+                                  repeats=args.repeats, **network_kwargs)
+
+    regression_list = []
+    if args.baseline is not None:
+        with open(args.baseline, "r") as temp_file:
+            baseline_list = json.load(temp_file)["results"]
+        regression_list = compare_with_baseline(result_list, baseline_list)
+        for benchmark_name, num_intersections, ratio in regression_list:
+            print(f"[WARNING] regression of {benchmark_name} with {num_intersections} intersections: "
+                  f"{np.round(ratio, 2)}x of the baseline")
+
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, "w") as temp_file:
+        json.dump({"environment": get_environment_info(),
+                   "config": {"sizes": args.sizes, "repeats": args.repeats, **network_kwargs},
+                   "results": result_list,
+                   "regressions": regression_list}, temp_file, indent=2)
+    print(f"Saved to `{args.output}`")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic corridor generator for benchmarks
+
+The corridor runs from west to east, junction J0 is the westmost one. Main street through movements
+(NEMA 2 eastbound & 6 westbound) receive the departures of the through movement at the upstream junction,
+the other movements receive uncoordinated arrivals. Left turns (odd NEMA index) are either permissive,
+yielding to the opposing through movement, or protected with their own green interval.
+"""
+import random
+
+from models.curve_classes import ArrivalCurve, DepartureCurve
+from models.movement_model import update_movement_model
+from models.movement_tod_classes import MovementTOD
+from models.net_dict_classes import MovementNetDict
+from mtldp.meta.TrafficNetwork import Arterial, OnewayArterial
+
+# NEMA movement indexes, in the order they are added to a junction
+MOVEMENT_INDEX_ORDER = [2, 6, 1, 5, 4, 8, 3, 7]
+# key: left turn index, val: opposing through index
+OPPOSING_THROUGH_DICT = {1: 2, 5: 6, 3: 4, 7: 8}
+# key: left turn index, val: through index of the same approach
+SAME_APPROACH_THROUGH_DICT = {1: 6, 5: 2, 3: 8, 7: 4}
+
+# split of the cycle: (start, duration) in proportion of the cycle length
+MAIN_THROUGH_SPLIT = (0, 0.45)
+MAIN_LEFT_SPLIT = (0.45, 0.2)
+MINOR_THROUGH_SPLIT = (0.65, 0.2)
+MINOR_LEFT_SPLIT = (0.85, 0.15)
+
+SYNTHETIC_TOD_NAME = "MD"
+SYNTHETIC_TOD_INTERVAL = [10, 14]
+
+
+def generate_synthetic_network(num_intersections=5,
+                               movements_per_junction=4,
+                               left_turn_permissive_share=0.5,
+                               cycle_length=120,
+                               resolution=2,
+                               trajs_per_movement=60,
+                               departure_cycles=3,
+                               penetration_rate=0.1,
+                               junction_spacing=400,
+                               free_speed=15,
+                               turning_share=0.2,
+                               num_of_dates=1,
+                               tod_name=SYNTHETIC_TOD_NAME,
+                               seed=0):
+    """
+    Generate a calibrated-like network of a corridor
+
+    :param num_intersections:
+    :param movements_per_junction: 1 to 8, following MOVEMENT_INDEX_ORDER
+    :param left_turn_permissive_share: probability that a left turn is permissive
+    :param cycle_length: common cycle length (s)
+    :param resolution: time resolution of the curves (s)
+    :param trajs_per_movement: number of uncoordinated trajectories of each movement,
+        main street through movements also receive the trajectories from the upstream junction
+    :param departure_cycles:
+    :param penetration_rate:
+    :param junction_spacing: distance between two adjacent junctions (m)
+    :param free_speed: (m/s)
+    :param turning_share: share of the upstream through departures turning left at the downstream junction
+    :param num_of_dates:
+    :param tod_name:
+    :param seed:
+    :return: MovementNetDict
+    """
+    if not (1 <= movements_per_junction <= len(MOVEMENT_INDEX_ORDER)):
+        raise ValueError(f"movements_per_junction should be between 1 and {len(MOVEMENT_INDEX_ORDER)}, "
+                         f"got {movements_per_junction}")
+    rng = random.Random(seed)
+    tod_duration = (SYNTHETIC_TOD_INTERVAL[-1] - SYNTHETIC_TOD_INTERVAL[0]) * 3600
+    travel_time = junction_spacing / free_speed
+    movement_index_list = MOVEMENT_INDEX_ORDER[:movements_per_junction]
+
+    net_dict = MovementNetDict()
+    net_dict.resolution = resolution
+    net_dict.departure_repeats = departure_cycles
+    net_dict.date_list = [f"synthetic-{idx}" for idx in range(num_of_dates)]
+    net_dict.tod_dict = {tod_name: SYNTHETIC_TOD_INTERVAL}
+
+    # permissive or protected left turn of each junction
+    permissive_dict = {}
+    offset_dict = {}
+    for junction_idx in range(num_intersections):
+        junction_id = get_junction_id(junction_idx)
+        offset_dict[junction_id] = int(junction_idx * travel_time) % cycle_length
+        for movement_index in movement_index_list:
+            if movement_index % 2 == 1:
+                permissive_dict[(junction_id, movement_index)] = rng.random() < left_turn_permissive_share
+
+    # departures of the main street through movements, propagated junction by junction
+    for through_index, junction_order in [(2, range(num_intersections)),
+                                          (6, range(num_intersections - 1, -1, -1))]:
+        upstream_departure_list = None
+        upstream_movement_id = None
+        for junction_idx in junction_order:
+            junction_id = get_junction_id(junction_idx)
+            arrival_list, origin_list = _uncoordinated_arrivals(rng, trajs_per_movement, tod_duration)
+            # downstream left turn of the same approach take a share of the upstream departures
+            turning_arrival_list = []
+            turning_origin_list = []
+            if upstream_departure_list is not None:
+                for departure_time in upstream_departure_list:
+                    arrival_time = departure_time + travel_time + rng.uniform(-2, 2)
+                    if rng.random() < turning_share:
+                        turning_arrival_list.append(arrival_time)
+                        turning_origin_list.append(upstream_movement_id)
+                    else:
+                        arrival_list.append(arrival_time)
+                        origin_list.append(upstream_movement_id)
+            if not (through_index in movement_index_list):
+                upstream_departure_list = None
+                continue
+            movement_curve = _generate_movement(rng, junction_id, through_index, arrival_list, origin_list,
+                                                offset_dict[junction_id], cycle_length, resolution,
+                                                departure_cycles, penetration_rate, num_of_dates,
+                                                tod_name, permissive=False)
+            net_dict.add_movement_tod_curve(movement_curve)
+            upstream_departure_list = movement_curve.departure_curve.raw_data_list
+            upstream_movement_id = movement_curve.movement_id
+
+            for left_index, approach_through in SAME_APPROACH_THROUGH_DICT.items():
+                if approach_through != through_index or not (left_index in movement_index_list):
+                    continue
+                left_arrival_list, left_origin_list = _uncoordinated_arrivals(rng, trajs_per_movement,
+                                                                             tod_duration)
+                left_arrival_list += turning_arrival_list
+                left_origin_list += turning_origin_list
+                net_dict.add_movement_tod_curve(
+                    _generate_movement(rng, junction_id, left_index, left_arrival_list, left_origin_list,
+                                       offset_dict[junction_id], cycle_length, resolution,
+                                       departure_cycles, penetration_rate, num_of_dates, tod_name,
+                                       permissive=permissive_dict[(junction_id, left_index)]))
+
+    # minor street movements, uncoordinated arrivals only
+    for junction_idx in range(num_intersections):
+        junction_id = get_junction_id(junction_idx)
+        for movement_index in movement_index_list:
+            if movement_index in [2, 6, 1, 5]:
+                continue
+            arrival_list, origin_list = _uncoordinated_arrivals(rng, trajs_per_movement, tod_duration)
+            permissive = permissive_dict.get((junction_id, movement_index), False)
+            net_dict.add_movement_tod_curve(
+                _generate_movement(rng, junction_id, movement_index, arrival_list, origin_list,
+                                   offset_dict[junction_id], cycle_length, resolution, departure_cycles,
+                                   penetration_rate, num_of_dates, tod_name, permissive=permissive))
+
+    net_dict.check_network_topology()
+    return net_dict
+
+
+def generate_synthetic_corridor(net_dict, arterial_id="Synthetic Rd", junction_spacing=400):
+    """
+    Corridor of the main street through movements generated by generate_synthetic_network,
+        can be used by plot.draw_ts.corridor_time_space_diagram
+
+    :param net_dict:
+    :param arterial_id:
+    :param junction_spacing:
+    :return: Arterial
+    """
+    junction_idx_list = sorted({int(movement_id.split("_")[0][1:]) for movement_id in net_dict.dict.keys()})
+    corridor = Arterial(arterial_id)
+    for direction, through_index, junction_order in [("E", 2, junction_idx_list),
+                                                     ("W", 6, junction_idx_list[::-1])]:
+        oneway = OnewayArterial(corridor, direction)
+        distance = 0
+        for junction_idx in junction_order:
+            movement_id = get_movement_id(get_junction_id(junction_idx), through_index)
+            if movement_id in net_dict.dict.keys():
+                oneway.distance_by_movement[movement_id] = distance
+            distance += junction_spacing
+        oneway.length = distance
+        corridor.oneways[direction] = oneway
+    return corridor
+
+
+def get_junction_id(junction_idx):
+    return f"J{junction_idx}"
+
+
+def get_movement_id(junction_id, movement_index):
+    return f"{junction_id}_{movement_index}"
+
+
+def _uncoordinated_arrivals(rng, trajs_number, tod_duration):
+    arrival_list = [rng.uniform(0, tod_duration) for _ in range(trajs_number)]
+    return arrival_list, ["null"] * len(arrival_list)
+
+
+def _get_green_time(movement_index, permissive, cycle_length):
+    if movement_index in [2, 6]:
+        split = MAIN_THROUGH_SPLIT
+    elif movement_index in [4, 8]:
+        split = MINOR_THROUGH_SPLIT
+    elif permissive:
+        # permissive left turn runs with the opposing through movement
+        split = MAIN_THROUGH_SPLIT if movement_index in [1, 5] else MINOR_THROUGH_SPLIT
+    else:
+        split = MAIN_LEFT_SPLIT if movement_index in [1, 5] else MINOR_LEFT_SPLIT
+    return [[split[0] * cycle_length, split[1] * cycle_length]]
+
+
+def _generate_movement(rng, junction_id, movement_index, arrival_list, origin_list, offset,
+                       cycle_length, resolution, departure_cycles, penetration_rate, num_of_dates,
+                       tod_name, permissive=False):
+    green_start, green_duration = _get_green_time(movement_index, permissive, cycle_length)[0]
+    effective_green = green_duration - 5
+
+    departure_list = []
+    total_control_delay = 0
+    total_stopped_trajs = 0
+    for arrival_time in arrival_list:
+        time_in_green = (arrival_time - offset - green_start) % cycle_length
+        if time_in_green < effective_green and (not permissive or rng.random() < 0.5):
+            departure_time = arrival_time + rng.uniform(0, 3)
+        else:
+            departure_time = arrival_time + (cycle_length - time_in_green) + rng.uniform(2, 6)
+            total_stopped_trajs += 1
+        departure_list.append(departure_time)
+        total_control_delay += departure_time - arrival_time
+
+    movement_curve = MovementTOD()
+    movement_curve.movement_id = get_movement_id(junction_id, movement_index)
+    movement_curve.movement_index = movement_index
+    movement_curve.junction_id = junction_id
+    movement_curve.tod_name = tod_name
+    movement_curve.tod_interval = SYNTHETIC_TOD_INTERVAL
+    movement_curve.number_of_dates = num_of_dates
+    movement_curve.green_time = [[green_start, green_duration]]
+    movement_curve.yellow_change_interval = 4
+    movement_curve.clearance_interval = 1
+    movement_curve.measured_free_v = 15
+    if movement_index % 2 == 1:
+        movement_curve.permissive_type = "lt_turn_permissive" if permissive else "lt_turn_protected"
+        if permissive:
+            movement_curve.conflicting_movement_list = \
+                [get_movement_id(junction_id, OPPOSING_THROUGH_DICT[movement_index])]
+
+    movement_curve.arrival_curve = ArrivalCurve()
+    movement_curve.departure_curve = DepartureCurve()
+    movement_curve.arrival_curve.raw_data_list = list(arrival_list)
+    movement_curve.departure_curve.raw_data_list = departure_list
+    for arrival_time, origin_id in zip(arrival_list, origin_list):
+        if not (origin_id in movement_curve.arrival_curve.raw_data_dict.keys()):
+            movement_curve.arrival_curve.raw_data_dict[origin_id] = []
+        movement_curve.arrival_curve.raw_data_dict[origin_id].append(arrival_time)
+    movement_curve.upstream_movement_list = [origin_id for origin_id in movement_curve.arrival_curve.raw_data_dict
+                                             if origin_id != "null"]
+    movement_curve.total_trajs = len(arrival_list)
+    movement_curve.total_control_delay = total_control_delay
+    movement_curve.total_stopped_trajs = total_stopped_trajs
+    movement_curve.total_stops = total_stopped_trajs
+
+    # histograms & prob curves
+    update_movement_model(movement_curve, penetration_rate=penetration_rate, offset=offset,
+                          resolution=resolution, departure_cycles=departure_cycles,
+                          cycle_length=cycle_length, departure_prediction=False)
+    return movement_curve
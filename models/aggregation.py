@@ -0,0 +1,140 @@
+"""
+Aggregation of the calibrated curves of different dates
+
+The curves of a movement are merged all at once (list concatenation & histogram sums) instead of pairwise,
+and the dates are split into chunks merged by parallel workers before the chunk results are merged,
+i.e., a tree reduction with a fan-in of len(dates) / workers. The inputs are not modified and
+the intermediate results are never deep-copied.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+
+import numpy as np
+
+from models.curve_classes import ArrivalCurve, DepartureCurve
+from models.metrics import estimate_movement_delay
+from models.movement_model import _update_movement_hist_curves, _update_movement_prob_curves
+from models.movement_tod_classes import MovementTOD
+
+TOTAL_ATTRIBUTE_LIST = ["total_trajs", "total_stops", "total_stopped_trajs",
+                        "total_control_delay", "total_stop_delay"]
+
+
+def aggregate_net_dicts(net_dict_list, workers=None):
+    """
+    Aggregate the networks of different dates
+
+    :param net_dict_list: list of MovementNetDict, not modified
+    :param workers: number of worker processes, serial if None or 1
+    :return: new MovementNetDict
+    """
+    if len(net_dict_list) == 0:
+        raise ValueError("No network to aggregate")
+    resolution_list = [net_dict.resolution for net_dict in net_dict_list]
+    if len(set(resolution_list)) > 1:
+        raise ValueError(f"All the dicts should have the same resolution: "
+                         f"{[(net_dict.date_list, net_dict.resolution) for net_dict in net_dict_list]}")
+
+    if workers is None or workers <= 1 or len(net_dict_list) <= 2:
+        return _aggregate_chunk(net_dict_list)
+
+    chunk_size = int(np.ceil(len(net_dict_list) / workers))
+    chunk_list = [net_dict_list[idx: idx + chunk_size] for idx in range(0, len(net_dict_list), chunk_size)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        partial_list = list(executor.map(_aggregate_chunk, chunk_list))
+    # the partial results are new objects, they can be merged without copying
+    return _aggregate_chunk(partial_list)
+
+
+def _aggregate_chunk(net_dict_list):
+    new_cls = type(net_dict_list[0])()
+    new_cls.date_list = list(chain.from_iterable([net_dict.date_list for net_dict in net_dict_list]))
+    new_cls.resolution = net_dict_list[0].resolution
+    new_cls.departure_repeats = net_dict_list[0].departure_repeats
+    new_cls.tod_dict = net_dict_list[0].tod_dict
+
+    movement_curve_dict = {}        # key: (movement_id, tod_name), val: list of movement curves
+    for net_dict in net_dict_list:
+        for movement_id, movement_tod_dict in net_dict.dict.items():
+            for tod_name, movement_curve in movement_tod_dict.items():
+                movement_curve_dict.setdefault((movement_id, tod_name), []).append(movement_curve)
+    for movement_curve_list in movement_curve_dict.values():
+        new_cls.add_movement_tod_curve(merge_movement_curves(movement_curve_list))
+    return new_cls
+
+
+def merge_movement_curves(movement_curve_list):
+    """
+    Merge the curves of the same movement & tod from different dates into a new movement curve,
+        the spat information is taken from the first one & the predictions are reset
+
+    :param movement_curve_list:
+    :return: new MovementTOD
+    """
+    first_curve = movement_curve_list[0]
+    new_cls = MovementTOD()
+    new_cls.__dict__.update(first_curve.__dict__)
+    new_cls.upstream_movement_list = \
+        list(dict.fromkeys(chain.from_iterable([val.upstream_movement_list for val in movement_curve_list])))
+    new_cls.conflicting_movement_list = list(first_curve.conflicting_movement_list or [])
+    new_cls.origin_diverge_dict = {}
+    new_cls.origin_shift_dict = {}
+    new_cls.origin_error_dict = {}
+    for attr in ["pmf_list", "signal_state_list", "capacity_state_list", "leftover_capacity_list",
+                 "departure_calibration_error", "arrival_calibration_error"]:
+        setattr(new_cls, attr, None)
+
+    total_trajs = sum([val.total_trajs for val in movement_curve_list])
+    if total_trajs > 0:
+        new_cls.measured_free_v = sum([val.total_trajs * val.measured_free_v
+                                       for val in movement_curve_list]) / total_trajs
+    for attr in TOTAL_ATTRIBUTE_LIST:
+        setattr(new_cls, attr, sum([getattr(val, attr) for val in movement_curve_list]))
+    new_cls.number_of_dates = sum([val.number_of_dates or 0 for val in movement_curve_list])
+
+    arrival_curve_list = [val.arrival_curve for val in movement_curve_list]
+    departure_curve_list = [val.departure_curve for val in movement_curve_list]
+    new_cls.arrival_curve = ArrivalCurve()
+    new_cls.departure_curve = DepartureCurve()
+    new_cls.arrival_curve.dimension = first_curve.arrival_curve.dimension
+    new_cls.departure_curve.dimension = first_curve.departure_curve.dimension
+    new_cls.departure_curve.extend_cycles = first_curve.departure_curve.extend_cycles
+    for new_curve, curve_list in [(new_cls.arrival_curve, arrival_curve_list),
+                                  (new_cls.departure_curve, departure_curve_list)]:
+        new_curve.raw_data_list = list(chain.from_iterable([val.raw_data_list for val in curve_list]))
+    raw_data_dict = {}
+    for arrival_curve in arrival_curve_list:
+        for origin_id, time_list in arrival_curve.raw_data_dict.items():
+            raw_data_dict.setdefault(origin_id, []).append(time_list)
+    new_cls.arrival_curve.raw_data_dict = {origin_id: list(chain.from_iterable(time_lists))
+                                           for origin_id, time_lists in raw_data_dict.items()}
+
+    fine_hist_list = [val.fine_hist for val in movement_curve_list if val.fine_hist is not None]
+    if len(fine_hist_list) > 0:
+        new_cls.fine_hist = fine_hist_list[0].copy()
+        for fine_hist in fine_hist_list[1:]:
+            new_cls.fine_hist.merge(fine_hist)
+
+    binning_set = {(val.offset, val.cycle_length, val.resolution, val.departure_cycles)
+                   for val in movement_curve_list}
+    if len(binning_set) == 1 and first_curve.arrival_curve.dimension is not None:
+        new_cls.arrival_curve.curve_list = _sum_lists([val.curve_list for val in arrival_curve_list])
+        new_cls.departure_curve.curve_list = _sum_lists([val.curve_list for val in departure_curve_list])
+        origin_curve_dict = {}
+        for arrival_curve in arrival_curve_list:
+            for origin_id, curve_list in arrival_curve.origin_curve_dict.items():
+                origin_curve_dict.setdefault(origin_id, []).append(curve_list)
+        new_cls.arrival_curve.origin_curve_dict = {origin_id: _sum_lists(curve_lists)
+                                                   for origin_id, curve_lists in origin_curve_dict.items()}
+        new_cls.hist_avg_delay = estimate_movement_delay(new_cls, prob=False)
+        new_cls.departure_curve.agg_curves()
+    else:
+        # the histograms of different spat cannot be summed, re-binned with the spat of the first date
+        _update_movement_hist_curves(new_cls)
+    _update_movement_prob_curves(new_cls)
+    return new_cls
+
+
+def _sum_lists(curve_lists):
+    return np.sum(np.array(curve_lists), axis=0).tolist()
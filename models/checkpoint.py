@@ -0,0 +1,190 @@
+"""
+Checkpoint & resume of long optimization runs (e.g., models.timing_optimizer)
+
+A checkpoint keeps the table of the evaluated candidates (key: content hash of the network & the candidate, see
+models.scenario_cache), the best plan found so far and optionally the prediction state of a tod. It is saved
+periodically in a compressed .npz file. The arrays are copied by the evaluation loop and written by a background
+thread, the evaluation never waits for the disk. A run restarted with the same checkpoint file skips the candidates
+already in the table:
+    checkpoint = RunCheckpoint("runs/corridor.npz")
+    optimize_green_splits(net_dict, tod_name, checkpoint=checkpoint)
+    checkpoint.close()
+"""
+
+import json
+import os
+import threading
+from time import time
+
+import numpy as np
+from models.scenario_cache import get_prediction_arrays, set_prediction_arrays
+
+CHECKPOINT_FORMAT_VERSION = 1
+DEFAULT_SAVE_INTERVAL = 60      # (s)
+PREDICTION_PREFIX = "prediction_"
+
+
+class RunCheckpoint(object):
+    """
+    Evaluated candidates & best plan of a run, loaded from the file if it exists
+    """
+    def __init__(self, path, save_interval=DEFAULT_SAVE_INTERVAL, net_dict=None, tod_name=None):
+        """
+        :param path: .npz file
+        :param save_interval: (s) minimum time between two periodic saves
+        :param net_dict: the prediction state of the tod is saved with each checkpoint (not saved if None),
+            see restore_prediction
+        :param tod_name:
+        """
+        self.path = path
+        self.save_interval = save_interval
+        self.net_dict = net_dict
+        self.tod_name = tod_name
+        self.result_dict = {}           # key: candidate key, val: (delay (h), stops (h equivalence))
+        self.best_dict = {}             # best plan & progress of the run, JSON serializable
+        self.prediction_dict = None     # prediction arrays of the loaded checkpoint
+        self.last_save_time = time()
+        self.write_error = None
+
+        self._condition = threading.Condition()
+        self._pending_entry = None
+        self._writer_thread = None
+        if os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self.result_dict)
+
+    def get_result(self, candidate_key):
+        return self.result_dict.get(candidate_key)
+
+    def record(self, candidate_key, result):
+        """
+        Record an evaluated candidate & save if the last save is older than the save interval
+
+        :param candidate_key:
+        :param result: delay (h), stops (h equivalence)
+        :return:
+        """
+        self.result_dict[candidate_key] = (float(result[0]), float(result[1]))
+        if time() - self.last_save_time >= self.save_interval:
+            self.save()
+
+    def set_best(self, **best_kwargs):
+        """
+        Update the best plan & progress of the run (JSON serializable values)
+
+        :param best_kwargs:
+        :return:
+        """
+        self.best_dict.update(best_kwargs)
+
+    def save(self, wait=False):
+        """
+        Copy the current state & write it in the background
+
+        :param wait: block until the file is written
+        :return:
+        """
+        key_list = list(self.result_dict.keys())
+        entry_dict = {"version": np.array(CHECKPOINT_FORMAT_VERSION),
+                      "candidate_key": np.array(key_list, dtype=str),
+                      "result": np.array([self.result_dict[key] for key in key_list], dtype=float).reshape(-1, 2),
+                      "best": np.array(json.dumps(self.best_dict))}
+        if self.net_dict is not None:
+            entry_dict.update(get_prediction_arrays(self.net_dict, self.tod_name, prefix=PREDICTION_PREFIX))
+        elif self.prediction_dict is not None:
+            # the prediction state of the loaded checkpoint is kept
+            entry_dict.update(self.prediction_dict)
+        self.last_save_time = time()
+        with self._condition:
+            # only the latest state is written if the previous one is still pending
+            self._pending_entry = entry_dict
+            if self._writer_thread is None:
+                self._writer_thread = threading.Thread(target=self._write_loop, daemon=True)
+                self._writer_thread.start()
+        if wait:
+            self.flush()
+
+    def flush(self):
+        """
+        Wait for the pending writes
+
+        :return:
+        """
+        with self._condition:
+            while self._writer_thread is not None:
+                self._condition.wait()
+        if self.write_error is not None:
+            write_error = self.write_error
+            self.write_error = None
+            raise write_error
+
+    def close(self):
+        """
+        Final save of the run
+
+        :return:
+        """
+        self.save(wait=True)
+
+    def load(self):
+        """
+        Read the checkpoint file
+
+        :return:
+        """
+        with np.load(self.path, allow_pickle=False) as entry:
+            entry_dict = {name: entry[name] for name in entry.files}
+        if int(entry_dict["version"]) != CHECKPOINT_FORMAT_VERSION:
+            raise ValueError(f"Checkpoint {self.path} has the format {int(entry_dict['version'])}, "
+                             f"expected {CHECKPOINT_FORMAT_VERSION}")
+        self.result_dict = {key: (float(delay), float(stops))
+                            for key, (delay, stops) in zip(entry_dict["candidate_key"].tolist(), entry_dict["result"])}
+        self.best_dict = json.loads(str(entry_dict["best"]))
+        prediction_dict = {name: val for name, val in entry_dict.items() if name.startswith(PREDICTION_PREFIX)}
+        self.prediction_dict = prediction_dict if len(prediction_dict) > 0 else None
+        return self
+
+    def restore_prediction(self, net_dict=None, tod_name=None):
+        """
+        Restore the prediction state of the loaded checkpoint
+
+        :param net_dict: the net_dict of the checkpoint if None
+        :param tod_name:
+        :return: False if there is no prediction state or the movements are not the same
+        """
+        if net_dict is None:
+            net_dict = self.net_dict
+        if tod_name is None:
+            tod_name = self.tod_name
+        if self.prediction_dict is None:
+            return False
+        return set_prediction_arrays(net_dict, tod_name, self.prediction_dict, prefix=PREDICTION_PREFIX)
+
+    def _write_loop(self):
+        while True:
+            with self._condition:
+                entry_dict = self._pending_entry
+                self._pending_entry = None
+                if entry_dict is None:
+                    self._writer_thread = None
+                    self._condition.notify_all()
+                    return
+            try:
+                _write_entry(self.path, entry_dict)
+            except OSError as write_error:
+                self.write_error = write_error
+
+
+def _write_entry(path, entry_dict):
+    """
+    Written under a temporary name & renamed, the previous checkpoint stays valid if the process is killed
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as temp_file:
+        np.savez_compressed(temp_file, **entry_dict)
+    os.replace(temp_path, path)
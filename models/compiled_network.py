@@ -0,0 +1,222 @@
+"""
+Compiled (array) form of the movements of a tod
+
+The curves of all the movements are stacked into padded 2-D arrays (one row per movement, in the order of
+movement_id_list) with the length of each row, and the spat & ground truth attributes into 1-D arrays, so that
+the numerical kernels can process the whole network with numpy operations instead of a loop of MovementTOD.
+The compiled form is a copy: the kernels modify the arrays, and sync() writes the modified fields back to the
+MovementTOD objects. After the movements are modified by the object-based code (e.g., update_network_prediction),
+refresh() reads them again.
+"""
+
+import numpy as np
+
+# key: field name, val: (curve attribute of the movement or None for the movement itself, list attribute)
+CURVE_FIELD_DICT = {
+    "arrival_curve": ("arrival_curve", "curve_list"),
+    "arrival_prob": ("arrival_curve", "prob_list"),
+    "arrival_predict": ("arrival_curve", "predict_list"),
+    "departure_curve": ("departure_curve", "curve_list"),
+    "departure_prob": ("departure_curve", "prob_list"),
+    "departure_predict": ("departure_curve", "predict_list"),
+    "departure_agg_prob": ("departure_curve", "agg_prob_list"),
+    "departure_agg_predict": ("departure_curve", "agg_predict_list"),
+    "signal_state": (None, "signal_state_list"),
+    "capacity_state": (None, "capacity_state_list"),
+    "permissive_capacity": (None, "permissive_capacity_list"),
+    "leftover_capacity": (None, "leftover_capacity_list"),
+}
+
+SCALAR_FIELD_LIST = ["cycle_length", "offset", "resolution", "departure_cycles", "penetration_rate",
+                     "equivalent_lane_number", "sat_flow_per_lane", "total_trajs", "total_stops",
+                     "total_stopped_trajs", "total_control_delay", "total_stop_delay",
+                     "predicted_delay", "predicted_stop_ratio", "hourly_volume"]
+
+# length of a missing (None) curve
+MISSING_LENGTH = -1
+
+
+class CompiledNetwork(object):
+    """
+    Padded arrays of the curves of the movements of a tod, row i is the movement movement_id_list[i]
+    """
+    def __init__(self, net_dict, tod_name, field_list=None):
+        """
+        :param net_dict:
+        :param tod_name:
+        :param field_list: curve fields to compile (keys of CURVE_FIELD_DICT), all of them if None
+        """
+        self.tod_name = tod_name
+        self.field_list = list(CURVE_FIELD_DICT.keys()) if field_list is None else list(field_list)
+        for field in self.field_list:
+            if not (field in CURVE_FIELD_DICT.keys()):
+                raise ValueError(f"Unknown curve field {field}, available: {list(CURVE_FIELD_DICT.keys())}")
+        self.movement_curve_list = list(net_dict.get_tod_movement_dict(tod_name).values())
+        self.movement_id_list = [movement_curve.movement_id for movement_curve in self.movement_curve_list]
+        self.row_dict = {movement_id: row for row, movement_id in enumerate(self.movement_id_list)}
+        # dense integer id (net_dict.movement_registry) of each row
+        self.movement_key_array = net_dict.movement_registry.intern_array(self.movement_id_list)
+
+        self.curve_dict = {}        # key: field, val: padded 2-D array (movement x bins)
+        self.length_dict = {}       # key: field, val: length of each row (MISSING_LENGTH if None)
+        self.scalar_dict = {}       # key: attribute, val: 1-D array (nan if None)
+        self.arrival_dimension_array = None
+        self.departure_dimension_array = None
+        self.modified_set = set()   # fields to write back by sync()
+        self.refresh()
+
+    def __len__(self):
+        return len(self.movement_id_list)
+
+    def refresh(self):
+        """
+        Read the curves & attributes of the movements again, the modifications not synced are discarded
+
+        :return:
+        """
+        for field in self.field_list:
+            self.curve_dict[field], self.length_dict[field] = \
+                _stack_lists([_get_field_list(movement_curve, field) for movement_curve in self.movement_curve_list])
+        for attr in SCALAR_FIELD_LIST:
+            self.scalar_dict[attr] = np.array([np.nan if getattr(movement_curve, attr) is None
+                                               else getattr(movement_curve, attr)
+                                               for movement_curve in self.movement_curve_list], dtype=float)
+        self.arrival_dimension_array = np.array([_get_dimension(movement_curve.arrival_curve)
+                                                 for movement_curve in self.movement_curve_list], dtype=int)
+        self.departure_dimension_array = np.array([_get_dimension(movement_curve.departure_curve)
+                                                   for movement_curve in self.movement_curve_list], dtype=int)
+        self.modified_set = set()
+        return self
+
+    def get_row(self, movement_id):
+        return self.row_dict[movement_id]
+
+    def get_field(self, field):
+        """
+        :param field:
+        :return: padded 2-D array (zeros after the length of each row), length of each row
+        """
+        return self.curve_dict[field], self.length_dict[field]
+
+    def get_mask(self, field):
+        """
+        :param field:
+        :return: boolean 2-D array, True for the bins within the length of each row
+        """
+        curve_array, length_array = self.get_field(field)
+        return np.arange(curve_array.shape[1])[None, :] < length_array[:, None]
+
+    def get_curve(self, field, movement_id):
+        """
+        :param field:
+        :param movement_id:
+        :return: 1-D array of the movement (without padding), None if missing
+        """
+        row = self.row_dict[movement_id]
+        length = self.length_dict[field][row]
+        if length == MISSING_LENGTH:
+            return None
+        return self.curve_dict[field][row, :length]
+
+    def get_scalar(self, attr):
+        return self.scalar_dict[attr]
+
+    def set_field(self, field, curve_array, length_array=None):
+        """
+        Replace all the rows of a field (e.g., output of a kernel)
+
+        :param field:
+        :param curve_array: 2-D array (movement x bins)
+        :param length_array: length of each row, the current lengths if None
+        :return:
+        """
+        curve_array = np.asarray(curve_array, dtype=float)
+        if curve_array.shape[0] != len(self):
+            raise ValueError(f"Expected {len(self)} rows for {field}, got {curve_array.shape[0]}")
+        if length_array is None:
+            length_array = self.length_dict[field]
+        self.curve_dict[field] = curve_array
+        self.length_dict[field] = np.minimum(np.asarray(length_array, dtype=int), curve_array.shape[1])
+        self.modified_set.add(field)
+
+    def set_curve(self, field, movement_id, curve_list):
+        """
+        Replace the row of a movement
+
+        :param field:
+        :param movement_id:
+        :param curve_list: None to set the curve as missing
+        :return:
+        """
+        row = self.row_dict[movement_id]
+        curve_array = self.curve_dict[field]
+        if curve_list is None:
+            curve_array[row, :] = 0
+            self.length_dict[field][row] = MISSING_LENGTH
+        else:
+            length = len(curve_list)
+            if length > curve_array.shape[1]:
+                curve_array = np.pad(curve_array, ((0, 0), (0, length - curve_array.shape[1])))
+                self.curve_dict[field] = curve_array
+            curve_array[row, :] = 0
+            curve_array[row, :length] = curve_list
+            self.length_dict[field][row] = length
+        self.modified_set.add(field)
+
+    def set_scalar(self, attr, value_array):
+        self.scalar_dict[attr] = np.asarray(value_array, dtype=float)
+        self.modified_set.add(attr)
+
+    def sync(self, field_list=None):
+        """
+        Write the fields back to the MovementTOD objects
+
+        :param field_list: the modified fields (curves & scalars) if None
+        :return:
+        """
+        if field_list is None:
+            field_list = list(self.modified_set)
+        for field in field_list:
+            if field in self.curve_dict.keys():
+                curve_attr, list_attr = CURVE_FIELD_DICT[field]
+                curve_array, length_array = self.get_field(field)
+                for row, movement_curve in enumerate(self.movement_curve_list):
+                    target = movement_curve if curve_attr is None else getattr(movement_curve, curve_attr)
+                    length = length_array[row]
+                    setattr(target, list_attr,
+                            None if length == MISSING_LENGTH else curve_array[row, :length].tolist())
+            elif field in self.scalar_dict.keys():
+                for movement_curve, value in zip(self.movement_curve_list, self.scalar_dict[field]):
+                    setattr(movement_curve, field, None if np.isnan(value) else float(value))
+            else:
+                raise ValueError(f"Field {field} is not compiled")
+            self.modified_set.discard(field)
+        return self
+
+
+def _get_field_list(movement_curve, field):
+    curve_attr, list_attr = CURVE_FIELD_DICT[field]
+    target = movement_curve if curve_attr is None else getattr(movement_curve, curve_attr)
+    if target is None:
+        return None
+    return getattr(target, list_attr)
+
+
+def _get_dimension(curve):
+    if curve is None or curve.dimension is None:
+        return 0
+    return curve.dimension
+
+
+def _stack_lists(list_list):
+    """
+    :param list_list: list of lists (or None)
+    :return: padded 2-D array, length of each row
+    """
+    length_array = np.array([MISSING_LENGTH if val is None else len(val) for val in list_list], dtype=int)
+    width = max(int(np.max(length_array)), 0) if len(length_array) > 0 else 0
+    curve_array = np.zeros((len(list_list), width), dtype=float)
+    for row, val in enumerate(list_list):
+        if val is not None and len(val) > 0:
+            curve_array[row, :len(val)] = val
+    return curve_array, length_array
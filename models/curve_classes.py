@@ -15,15 +15,17 @@ class DistributionCurve(object):
         self.predict_list = None  # predicted list (departure/arrival prediction)
         self.dimension = None  # length of list
 
-    # def update_prob_curve(self, coefficient):
-    #     self.prob_list = coefficient * np.array(self.curve_list)
-    #     self.prob_list = self.prob_list.tolist()
-    #     # self.prob_list = [val * coefficient for val in self.curve_list]
+    def update_prob_curve(self, coefficient):
+        self.prob_list = coefficient * np.array(self.curve_list)
+        self.prob_list = self.prob_list.tolist()
 
     def get_prediction_error(self, norm=2):
         error = np.sum(np.abs((np.array(self.prob_list) - np.array(self.predict_list)) ** norm)) ** (1 / norm)
         return error
 
+    def to_dict(self):
+        return {k: _to_builtin(v) for k, v in self.__dict__.items()}
+
     def from_dict(self, input_dict):
         for k, v in input_dict.items():
             setattr(self, k, v)
@@ -45,9 +47,135 @@ class ArrivalCurve(DistributionCurve):
     def __init__(self):
         super().__init__()
         self.raw_data_dict = {}
-        self.origin_curve_dict = {}
-        self.origin_prob_dict = {}
-        self.origin_predict_dict = {}
+        # the origin curves are stored as 2-D arrays (origin x time bins) with the origin of each row,
+        #   origin_curve_dict, origin_prob_dict & origin_predict_dict are views of the rows
+        self.origin_id_dict = {"curve": [], "prob": [], "predict": []}            # key: curve type
+        self.origin_array_dict = {"curve": None, "prob": None, "predict": None}   # key: curve type
+
+    @property
+    def origin_curve_dict(self):
+        return self.get_origin_dict("curve")
+
+    @origin_curve_dict.setter
+    def origin_curve_dict(self, origin_dict):
+        self.set_origin_dict(origin_dict, "curve")
+
+    @property
+    def origin_prob_dict(self):
+        return self.get_origin_dict("prob")
+
+    @origin_prob_dict.setter
+    def origin_prob_dict(self, origin_dict):
+        self.set_origin_dict(origin_dict, "prob")
+
+    @property
+    def origin_predict_dict(self):
+        return self.get_origin_dict("predict")
+
+    @origin_predict_dict.setter
+    def origin_predict_dict(self, origin_dict):
+        self.set_origin_dict(origin_dict, "predict")
+
+    def get_raw_origin_list(self):
+        """
+        Origin of each trajectory of raw_data_list (matched by arrival time with raw_data_dict)
+
+        :return:
+        """
+        origin_dict = {}
+        for origin_id, time_list in self.raw_data_dict.items():
+            for arrival_time in time_list:
+                origin_dict.setdefault(arrival_time, []).append(origin_id)
+        return [origin_dict[arrival_time].pop() if origin_dict.get(arrival_time) else "null"
+                for arrival_time in self.raw_data_list]
+
+    def get_origin_dict(self, curve_type="curve"):
+        """
+        Dict view of the origin array, the values are the rows (modified in place with the array)
+
+        :param curve_type: "curve", "prob" or "predict"
+        :return: {origin_id: 1-D array}
+        """
+        origin_array = self.origin_array_dict[curve_type]
+        if origin_array is None:
+            return {}
+        return dict(zip(self.origin_id_dict[curve_type], origin_array))
+
+    def set_origin_dict(self, origin_dict, curve_type="curve"):
+        """
+        :param origin_dict: {origin_id: curve list}
+        :param curve_type: "curve", "prob" or "predict"
+        :return:
+        """
+        origin_dict = origin_dict or {}
+        self.set_origin_array(list(origin_dict.keys()),
+                              np.array(list(origin_dict.values())) if len(origin_dict) > 0 else None, curve_type)
+
+    def get_origin_array(self, origin_id_list=None, curve_type="curve"):
+        """
+        Stacked origin curves (origin x time bins), the origins missing in the curve type are skipped
+
+        :param origin_id_list: all the origins if None (the stored array, not a copy)
+        :param curve_type: "curve", "prob" or "predict"
+        :return: list of origin ids (row index), 2-D array
+        """
+        stored_id_list = self.origin_id_dict[curve_type]
+        origin_array = self.origin_array_dict[curve_type]
+        if origin_id_list is None:
+            return list(stored_id_list), origin_array
+        row_dict = {origin_id: row for row, origin_id in enumerate(stored_id_list)}
+        origin_id_list = [origin_id for origin_id in origin_id_list if origin_id in row_dict.keys()]
+        if len(origin_id_list) == 0:
+            return origin_id_list, None
+        return origin_id_list, origin_array[[row_dict[origin_id] for origin_id in origin_id_list]]
+
+    def set_origin_array(self, origin_id_list, origin_array, curve_type="curve"):
+        """
+        :param origin_id_list: origin of each row
+        :param origin_array: 2-D array (origin x time bins), None if there is no origin
+        :param curve_type: "curve", "prob" or "predict"
+        :return:
+        """
+        if len(origin_id_list) == 0:
+            origin_id_list, origin_array = [], None
+        self.origin_id_dict[curve_type] = list(origin_id_list)
+        self.origin_array_dict[curve_type] = None if origin_array is None else np.asarray(origin_array)
+
+    def set_origin_row(self, origin_id, curve_list, curve_type="curve"):
+        """
+        Replace the row of an origin, a new origin is appended
+
+        :param origin_id:
+        :param curve_list:
+        :param curve_type: "curve", "prob" or "predict"
+        :return:
+        """
+        curve_array = np.asarray(curve_list)
+        origin_id_list = self.origin_id_dict[curve_type]
+        origin_array = self.origin_array_dict[curve_type]
+        if origin_array is None:
+            self.set_origin_array([origin_id], curve_array[None, :], curve_type)
+            return
+        origin_array = origin_array.astype(np.result_type(origin_array, curve_array), copy=False)
+        if origin_id in origin_id_list:
+            origin_array[origin_id_list.index(origin_id)] = curve_array
+            self.origin_array_dict[curve_type] = origin_array
+        else:
+            self.set_origin_array(origin_id_list + [origin_id], np.vstack([origin_array, curve_array]), curve_type)
+
+    def update_prob_curve(self, coefficient):
+        super().update_prob_curve(coefficient)
+        origin_array = self.origin_array_dict["curve"]
+        self.set_origin_array(self.origin_id_dict["curve"],
+                              None if origin_array is None else coefficient * origin_array.astype(float), "prob")
+
+    def to_dict(self):
+        # the serialized form keeps the origin dicts of lists
+        output_dict = {k: _to_builtin(v) for k, v in self.__dict__.items()
+                       if not (k in ["origin_id_dict", "origin_array_dict"])}
+        for curve_type in self.origin_id_dict.keys():
+            output_dict[f"origin_{curve_type}_dict"] = _to_builtin(self.get_origin_dict(curve_type))
+        return output_dict
 
 
 class DepartureCurve(DistributionCurve):
@@ -58,6 +186,10 @@ class DepartureCurve(DistributionCurve):
         self.agg_prob_list = None
         self.agg_predict_list = None
 
+    def update_prob_curve(self, coefficient):
+        super().update_prob_curve(coefficient)
+        self.agg_curves()
+
     def agg_curves(self):
         if self.prob_list is not None:
             if len(self.prob_list) == self.dimension:
@@ -86,3 +218,16 @@ class DepartureCurve(DistributionCurve):
             else:
                 agg_array += local_array
         return agg_array.tolist()
+
+
+def _to_builtin(value):
+    """
+    numpy arrays & scalars to lists & floats (json serializable)
+    """
+    if isinstance(value, dict):
+        return {k: _to_builtin(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_builtin(v) for v in value]
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    return value
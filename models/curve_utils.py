@@ -4,7 +4,6 @@ Utility functions for operating list (arrival & departure curves)
 """
 
 import numpy as np
-from scipy.integrate import quad
 import math
 
 
@@ -56,6 +55,28 @@ def _get_optimal_shift(target_list, moving_list,
     return best_shift, minimum_cost
 
 
+def get_optimal_shift_batch(target_array, moving_array):
+    """
+    Optimal integer shift of many pairs at once, same search as get_optimal_shift (accurate_mode=False)
+
+    :param target_array: 2-D array (pair x bins)
+    :param moving_array: 2-D array (pair x bins), shifted to fit the target
+    :return: optimal shift array (int), error array
+    """
+    target_array = np.asarray(target_array, dtype=float)
+    moving_array = np.asarray(moving_array, dtype=float)
+    dimension = target_array.shape[1]
+    shift_array = np.arange(0, dimension - 1)
+    # rolled_array[pair, shift, i] = moving_array[pair, i - shift]
+    roll_index = (np.arange(dimension)[None, :] - shift_array[:, None]) % dimension
+    rolled_array = moving_array[:, roll_index]
+    error_array = np.sum(np.sqrt(np.square(rolled_array - target_array[:, None, :])), axis=2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        error_array = error_array / np.sum(target_array, axis=1)[:, None]
+    min_error_index = np.argmin(error_array, axis=1)
+    return shift_array[min_error_index], error_array[np.arange(len(min_error_index)), min_error_index]
+
+
 def shift_list_by_val(input_list, shift_interval=0.0):
     """
     Shift a list by certain value
@@ -81,6 +102,23 @@ def gaussian_cdf(x, mu=2.5, var=1):
     return cd
 
 
+def gaussian_cdf_integral(lower, upper, mu=2.5, var=1):
+    """
+    Integral of gaussian_cdf from lower to upper in closed form (no numerical quadrature needed):
+        int Phi((x - mu) / var) dx = (x - mu) * Phi((x - mu) / var) + var * phi((x - mu) / var)
+
+    :param lower:
+    :param upper:
+    :param mu:
+    :param var:
+    :return:
+    """
+    def _antiderivative(x):
+        z = (x - mu) / var
+        return (x - mu) * gaussian_cdf(x, mu, var) + var * math.exp(-z * z / 2) / math.sqrt(2 * math.pi)
+    return _antiderivative(upper) - _antiderivative(lower)
+
+
 DEFAULT_GREEN_START_MU = 2.5
 DEFAULT_GREEN_START_VAR = 1
 
@@ -92,15 +130,15 @@ def cum_normal_green_start(green_start, time, resolution,
     green_end_time = green_start_time + resolution
     if green_start_time == 0:
         green_start_time -= 1
-    prob = quad(gaussian_cdf, green_start_time, green_end_time, args=(mu, var))
-    return prob[0] / resolution
+    prob = gaussian_cdf_integral(green_start_time, green_end_time, mu, var)
+    return prob / resolution
 
 
 def cum_normal_abnormal_green_start(difference, resolution,
                                     mu=DEFAULT_GREEN_START_MU,
                                     var=DEFAULT_GREEN_START_VAR):
-    prob = quad(gaussian_cdf, -1, difference, args=(mu, var))
-    return prob[0] / resolution
+    prob = gaussian_cdf_integral(-1, difference, mu, var)
+    return prob / resolution
 
 
 def agg_curves(curve_list, dimension, extend_cycles):
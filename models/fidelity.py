@@ -0,0 +1,80 @@
+"""
+Fidelity settings of the network prediction
+
+The default settings are the full model. A cheaper fidelity (e.g., to screen many candidate plans) is activated
+for a block of code, the prediction functions read the active settings instead of receiving them as arguments:
+    with PredictionFidelity(departure_steps=5, permissive_update=False).activate():
+        update_network_prediction(...)
+"""
+
+from contextlib import contextmanager
+
+DEFAULT_DEPARTURE_STEPS = 15
+
+_active_fidelity = None
+
+
+class PredictionFidelity(object):
+    """
+    Settings trading accuracy for speed, the defaults are the full model
+    """
+    def __init__(self, departure_steps=DEFAULT_DEPARTURE_STEPS, permissive_update=True,
+                 binary_green=False, max_super_iterations=None, resolution=None):
+        """
+        :param departure_steps: maximum number of fixed-point steps of the departure prediction
+        :param permissive_update: re-compute the permissive capacity from the conflicting movements,
+            otherwise keep the capacity of the last prediction (not valid if the conflicting movements change)
+        :param binary_green: 0/1 signal state instead of the start-up & clearance distributions
+        :param max_super_iterations: number of super iterations of the network prediction, unchanged if None
+        :param resolution: resolution (s) of the histograms, unchanged if None
+        """
+        self.departure_steps = departure_steps
+        self.permissive_update = permissive_update
+        self.binary_green = binary_green
+        self.max_super_iterations = max_super_iterations
+        self.resolution = resolution
+
+    @contextmanager
+    def activate(self):
+        """
+        Make these settings the active ones (not thread-safe, one active fidelity per process)
+
+        :return:
+        """
+        global _active_fidelity
+        previous_fidelity = _active_fidelity
+        _active_fidelity = self
+        try:
+            yield self
+        finally:
+            _active_fidelity = previous_fidelity
+
+    def apply(self, net_dict, tod_name):
+        """
+        Apply the movement settings (resolution & binary green) to the movements of a tod & the resolution
+            to the network (used by the permissive capacity), use it within net_dict.trial(tod_name)
+            to restore the full model afterwards
+
+        :param net_dict:
+        :param tod_name:
+        :return:
+        """
+        # imported here, the movement model reads the active fidelity
+        from models.movement_model import update_movement_model
+        if self.resolution is not None:
+            net_dict.resolution = self.resolution
+        for movement_curve in net_dict.get_tod_movement_dict(tod_name).values():
+            if self.binary_green:
+                movement_curve.binary_green = True
+            if self.resolution is not None:
+                update_movement_model(movement_curve, resolution=self.resolution, departure_prediction=False)
+        return net_dict
+
+
+FULL_FIDELITY = PredictionFidelity()
+
+
+def get_active_fidelity():
+    if _active_fidelity is None:
+        return FULL_FIDELITY
+    return _active_fidelity
@@ -0,0 +1,53 @@
+"""
+Interning of the string movement identifiers as dense integers
+
+The string ids are kept by the public API (dict keys, json files), the dense integers are used by the
+array-based computation, e.g., the dependency scheduling of the network prediction.
+"""
+
+import numpy as np
+
+UNKNOWN_ID = -1
+
+
+class IdRegistry(object):
+    """
+    Bidirectional map between the string ids and 0, 1, 2, ... (in the order of interning)
+    """
+    def __init__(self):
+        self.id_dict = {}       # key: string id, val: integer id
+        self.name_list = []     # string id of each integer id
+
+    def intern(self, name):
+        """
+        :param name: string id
+        :return: integer id, a new one is assigned if the name is not registered yet
+        """
+        int_id = self.id_dict.get(name)
+        if int_id is None:
+            int_id = len(self.name_list)
+            self.id_dict[name] = int_id
+            self.name_list.append(name)
+        return int_id
+
+    def intern_array(self, name_list):
+        """
+        :param name_list:
+        :return: numpy array of integer ids
+        """
+        return np.array([self.intern(name) for name in name_list], dtype=int)
+
+    def get_id(self, name, default=UNKNOWN_ID):
+        return self.id_dict.get(name, default)
+
+    def get_name(self, int_id):
+        return self.name_list[int_id]
+
+    def get_name_list(self, int_id_list):
+        return [self.name_list[int_id] for int_id in int_id_list]
+
+    def __len__(self):
+        return len(self.name_list)
+
+    def __contains__(self, name):
+        return name in self.id_dict
@@ -4,7 +4,10 @@ This file is to derive delay metrics from network & movement
 
 
 import numpy as np
-from models.curve_utils import curve_time_integral
+from models.compiled_network import CompiledNetwork, MISSING_LENGTH
+
+# curve fields of the network metrics
+METRIC_FIELD_LIST = ["arrival_prob", "arrival_predict", "departure_prob", "departure_predict"]
 
 
 def estimate_movement_volumes(movement_tod, prob=True):
@@ -40,9 +43,8 @@ def estimate_movement_delay(movement_tod, prob=False,
     arrival_list, departure_list, normalize = \
         movement_tod.get_arrival_departure_curves(prob, departure_predict, arrival_predict)
 
-    cumulative_departure = curve_time_integral(departure_list)
-    cumulative_arrival = curve_time_integral(arrival_list)
-    total_delay = cumulative_departure[-1] - cumulative_arrival[-1]
+    # last element of the cumulative time integral (curve_time_integral) of each curve
+    total_delay = _time_integral(departure_list) - _time_integral(arrival_list)
 
     total_delay *= movement_tod.resolution
     avg_delay = total_delay / max(normalize, 1)
@@ -71,3 +73,109 @@ def get_movement_calibration_diff(movement_tod, stop_weight=30):
     ground_truth_val += (movement_tod.total_stopped_trajs * stop_weight) / max(movement_tod.total_trajs, 1)
     residual = predicted_val - ground_truth_val
     return residual
+
+
+def get_network_hourly_cost(net_dict, tod_name, stop_weight=30, junction_list=None):
+    """
+    Hourly delay & stops of the predicted movements of a tod (weighted by the estimated hourly volume)
+
+    :param net_dict:
+    :param tod_name:
+    :param stop_weight: (s) per stop
+    :param junction_list: all the junctions if None
+    :return: delay (h), stops (h equivalence)
+    """
+    total_delay = 0
+    total_stops = 0
+    for movement_curve in net_dict.get_tod_movement_dict(tod_name).values():
+        if (junction_list is not None) and not (movement_curve.junction_id in junction_list):
+            continue
+        hourly_volume = movement_curve.hourly_volume or 0
+        total_delay += movement_curve.predicted_delay * hourly_volume
+        total_stops += movement_curve.predicted_stop_ratio * hourly_volume
+    return total_delay / 3600, total_stops * stop_weight / 3600
+
+
+def get_network_metrics(net_dict, tod_name, compiled_network=None, stop_weight=30,
+                        departure_predict=True, arrival_predict=True, as_df=False):
+    """
+    Delay, stop ratio, hourly volume & calibration residual of all the movements of a tod,
+        the curve measures are computed on the stacked prob curves (see models.compiled_network)
+        instead of a loop of movements
+
+    :param net_dict:
+    :param tod_name:
+    :param compiled_network: CompiledNetwork of the tod with the METRIC_FIELD_LIST fields, compiled if None
+    :param stop_weight: (s) per stop of the calibration residual
+    :param departure_predict: curve delay of the predicted departure (prob departure of the movements without
+        prediction)
+    :param arrival_predict: curve delay of the predicted arrival (prob arrival of the movements without prediction)
+    :param as_df: return a DataFrame instead of a structured array
+    :return: one row per movement: movement_id, junction_id, delay (s), curve_delay (s), stop_ratio,
+        hourly_volume (veh/h), calibration_residual (s, same as get_movement_calibration_diff).
+        The delay & the stop ratio are the stored predicted_delay & predicted_stop_ratio of the last prediction,
+        they are by-products of the queue pmf of the departure prediction. The curve delay is a separate measure,
+        the time between the arrival & departure curves (see estimate_movement_delay), it may differ from the
+        predicted delay by a few seconds
+    """
+    if compiled_network is None:
+        compiled_network = CompiledNetwork(net_dict, tod_name, field_list=METRIC_FIELD_LIST)
+
+    arrival_array = _get_predicted_field(compiled_network, "arrival", arrival_predict)
+    departure_array = _get_predicted_field(compiled_network, "departure", departure_predict)
+    resolution_array = compiled_network.get_scalar("resolution")
+    # same as estimate_movement_delay: the prob curves are normalized by the total departure
+    total_delay_array = departure_array @ np.arange(1, departure_array.shape[1] + 1) - \
+        arrival_array @ np.arange(1, arrival_array.shape[1] + 1)
+    curve_delay_array = total_delay_array * resolution_array / np.maximum(departure_array.sum(axis=1), 1)
+
+    # same as estimate_movement_volumes
+    arrival_prob_array, _ = compiled_network.get_field("arrival_prob")
+    arrival_per_cycle_array = arrival_prob_array.sum(axis=1) * resolution_array * \
+        compiled_network.get_scalar("equivalent_lane_number")
+    volume_array = 3600 * arrival_per_cycle_array / compiled_network.get_scalar("cycle_length")
+
+    # same as get_movement_calibration_diff
+    delay_array = compiled_network.get_scalar("predicted_delay")
+    stop_ratio_array = compiled_network.get_scalar("predicted_stop_ratio")
+    trajs_array = np.maximum(np.nan_to_num(compiled_network.get_scalar("total_trajs")), 1)
+    residual_array = stop_ratio_array * stop_weight + delay_array - \
+        (compiled_network.get_scalar("total_control_delay") +
+         compiled_network.get_scalar("total_stopped_trajs") * stop_weight) / trajs_array
+
+    junction_id_list = [movement_curve.junction_id for movement_curve in compiled_network.movement_curve_list]
+    metric_array = np.zeros(len(compiled_network), dtype=[("movement_id", object), ("junction_id", object),
+                                                          ("delay", float), ("curve_delay", float),
+                                                          ("stop_ratio", float),
+                                                          ("hourly_volume", float),
+                                                          ("calibration_residual", float)])
+    metric_array["movement_id"] = compiled_network.movement_id_list
+    metric_array["junction_id"] = junction_id_list
+    metric_array["delay"] = delay_array
+    metric_array["curve_delay"] = curve_delay_array
+    metric_array["stop_ratio"] = stop_ratio_array
+    metric_array["hourly_volume"] = volume_array
+    metric_array["calibration_residual"] = residual_array
+    if as_df:
+        import pandas as pd
+        return pd.DataFrame(metric_array)
+    return metric_array
+
+
+def _get_predicted_field(compiled_network, curve_name, predict):
+    """
+    :return: padded 2-D array of the predicted curves, the prob curve of the rows without prediction
+    """
+    prob_array, _ = compiled_network.get_field(f"{curve_name}_prob")
+    if not predict:
+        return prob_array
+    predict_array, length_array = compiled_network.get_field(f"{curve_name}_predict")
+    width = max(prob_array.shape[1], predict_array.shape[1])
+    prob_array = np.pad(prob_array, ((0, 0), (0, width - prob_array.shape[1])))
+    predict_array = np.pad(predict_array, ((0, 0), (0, width - predict_array.shape[1])))
+    return np.where((length_array == MISSING_LENGTH)[:, None], prob_array, predict_array)
+
+
+def _time_integral(curve_list):
+    curve_array = np.asarray(curve_list, dtype=float)
+    return float(curve_array @ np.arange(1, len(curve_array) + 1))
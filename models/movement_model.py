@@ -3,6 +3,8 @@ from models.metrics import estimate_movement_volumes, \
     estimate_movement_delay
 from models.spat_utils import update_movement_capacity_state
 from models.pmf_utils import SingleQueuePmf
+from models.fidelity import get_active_fidelity
+from models.profiling import profile_stage, STAGE_SIGNAL_STATE, STAGE_DEPARTURE_ITERATION
 
 
 def update_movement_model(movement_tod, penetration_rate=None,
@@ -112,26 +114,30 @@ def update_movement_model(movement_tod, penetration_rate=None,
     return movement_tod.predicted_delay
 
 
-def _departure_curve_prediction(movement_tod, maximum_steps=15,
+def _departure_curve_prediction(movement_tod, maximum_steps=None,
                                 stopping_criteria=1e-6,
                                 use_predicted_arrival=False):
     """
     departure curve models given the arrival curve
 
-    :param maximum_steps:
+    :param maximum_steps: departure steps of the active fidelity if None (see models.fidelity)
     :param use_predicted_arrival:
     :return:
     """
-    update_movement_capacity_state(movement_tod)
+    if maximum_steps is None:
+        maximum_steps = get_active_fidelity().departure_steps
+    with profile_stage(movement_tod, STAGE_SIGNAL_STATE):
+        update_movement_capacity_state(movement_tod)
     # predict the departure curve given the current
     departure_dim = movement_tod.departure_curve.dimension
     predict_departure_list = [0 for _ in range(departure_dim)]
 
     prv_metric = None
     for i_step in range(maximum_steps):
-        predict_departure_list = \
-            _departure_prediction_step(movement_tod, predict_departure_list,
-                                       use_predicted_arrival=use_predicted_arrival)
+        with profile_stage(movement_tod, STAGE_DEPARTURE_ITERATION):
+            predict_departure_list = \
+                _departure_prediction_step(movement_tod, predict_departure_list,
+                                           use_predicted_arrival=use_predicted_arrival)
         current_metric = movement_tod.predicted_delay
         if prv_metric is not None:
             if abs(current_metric - prv_metric) / max(prv_metric, 1) <= stopping_criteria:
@@ -234,36 +240,32 @@ def _update_movement_hist_curves(movement_tod):
     movement_tod.arrival_curve.dimension = int(np.ceil(movement_tod.cycle_length / movement_tod.resolution))
     movement_tod.departure_curve.dimension = movement_tod.arrival_curve.dimension * movement_tod.departure_cycles
     movement_tod.departure_curve.extend_cycles = movement_tod.departure_cycles
+    if movement_tod.fine_hist is not None:
+        # compact mode, the histograms are folded from the fine histogram
+        movement_tod.arrival_curve.origin_curve_dict, movement_tod.arrival_curve.curve_list, \
+            movement_tod.departure_curve.curve_list = \
+            movement_tod.fine_hist.fold(movement_tod.offset, movement_tod.cycle_length, movement_tod.resolution,
+                                        movement_tod.arrival_curve.dimension,
+                                        movement_tod.departure_curve.dimension)
+        movement_tod.hist_avg_delay = estimate_movement_delay(movement_tod, prob=False)
+        movement_tod.departure_curve.agg_curves()
+        return
+
     origin_curve_dict = {}
     for origin_id, time_list in movement_tod.arrival_curve.raw_data_dict.items():
         curve_list = [0 for _ in range(movement_tod.arrival_curve.dimension)]
         for arrival_time in time_list:
-            arrival_time -= movement_tod.offset
-            time_in_cycle = arrival_time % movement_tod.cycle_length
-            cycle_index = int(time_in_cycle / movement_tod.resolution)
-            if cycle_index >= movement_tod.arrival_curve.dimension:
-                cycle_index = movement_tod.arrival_curve.dimension - 1
-            curve_list[cycle_index] += 1
+            curve_list[get_arrival_hist_index(movement_tod, arrival_time)] += 1
         origin_curve_dict[origin_id] = curve_list
     movement_tod.arrival_curve.origin_curve_dict = origin_curve_dict
 
     arrival_curve_list = [0 for _ in range(movement_tod.arrival_curve.dimension)]
     departure_curve_list = [0 for _ in range(movement_tod.departure_curve.dimension)]
     for idx in range(len(movement_tod.arrival_curve.raw_data_list)):
-        arrival_time = movement_tod.arrival_curve.raw_data_list[idx]
-        departure_time = movement_tod.departure_curve.raw_data_list[idx]
-        arrival_time -= movement_tod.offset
-        arrival_time_in_cycle = arrival_time % movement_tod.cycle_length
-        shift_time = arrival_time - arrival_time_in_cycle
-        departure_time_in_cycle = departure_time - shift_time - movement_tod.offset
-        arrival_index = int(arrival_time_in_cycle / movement_tod.resolution)
-        if arrival_index >= movement_tod.arrival_curve.dimension:
-            arrival_index = movement_tod.arrival_curve.dimension - 1
+        arrival_index, departure_index = \
+            get_hist_indexes(movement_tod, movement_tod.arrival_curve.raw_data_list[idx],
+                             movement_tod.departure_curve.raw_data_list[idx])
         arrival_curve_list[arrival_index] += 1
-
-        departure_index = int(departure_time_in_cycle / movement_tod.resolution)
-        if departure_index >= movement_tod.departure_curve.dimension:
-            departure_index = movement_tod.departure_curve.dimension - 1
         departure_curve_list[departure_index] += 1
 
     movement_tod.arrival_curve.curve_list = arrival_curve_list
@@ -272,6 +274,45 @@ def _update_movement_hist_curves(movement_tod):
     movement_tod.departure_curve.agg_curves()
 
 
+def get_arrival_hist_index(movement_tod, arrival_time):
+    """
+    Index of an arrival in the arrival histogram (given the offset, cycle length & resolution)
+
+    :param movement_tod:
+    :param arrival_time: time within the tod
+    :return:
+    """
+    time_in_cycle = (arrival_time - movement_tod.offset) % movement_tod.cycle_length
+    cycle_index = int(time_in_cycle / movement_tod.resolution)
+    if cycle_index >= movement_tod.arrival_curve.dimension:
+        cycle_index = movement_tod.arrival_curve.dimension - 1
+    return cycle_index
+
+
+def get_hist_indexes(movement_tod, arrival_time, departure_time):
+    """
+    Indexes of a trajectory in the arrival & departure histograms,
+        the departure is counted from the cycle of the arrival
+
+    :param movement_tod:
+    :param arrival_time: time within the tod
+    :param departure_time: time within the tod
+    :return: arrival index, departure index
+    """
+    arrival_time -= movement_tod.offset
+    arrival_time_in_cycle = arrival_time % movement_tod.cycle_length
+    shift_time = arrival_time - arrival_time_in_cycle
+    departure_time_in_cycle = departure_time - shift_time - movement_tod.offset
+    arrival_index = int(arrival_time_in_cycle / movement_tod.resolution)
+    if arrival_index >= movement_tod.arrival_curve.dimension:
+        arrival_index = movement_tod.arrival_curve.dimension - 1
+
+    departure_index = int(departure_time_in_cycle / movement_tod.resolution)
+    if departure_index >= movement_tod.departure_curve.dimension:
+        departure_index = movement_tod.departure_curve.dimension - 1
+    return arrival_index, departure_index
+
+
 def _update_movement_prob_curves(self):
     """
     update the scaled probability given the number of date, penetration rate and lane number
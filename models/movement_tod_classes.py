@@ -1,5 +1,6 @@
 from copy import deepcopy
 from models.curve_classes import ArrivalCurve, DepartureCurve
+from models.fine_hist import FineHistogram
 
 
 class MovementTOD(object):
@@ -18,6 +19,7 @@ class MovementTOD(object):
 
         self.departure_curve = None
         self.arrival_curve = None
+        self.fine_hist = None       # FineHistogram replacing the raw data (compact mode)
 
         # spat information
         self.cycle_length = None
@@ -151,6 +153,8 @@ class MovementTOD(object):
         output_dict = deepcopy(self.__dict__)
         output_dict["arrival_curve"] = self.arrival_curve.to_dict()
         output_dict["departure_curve"] = self.departure_curve.to_dict()
+        if self.fine_hist is not None:
+            output_dict["fine_hist"] = self.fine_hist.to_dict()
         return output_dict
 
     def from_dict(self, input_dict):
@@ -159,6 +163,8 @@ class MovementTOD(object):
                 v = ArrivalCurve().from_dict(v)
             elif k == 'departure_curve':
                 v = DepartureCurve().from_dict(v)
+            elif k == 'fine_hist' and v is not None:
+                v = FineHistogram().from_dict(v)
             setattr(self, k, v)
         return self
 
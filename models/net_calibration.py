@@ -1,24 +1,116 @@
+from hashlib import blake2b
+
 import numpy as np
-from models.curve_utils import get_optimal_shift, shift_list_by_val
+from models.compiled_network import CompiledNetwork
+from models.curve_utils import get_optimal_shift, get_optimal_shift_batch, shift_list_by_val
+from models.profiling import profile_stage, profile_batch, STAGE_ARRIVAL_CALIBRATION
+
+# memory of a vectorized block of (upstream, origin) pairs: the shift search holds a few float arrays of
+#   pairs x shifts x bins, i.e. quadratic in the dimension of the curves (cycle length / resolution)
+CALIBRATION_BLOCK_BYTES = 128 * 1024 * 1024
+CALIBRATION_TEMPORARY_ARRAYS = 3
 
 
-def arrival_curve_calibration(curve_dict, tod_name=None):
+def arrival_curve_calibration(curve_dict, tod_name=None, use_cache=True):
     """
     Arrival curve calibration:
 
     :param curve_dict:
     :param tod_name:
+    :param use_cache: skip the (movement, origin) pairs whose inputs are unchanged since the last calibration
     :return:
     """
-    for movement_id, movement_curve_dict in curve_dict.dict.items():
-        for local_tod, movement_curve in movement_curve_dict.items():
-            if tod_name is not None:
-                if local_tod != tod_name:
-                    continue
-            movement_arrival_calibration(curve_dict, movement_curve, debug_mode=False)
+    if tod_name is not None:
+        return batch_arrival_calibration(curve_dict, tod_name, use_cache=use_cache)
+    for local_tod in list(curve_dict.tod_index.keys()):
+        batch_arrival_calibration(curve_dict, local_tod, use_cache=use_cache)
     return curve_dict
 
 
+def batch_arrival_calibration(net_dict, tod_name, use_cache=True):
+    """
+    Arrival calibration of all the (upstream departure, origin arrival) pairs of a tod at once,
+        same results as movement_arrival_calibration (use_prob=True, upstream_predict=False)
+
+    The results are cached in net_dict.calibration_cache with a fingerprint of the penetration rates
+        & the input curves, the pairs with the same fingerprint as the last calibration are not recomputed.
+    The upstream departures of a block are gathered from the compiled departure curves of the tod
+        (see models.compiled_network), one row per pair
+
+    :param net_dict:
+    :param tod_name:
+    :param use_cache:
+    :return:
+    """
+    calibration_cache = net_dict.calibration_cache
+    movement_curve_list = list(net_dict.get_tod_movement_dict(tod_name).values())
+    with profile_batch(movement_curve_list, STAGE_ARRIVAL_CALIBRATION):
+        compiled_network = CompiledNetwork(net_dict, tod_name, field_list=["departure_agg_prob"])
+        departure_array, _ = compiled_network.get_field("departure_agg_prob")
+        pair_dict = {}      # key: dimensions, val: list of (movement_curve, origin_id, upstream row, downstream)
+        for movement_curve in movement_curve_list:
+            net_dict.merge_minor_origins(movement_curve)
+            for origin_movement_id, downstream_arrival_list in \
+                    movement_curve.arrival_curve.origin_prob_dict.items():
+                if origin_movement_id == "null":
+                    continue
+                upstream_movement_curve = net_dict.get_movement_tod_curve(origin_movement_id, tod_name)
+                upstream_departure_list = compiled_network.get_curve("departure_agg_prob", origin_movement_id)
+                cache_key = (movement_curve.movement_id, tod_name, origin_movement_id)
+                fingerprint = _get_calibration_fingerprint(movement_curve, upstream_movement_curve,
+                                                           upstream_departure_list, downstream_arrival_list)
+                cached_result = calibration_cache.get(cache_key)
+                if use_cache and (cached_result is not None) and cached_result[0] == fingerprint:
+                    _set_origin_calibration(movement_curve, origin_movement_id, *cached_result[1:])
+                    continue
+                pair_dict.setdefault((len(upstream_departure_list), len(downstream_arrival_list)), []).append(
+                    (movement_curve, origin_movement_id, compiled_network.get_row(origin_movement_id),
+                     downstream_arrival_list, cache_key, fingerprint))
+
+        for (upstream_dimension, dimension), pair_list in pair_dict.items():
+            block_size = _get_calibration_block_size(dimension)
+            for block_start in range(0, len(pair_list), block_size):
+                block_list = pair_list[block_start: block_start + block_size]
+                upstream_array = departure_array[[val[2] for val in block_list], :upstream_dimension]
+                downstream_array = np.array([val[3] for val in block_list], dtype=float)
+                diverge_array = np.sum(downstream_array, axis=1) / \
+                    np.maximum(np.sum(upstream_array, axis=1), 0.1)
+                diverge_array = np.minimum(np.maximum(diverge_array, 0), 1)
+                shift_array, error_array = get_optimal_shift_batch(downstream_array,
+                                                                   upstream_array * diverge_array[:, None])
+                for (movement_curve, origin_movement_id, _, _, cache_key, fingerprint), \
+                        diverge_proportion, optimal_shift, error in \
+                        zip(block_list, diverge_array, shift_array, error_array):
+                    result = (float(diverge_proportion), int(optimal_shift), float(error))
+                    _set_origin_calibration(movement_curve, origin_movement_id, *result)
+                    calibration_cache[cache_key] = (fingerprint,) + result
+    return net_dict
+
+
+def _get_calibration_block_size(dimension):
+    """
+    Number of pairs of a block within CALIBRATION_BLOCK_BYTES (at least one)
+    """
+    pair_bytes = CALIBRATION_TEMPORARY_ARRAYS * max(dimension - 1, 1) * dimension * np.dtype(float).itemsize
+    return max(CALIBRATION_BLOCK_BYTES // pair_bytes, 1)
+
+
+def _get_calibration_fingerprint(movement_curve, upstream_movement_curve,
+                                 upstream_departure_list, downstream_arrival_list):
+    fingerprint = blake2b(digest_size=16)
+    fingerprint.update(repr((movement_curve.penetration_rate, upstream_movement_curve.penetration_rate)).encode())
+    fingerprint.update(np.asarray(upstream_departure_list, dtype=float).tobytes())
+    fingerprint.update(b"|")
+    fingerprint.update(np.asarray(downstream_arrival_list, dtype=float).tobytes())
+    return fingerprint.digest()
+
+
+def _set_origin_calibration(movement_curve, origin_movement_id, diverge_proportion, optimal_shift, error):
+    movement_curve.origin_diverge_dict[origin_movement_id] = diverge_proportion
+    movement_curve.origin_shift_dict[origin_movement_id] = optimal_shift
+    movement_curve.origin_error_dict[origin_movement_id] = error
+
+
 def movement_arrival_calibration(net_dict, movement_curve, debug_mode=False,
                                  use_prob=True, upstream_predict=False,
                                  output_path=None):
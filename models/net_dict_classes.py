@@ -1,7 +1,11 @@
 import numpy as np
-import pandas as pd
 
+from models.aggregation import aggregate_net_dicts
+from models.compiled_network import CompiledNetwork
+from models.id_registry import IdRegistry
 from models.movement_tod_classes import MovementTOD
+from models.snapshot import NetworkSnapshot, trial_context
+from models.fine_hist import compact_movement, DEFAULT_FINE_RESOLUTION
 
 
 class MovementNetDict(object):
@@ -14,6 +18,14 @@ class MovementNetDict(object):
         self.departure_repeats = None
         self.date_list = []
         self.tod_dict = {}
+        self.tod_index = {}         # key: tod_name, val: {movement_id: movement_tod_curve}
+        self.junction_index = {}    # key: tod_name, val: {junction_id: {movement_id: movement_tod_curve}}
+        self.nema_index = {}        # key: tod_name, val: {junction_id: {movement_index: movement_tod_curve}}
+        # dense integer ids, including the upstream & conflicting movements outside of the dict
+        self.movement_registry = IdRegistry()
+        # arrival calibration results, key: (movement_id, tod_name, origin_id),
+        #   val: (fingerprint of the inputs, diverge proportion, shift, error), see models.net_calibration
+        self.calibration_cache = {}
 
     def add_movement_tod_curve(self, movement_tod_curve):
         """
@@ -26,6 +38,138 @@ class MovementNetDict(object):
         if not (movement_id in self.dict.keys()):
             self.dict[movement_id] = {}
         self.dict[movement_id][tod_name] = movement_tod_curve
+        self._index_movement_tod_curve(movement_tod_curve)
+
+    def _index_movement_tod_curve(self, movement_tod_curve):
+        movement_id = movement_tod_curve.movement_id
+        tod_name = movement_tod_curve.tod_name
+        junction_id = movement_tod_curve.junction_id
+        self.tod_index.setdefault(tod_name, {})[movement_id] = movement_tod_curve
+        self.junction_index.setdefault(tod_name, {}).setdefault(junction_id, {})[movement_id] = movement_tod_curve
+        if movement_tod_curve.movement_index is not None:
+            self.nema_index.setdefault(tod_name, {}).setdefault(junction_id, {})[
+                movement_tod_curve.movement_index] = movement_tod_curve
+        self.movement_registry.intern(movement_id)
+        for dependency_id in (movement_tod_curve.upstream_movement_list or []) + \
+                (movement_tod_curve.conflicting_movement_list or []):
+            self.movement_registry.intern(dependency_id)
+
+    def rebuild_index(self):
+        """
+        Rebuild the secondary indexes, should be called if self.dict is modified directly
+            (or if the junction/movement index of a movement is changed)
+
+        :return:
+        """
+        self.tod_index = {}
+        self.junction_index = {}
+        self.nema_index = {}
+        for movement_dict in self.dict.values():
+            for movement_tod_curve in movement_dict.values():
+                self._index_movement_tod_curve(movement_tod_curve)
+        return self
+
+    def get_tod_movement_dict(self, tod_name):
+        """
+        All the movements of a tod without scanning the network
+
+        :param tod_name:
+        :return: {movement_id: movement_tod_curve}
+        """
+        return self.tod_index.get(tod_name, {})
+
+    def get_dependency_arrays(self, movement_tod_curve):
+        """
+        Unique upstream & conflicting movements as arrays of integer ids (see models.id_registry)
+
+        :param movement_tod_curve:
+        :return: upstream id array, conflicting id array
+        """
+        upstream_list = list(dict.fromkeys(movement_tod_curve.upstream_movement_list or []))
+        conflicting_list = list(dict.fromkeys(movement_tod_curve.conflicting_movement_list or []))
+        return self.movement_registry.intern_array(upstream_list), \
+            self.movement_registry.intern_array(conflicting_list)
+
+    def get_junction_list(self, tod_name):
+        return list(self.junction_index.get(tod_name, {}).keys())
+
+    def get_junction_movement_dict(self, tod_name, junction_id):
+        """
+        All the movements of a junction at a tod
+
+        :param tod_name:
+        :param junction_id:
+        :return: {movement_id: movement_tod_curve}
+        """
+        return self.junction_index.get(tod_name, {}).get(junction_id, {})
+
+    def get_junction_movement(self, tod_name, junction_id, movement_index):
+        """
+        Movement of a junction by its NEMA index
+
+        :param tod_name:
+        :param junction_id:
+        :param movement_index: NEMA movement index
+        :return: movement_tod_curve, None if not existing
+        """
+        return self.nema_index.get(tod_name, {}).get(junction_id, {}).get(movement_index)
+
+    def select_tod(self, tod_name, movement_id_list=None):
+        """
+        A new network with only the movements of a tod, the movement curves & the calibration cache are not copied
+
+        :param tod_name:
+        :param movement_id_list: only these movements of the tod (e.g., a connected component), all if None
+        :return:
+        """
+        new_cls = MovementNetDict()
+        new_cls.resolution = self.resolution
+        new_cls.departure_repeats = self.departure_repeats
+        new_cls.date_list = self.date_list
+        new_cls.tod_dict = self.tod_dict
+        # keyed by movement & tod, shared with the parent network
+        new_cls.calibration_cache = self.calibration_cache
+        movement_dict = self.get_tod_movement_dict(tod_name)
+        if movement_id_list is None:
+            movement_id_list = list(movement_dict.keys())
+        for movement_id in movement_id_list:
+            new_cls.add_movement_tod_curve(movement_dict[movement_id])
+        return new_cls
+
+    def get_connected_components(self, tod_name):
+        """
+        Weakly connected components of the movements of a tod through the upstream & conflicting movements,
+            the components do not interact in the prediction
+
+        :param tod_name:
+        :return: list of movement id lists (order of the tod), from the largest component
+        """
+        movement_dict = self.get_tod_movement_dict(tod_name)
+        movement_key_array = self.movement_registry.intern_array(list(movement_dict.keys()))
+        dependency_list = [self.get_dependency_arrays(movement_curve) for movement_curve in movement_dict.values()]
+        # union-find over the integer ids (sized after all the dependencies are interned),
+        #   the dependencies outside the tod are ignored
+        parent_array = np.arange(len(self.movement_registry))
+        in_tod_array = np.zeros(len(self.movement_registry), dtype=bool)
+        in_tod_array[movement_key_array] = True
+
+        def _find(key):
+            while parent_array[key] != key:
+                parent_array[key] = parent_array[parent_array[key]]
+                key = parent_array[key]
+            return key
+
+        for movement_key, dependency_arrays in zip(movement_key_array, dependency_list):
+            for dependency_array in dependency_arrays:
+                for dependency_key in dependency_array[in_tod_array[dependency_array]]:
+                    root_key, dependency_root_key = _find(movement_key), _find(dependency_key)
+                    if root_key != dependency_root_key:
+                        parent_array[max(root_key, dependency_root_key)] = min(root_key, dependency_root_key)
+
+        component_dict = {}
+        for movement_id, movement_key in zip(movement_dict.keys(), movement_key_array):
+            component_dict.setdefault(_find(movement_key), []).append(movement_id)
+        return sorted(component_dict.values(), key=lambda val: -len(val))
 
     def get_movement_tod_curve(self, movement_id, tod_name):
         if not (movement_id in self.dict.keys()):
@@ -52,6 +196,9 @@ class MovementNetDict(object):
         :param tod_list:
         :return:
         """
+        # pandas is only needed here, do not import it with the prediction core
+        import pandas as pd
+
         essential_attributes = ["movement_id", "tod_name"]
         all_attributes = essential_attributes + attributes
         overall_dict = {}
@@ -79,6 +226,59 @@ class MovementNetDict(object):
                 self.add_movement_tod_curve(movement_curve)
         return self
 
+    def snapshot(self, tod_name=None):
+        """
+        Record the prediction state of the movements (see models.snapshot)
+
+        :param tod_name: all the tods if None
+        :return: NetworkSnapshot
+        """
+        return NetworkSnapshot(self, tod_name)
+
+    def rollback(self, snapshot):
+        """
+        Restore a snapshot, it can be restored again afterwards
+
+        :param snapshot: NetworkSnapshot
+        :return:
+        """
+        return snapshot.restore(self)
+
+    def trial(self, tod_name=None, movement_id_list=None):
+        """
+        Context manager rolling back the network at the end of the block, e.g.,
+            with net_dict.trial(tod_name):
+                update_network_prediction(net_dict, tod_name, offset_dict=candidate_offset_dict)
+
+        :param tod_name:
+        :param movement_id_list: only these movements of the tod are rolled back, all the movements if None
+        :return:
+        """
+        return trial_context(self, tod_name, movement_id_list)
+
+    def compact(self, fine_resolution=DEFAULT_FINE_RESOLUTION):
+        """
+        Histogram-only mode, replace the raw trajectory times by fine histograms (see models.fine_hist)
+
+        :param fine_resolution: (s)
+        :return:
+        """
+        for movement_dict in self.dict.values():
+            for movement_tod_curve in movement_dict.values():
+                compact_movement(movement_tod_curve, fine_resolution)
+        return self
+
+    def compile(self, tod_name, field_list=None):
+        """
+        Padded array form of the curves of a tod (see models.compiled_network), call .sync() on the
+            result to write the modifications back to the movements
+
+        :param tod_name:
+        :param field_list: curve fields, all of them if None
+        :return: CompiledNetwork
+        """
+        return CompiledNetwork(self, tod_name, field_list=field_list)
+
     def update_movement(self, other):
         """
         update movement
@@ -87,6 +287,7 @@ class MovementNetDict(object):
         :return:
         """
         self.dict.update(other.dict)
+        self.rebuild_index()
         return self
 
     def aggregate(self, other):
@@ -96,90 +297,52 @@ class MovementNetDict(object):
         :param other: the same dict with different dates
         :return:
         """
-        new_cls = MovementNetDict()
-        new_cls.date_list = self.date_list + other.date_list
-        if self.resolution != other.resolution:
-            raise ValueError(f"Two dict should have the same resolution:"
-                             f" {self.date_list} with {self.resolution} and"
-                             f" {other.date_list} with {other.resolution}")
-        new_cls.resolution = self.resolution
-        new_cls.departure_repeats = self.departure_repeats
-        new_cls.tod_dict = self.tod_dict
-        for movement_id, movement_tod_dict in self.dict.items():
-            for tod_id in movement_tod_dict.keys():
-                local_curve = self.get_movement_tod_curve(movement_id, tod_id)
-                other_curve = other.get_movement_tod_curve(movement_id, tod_id)
-                new_curve = local_curve + other_curve
-                new_cls.add_movement_tod_curve(new_curve)
-        return new_cls
+        return MovementNetDict.aggregate_many([self, other])
+
+    @staticmethod
+    def aggregate_many(net_dict_list, workers=None):
+        """
+        Aggregate the dicts of many dates at once (see models.aggregation), e.g., a monthly calibration set
+
+        :param net_dict_list: list of MovementNetDict with different dates, not modified
+        :param workers: number of worker processes for the tree reduction, serial if None
+        :return: new MovementNetDict
+        """
+        return aggregate_net_dicts(net_dict_list, workers=workers)
 
     def merge_minor_origins(self, movement_curve, min_prop=0.05):
         """
         Merge the uncoordinated origins into others
-        apply to all the curves including curve list, prob list and predicted list (if existing)
+        apply to all the origin arrays including curve, prob and predict (if existing)
 
         :param movement_curve:
         :param min_prop:
         :return:
         """
         tod_name = movement_curve.tod_name
-        total_trajs = movement_curve.total_trajs
-
-        uncoord_array = None
-        uncoord_predict_array = None
-        uncoord_prob_array = None
-        new_origin_dict = {}
-        new_origin_prob_dict = {}
-        new_origin_predict_dict = {}
-        for origin_movement_id in movement_curve.arrival_curve.origin_curve_dict.keys():
-            curve_list = movement_curve.arrival_curve.origin_curve_dict[origin_movement_id]
-            origin_trajs = sum(curve_list)
-            origin_proportion = origin_trajs / total_trajs
-            upstream_movement_curve = self.get_movement_tod_curve(origin_movement_id, tod_name)
-            if (upstream_movement_curve is None) or (origin_proportion <= min_prop):
-                if uncoord_array is None:
-                    uncoord_array = np.array(curve_list)
-                else:
-                    uncoord_array += np.array(curve_list)
-
-                if origin_movement_id in movement_curve.arrival_curve.origin_prob_dict.keys():
-                    local_array = np.array(movement_curve.arrival_curve.origin_prob_dict[origin_movement_id])
-                    if uncoord_prob_array is None:
-                        uncoord_prob_array = local_array
-                    else:
-                        uncoord_prob_array += local_array
-
-                if origin_movement_id in movement_curve.arrival_curve.origin_predict_dict.keys():
-                    local_array = np.array(movement_curve.arrival_curve.origin_predict_dict[origin_movement_id])
-                    if uncoord_predict_array is None:
-                        uncoord_predict_array = local_array
-                    else:
-                        uncoord_predict_array += local_array
-            else:
-                new_origin_dict[origin_movement_id] = curve_list
-                if origin_movement_id in movement_curve.arrival_curve.origin_prob_dict.keys():
-                    new_origin_prob_dict[origin_movement_id] = \
-                        movement_curve.arrival_curve.origin_prob_dict[origin_movement_id]
-                if origin_movement_id in movement_curve.arrival_curve.origin_predict_dict.keys():
-                    new_origin_predict_dict[origin_movement_id] = \
-                        movement_curve.arrival_curve.origin_predict_dict[origin_movement_id]
-
-        if uncoord_prob_array is not None:
-            new_origin_prob_dict['null'] = uncoord_prob_array.tolist()
-        if uncoord_array is not None:
-            new_origin_dict['null'] = uncoord_array.tolist()
-        if uncoord_predict_array is not None:
-            new_origin_predict_dict['null'] = uncoord_predict_array.tolist()
-
-        movement_curve.arrival_curve.origin_curve_dict = new_origin_dict
-        new_movement_list = []
-        for movement_id in new_origin_dict.keys():
-            if movement_id == "null":
-                continue
-            new_movement_list.append(movement_id)
-        movement_curve.upstream_movement_list = new_movement_list
-        movement_curve.arrival_curve.origin_predict_dict = new_origin_predict_dict
-        movement_curve.arrival_curve.origin_prob_dict = new_origin_prob_dict
+        arrival_curve = movement_curve.arrival_curve
+
+        origin_id_list, curve_array = arrival_curve.get_origin_array(curve_type="curve")
+        if curve_array is None:
+            movement_curve.upstream_movement_list = []
+            arrival_curve.set_origin_array([], None, "prob")
+            arrival_curve.set_origin_array([], None, "predict")
+            return
+        # one row per origin: uncoordinated if there is no upstream curve or the share is too small
+        origin_proportion_array = np.sum(curve_array, axis=1) / movement_curve.total_trajs
+        minor_mask = np.array([self.get_movement_tod_curve(origin_id, tod_name) is None
+                               for origin_id in origin_id_list]) | (origin_proportion_array <= min_prop)
+        major_list = [origin_id for origin_id, is_minor in zip(origin_id_list, minor_mask) if not is_minor]
+        minor_list = [origin_id for origin_id, is_minor in zip(origin_id_list, minor_mask) if is_minor]
+        movement_curve.upstream_movement_list = [origin_id for origin_id in major_list if origin_id != "null"]
+
+        # already merged (only the "null" origin at the end is uncoordinated), nothing to rebuild
+        if len(minor_list) == 0 or (minor_list == ["null"] and origin_id_list[-1] == "null"):
+            return
+
+        for curve_type in ["curve", "prob", "predict"]:
+            arrival_curve.set_origin_array(*_merge_origin_rows(*arrival_curve.get_origin_array(curve_type=curve_type),
+                                                               major_list, minor_list), curve_type)
 
     def check_network_topology(self):
         """
@@ -204,4 +367,25 @@ class MovementNetDict(object):
                     movement_curve.conflicting_movement_list = new_conflicting_movement_list
 
     def __add__(self, other):
-        return self.aggregate(other)
\ No newline at end of file
+        return self.aggregate(other)
+
+
+def _merge_origin_rows(origin_id_list, origin_array, major_list, minor_list):
+    """
+    :param origin_id_list: origin of each row of the origin array
+    :param origin_array: 2-D array (origin x time bins), None if there is no origin
+    :param major_list: origins kept
+    :param minor_list: origins merged into "null"
+    :return: new origin id list, new origin array (the major rows & the sum of the minor rows as "null")
+    """
+    if origin_array is None:
+        return [], None
+    row_dict = {origin_id: row for row, origin_id in enumerate(origin_id_list)}
+    major_row_list = [row_dict[origin_id] for origin_id in major_list if origin_id in row_dict.keys()]
+    minor_row_list = [row_dict[origin_id] for origin_id in minor_list if origin_id in row_dict.keys()]
+    new_origin_id_list = [origin_id_list[row] for row in major_row_list]
+    new_origin_array = origin_array[major_row_list]
+    if len(minor_row_list) > 0:
+        new_origin_id_list.append("null")
+        new_origin_array = np.vstack([new_origin_array, np.sum(origin_array[minor_row_list], axis=0)])
+    return new_origin_id_list, new_origin_array
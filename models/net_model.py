@@ -2,12 +2,18 @@
 This file is for the overall prediction of a network
 """
 from __future__ import annotations
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from time import time
 import numpy as np
 from models.movement_model import update_movement_model
 from models.net_calibration import arrival_curve_calibration
 from models.curve_utils import shift_list_by_val, agg_curves, lane_and_sat_depart_adjustment
 from models.metrics import get_movement_calibration_diff
+from models.fidelity import get_active_fidelity
+from models.profiling import PredictionProfiler, get_active_profiler, profile_stage, STAGE_PENETRATION, \
+    STAGE_ARRIVAL_PREDICTION, STAGE_PERMISSIVE_CAPACITY, STAGE_METRICS
 
 from typing import TYPE_CHECKING
 
@@ -29,6 +35,10 @@ def update_network_prediction(curve_dict: MovementNetDict,
                               max_super_iterations=5,
                               super_stopping_criteria=1e-8,
                               retry_with_loop=True,
+                              worklist_tolerance=None,
+                              changed_movement_list=None,
+                              profiler: PredictionProfiler | None = None,
+                              stats_dict: dict | None = None,
                               disp=False):
     """
     Update the overall prediction results.
@@ -48,27 +58,52 @@ def update_network_prediction(curve_dict: MovementNetDict,
     :param max_super_iterations:
     :param super_stopping_criteria:
     :param retry_with_loop
+    :param worklist_tolerance: if set, from the second super iteration on, a movement is only re-predicted
+        when the departure prediction of one of its upstream or conflicting movements changed by more than
+        this value (max absolute difference of the probability) since the movement was last predicted
+    :param changed_movement_list: warm start (requires worklist_tolerance), the network holds a prediction and
+        only these movements have new inputs, the worklist of the first super iteration starts from them
+    :param profiler: if provided, the wall time & calls of each stage of each movement are recorded
+    :param stats_dict: if provided, filled with the number of "super_iterations" & whether the prediction
+        "converged" (super stopping criteria reached)
     :param disp: display the information
     :return: overall calibration difference (predicted stop/delay minus ground truth)
     """
+    if (profiler is not None) and (get_active_profiler() is not profiler):
+        with profiler.activate():
+            return update_network_prediction(curve_dict, tod_name, offset_dict=offset_dict,
+                                             green_dict=green_dict, cycle_dict=cycle_dict,
+                                             global_cycle=global_cycle, global_p=global_p, p_dict=p_dict,
+                                             through_cost_only=through_cost_only,
+                                             dependency_loop=dependency_loop,
+                                             use_predicted_arrival=use_predicted_arrival,
+                                             max_super_iterations=max_super_iterations,
+                                             super_stopping_criteria=super_stopping_criteria,
+                                             retry_with_loop=retry_with_loop,
+                                             worklist_tolerance=worklist_tolerance,
+                                             changed_movement_list=changed_movement_list,
+                                             profiler=profiler, stats_dict=stats_dict, disp=disp)
     start_time = time()
     # If the dependency loop is already set as True, no need to retry
     sup_separate = "=" * 100
     separate = "~" * 100
     sub_separate = "-" * 100
 
-    overall_movements_number = len(curve_dict.dict.keys())
     if disp:
         print(sup_separate)
         print("Overall network prediction program start...")
-        print(f"Overall number of movements: {overall_movements_number}")
+        print(f"Overall number of movements: {len(curve_dict.dict)}")
         print(f"Through cost only: {through_cost_only}")
         print(f"Dependency loop mode: {dependency_loop}")
+        print(f"Worklist tolerance: {worklist_tolerance}")
         if not dependency_loop:
             print(f"Retry if there is a dependency loop: {retry_with_loop}")
 
     if dependency_loop:
         retry_with_loop = False
+    fidelity_super_iterations = get_active_fidelity().max_super_iterations
+    if fidelity_super_iterations is not None:
+        max_super_iterations = min(max_super_iterations, fidelity_super_iterations)
 
     if offset_dict is None:
         offset_dict = {}
@@ -77,6 +112,8 @@ def update_network_prediction(curve_dict: MovementNetDict,
     if cycle_dict is None:
         cycle_dict = {}
 
+    # re-bin the curves with the new cycle lengths first, the arrival calibration fits the new bins
+    _apply_cycle_lengths(curve_dict, tod_name, cycle_dict, global_cycle)
     # Set the penetration first to scale the prob curve,
     # we need to set the arrival calibration as True
     # since the penetration rate will influence the diverge proportion
@@ -89,143 +126,88 @@ def update_network_prediction(curve_dict: MovementNetDict,
         if disp:
             print(f"Use dependency loop mode, augmented processed movements: {augment_processed_list}")
 
+    scheduler = _DependencyScheduler(curve_dict, tod_name)
+    overall_movements_number = len(scheduler.movement_list)
+    _apply_offsets(curve_dict, tod_name, offset_dict)
+    warm_start = (worklist_tolerance is not None) and (changed_movement_list is not None)
+    if warm_start:
+        scheduler.seed(curve_dict, tod_name, changed_movement_list)
+
     total_calibration_diff = 0
     prv_movement_metric_dict = {}
+    super_iterations = 0
+    converged = False
 
     for super_iter in range(max_super_iterations):
+        super_iterations = super_iter + 1
         if disp:
             print(separate)
             print(f"Super iteration {super_iter}")
-        processed_movement_list = []  # list for processed movement list
+        scheduler.reset()
         total_calibration_diff = 0
-        remaining_movements = len(curve_dict.dict)
         movement_metric_dict = {}
-        use_prv_conflicting = False
-        unprocessed_movement_dict = {}
+        # only the movements with changed inputs are re-predicted in the later super iterations
+        worklist_mode = (worklist_tolerance is not None) and (super_iter > 0 or warm_start)
 
         for _ in range(overall_movements_number):
-            unprocessed_movement_dict = {}
-            remaining_movements = 0
+            # process every movement whose dependencies are all predicted in this super iteration
             processed_this_round = []
-            for movement_id, movement_curve_dict in curve_dict.dict.items():
-                if movement_id in processed_movement_list:
+            while scheduler.ready_queue:
+                movement_key = scheduler.ready_queue.popleft()
+                if scheduler.is_processed(movement_key):
                     continue
-                remaining_movements += 1
-                for local_tod, movement_curve in movement_curve_dict.items():
-                    if local_tod != tod_name:
-                        continue
-
-                    upstream_movement_list = movement_curve.upstream_movement_list
-                    conflicting_movement_list = movement_curve.conflicting_movement_list
-                    upstream_ready = _isin(upstream_movement_list, processed_movement_list)
-                    conflicting_ready = _isin(conflicting_movement_list, processed_movement_list)
-                    conflicting_augment_ready = _isin(conflicting_movement_list,
-                                                      processed_movement_list + augment_processed_list)
-                    if movement_curve.movement_index % 2 == 1:
-                        upstream_augment_ready = _isin(upstream_movement_list,
-                                                       processed_movement_list + augment_processed_list)
-                    else:
-                        upstream_augment_ready = upstream_ready
-
-                    if use_prv_conflicting:
-                        _proceed_to_calculate = (upstream_augment_ready and conflicting_augment_ready)
-                    else:
-                        _proceed_to_calculate = (upstream_ready and conflicting_ready)
-                    if not _proceed_to_calculate:
-                        unprocessed_movement_dict[movement_id] = {}
-                        if not upstream_ready:
-                            unprocessed_movement_dict[movement_id]["upstream"] = upstream_movement_list
-                        if not conflicting_ready:
-                            unprocessed_movement_dict[movement_id]["conflicting"] = conflicting_movement_list
-                    else:
-                        if movement_curve.junction_id in offset_dict.keys():
-                            movement_curve.additional_offset = offset_dict[movement_curve.junction_id]
-
-                        new_cycle_length = global_cycle
-                        if movement_curve.junction_id in cycle_dict.keys():
-                            new_cycle_length = cycle_dict[movement_curve.junction_id]
-
-                        new_green_info = None
-                        if movement_id in green_dict.keys():
-                            new_green_info = green_dict[movement_id]
-
-                        # get the arrival from the upstream
-                        # todo we need to be able to adjust cycle length here
-                        # todo have to be careful about cycle lengths from upstream (TODs from upstream)
-                        if use_predicted_arrival:
-                            _movement_arrival_prediction(curve_dict, movement_curve, from_upstream=True,
-                                                         from_upstream_prediction=True)
-                        # get the permissive capacity from the conflicted movements
-                        _update_movement_permissive_capacity_list(curve_dict, movement_curve,
-                                                                  use_prediction=True,
-                                                                  debug=False)
-
-                        # departure prediction
-                        update_movement_model(movement_curve, green_time=new_green_info,
-                                              cycle_length=new_cycle_length,
-                                              use_predicted_arrival=use_predicted_arrival)
-                        processed_movement_list.append(movement_id)
-                        processed_this_round.append(movement_id)
-
-                        if through_cost_only:
-                            if not (movement_curve.movement_index in [2, 4, 6, 8]):
-                                continue
-                        # local_calibration_diff = movement_curve.get_calibration_diff() * movement_curve.hourly_volume
-                        local_calibration_diff = get_movement_calibration_diff(movement_curve) * \
-                                                 movement_curve.total_trajs
-                        local_calibration_diff /= 3600  # convert second to hour
-
-                        local_delay_metric = movement_curve.predicted_delay + \
-                                             movement_curve.predicted_stop_ratio * 30
-                        local_delay_metric *= movement_curve.total_trajs
-                        movement_metric_dict[movement_id] = local_delay_metric
-
-                        # attention: here is how we set the objective function
-                        if local_calibration_diff >= 0:
-                            total_calibration_diff += local_calibration_diff * local_calibration_diff
-                        else:
-                            # a higher penalty is set here
-                            total_calibration_diff += local_calibration_diff * local_calibration_diff * 4
-
-            use_prv_conflicting = False
-            if remaining_movements == 0:
+                processed_this_round.append(scheduler.get_movement_id(movement_key))
+                total_calibration_diff += _process_movement(curve_dict, tod_name, movement_key, scheduler,
+                                                            movement_metric_dict, green_dict,
+                                                            cycle_dict, global_cycle, through_cost_only,
+                                                            use_predicted_arrival, worklist_mode,
+                                                            worklist_tolerance)
+            if scheduler.remaining_number() == 0 or (not dependency_loop):
                 break
 
-            if len(processed_this_round) == 0:
-                if dependency_loop:
-                    if not use_prv_conflicting:
-                        if disp:
-                            print('[WARNING] remaining movements not reduced, use the'
-                                  ' previous conflicting prediction to proceed...')
-                        use_prv_conflicting = True
-                    else:
-                        print('[ERROR] remaining movements not reduced, there is a dead loop '
-                              'in the movement dependency...')
-                        break
-                else:
-                    break
-                # else:
-                if disp:
-                    print(sub_separate)
-                    print(f"Sub iteration number {_}")
-                    print(f"Processed movements this round: {processed_this_round}")
-                    processed_number = len(processed_movement_list)
-                    print(f"Overall processed movements {processed_number}, "
-                          f"unprocessed movements {overall_movements_number - processed_number}")
-                    print(f"Use conflicting info from previous iteration {use_prv_conflicting}")
+            if disp:
+                print('[WARNING] remaining movements not reduced, use the'
+                      ' previous conflicting prediction to proceed...')
+            # dependency loop: proceed with the conflicting (and left-turn upstream) prediction
+            #   of the previous iteration, following the original movement order
+            augment_processed_number = 0
+            for movement_id, movement_key in zip(scheduler.movement_list, scheduler.movement_key_list):
+                if scheduler.is_processed(movement_key):
+                    continue
+                if not scheduler.is_augment_ready(movement_key):
+                    continue
+                augment_processed_number += 1
+                processed_this_round.append(movement_id)
+                total_calibration_diff += _process_movement(curve_dict, tod_name, movement_key, scheduler,
+                                                            movement_metric_dict, green_dict,
+                                                            cycle_dict, global_cycle, through_cost_only,
+                                                            use_predicted_arrival, worklist_mode,
+                                                            worklist_tolerance)
+            if disp:
+                print(sub_separate)
+                print(f"Sub iteration number {_}")
+                print(f"Processed movements this round: {processed_this_round}")
+                processed_number = len(scheduler.processed_list)
+                print(f"Overall processed movements {processed_number}, "
+                      f"unprocessed movements {overall_movements_number - processed_number}")
+            if augment_processed_number == 0:
+                print('[ERROR] remaining movements not reduced, there is a dead loop '
+                      'in the movement dependency...')
+                break
 
+        remaining_movements = scheduler.remaining_number()
         if remaining_movements > 0:
             if (not retry_with_loop) and dependency_loop:
                 print(separate)
                 print("Network update error report")
 
-                print(f"Processed {len(processed_movement_list)} v.s. "
-                      f"unprocessed {overall_movements_number - len(processed_movement_list)}")
+                print(f"Processed {len(scheduler.processed_list)} v.s. "
+                      f"unprocessed {remaining_movements}")
                 print(f"Augment processed movements:", augment_processed_list)
-                print("Processed movements:", processed_movement_list)
+                print("Processed movements:", scheduler.processed_list)
                 print("Unprocessed movements and the their dependencies:")
                 sscount = 0
-                for k, v in unprocessed_movement_dict.items():
+                for k, v in scheduler.get_unprocessed_dependencies().items():
                     print(f"Movement {sscount}: {k}, dependencies: {v}")
                     sscount += 1
 
@@ -244,21 +226,29 @@ def update_network_prediction(curve_dict: MovementNetDict,
                                           p_dict=p_dict,
                                           through_cost_only=through_cost_only,
                                           dependency_loop=True,
+                                          worklist_tolerance=worklist_tolerance,
                                           disp=disp)
 
         metric_diff_ratio = _get_cali_diff(metric_dict1=prv_movement_metric_dict,
                                            metric_dict2=movement_metric_dict,
                                            disp=disp)
         if disp:
+            if worklist_mode:
+                print(f"Re-predicted movements: {scheduler.predicted_number} / {overall_movements_number}")
             print(f"End of super iteration {super_iter}")
             print(separate)
 
         if metric_diff_ratio <= super_stopping_criteria:
             if disp:
                 print("Terminated super iteration in advance.")
+            converged = True
             break
         prv_movement_metric_dict = movement_metric_dict
 
+    if stats_dict is not None:
+        stats_dict["super_iterations"] = super_iterations
+        stats_dict["converged"] = converged
+
     if disp:
         print(f"Overall running time: {np.round(time() - start_time, 3)} secs")
         print("End of the overall network prediction")
@@ -266,6 +256,386 @@ def update_network_prediction(curve_dict: MovementNetDict,
     return total_calibration_diff
 
 
+def update_network_prediction_all_tods(curve_dict: MovementNetDict,
+                                       tods: list | None = None,
+                                       workers: int | None = None,
+                                       tod_kwargs: dict | None = None,
+                                       **kwargs):
+    """
+    Update the prediction of several tods (AM, MD, PM, ...). Different tods are independent problems,
+        they are solved concurrently in separate processes and the results are merged back to curve_dict
+
+    :param curve_dict:
+    :param tods: list of tod names, all the tods of the network if None
+    :param workers: number of processes, default: number of tods bounded by the cpu count,
+        the tods are solved one by one in the current process if workers <= 1
+    :param tod_kwargs: {tod_name: {argument: value}}, tod-specific arguments of update_network_prediction
+        (e.g., offset_dict), has higher priority than kwargs
+    :param kwargs: arguments of update_network_prediction shared by all the tods
+    :return: {tod_name: overall calibration difference}
+    """
+    if tods is None:
+        tods = list(curve_dict.tod_index.keys())
+    if tod_kwargs is None:
+        tod_kwargs = {}
+    if workers is None:
+        workers = min(len(tods), os.cpu_count() or 1)
+
+    task_list = []
+    for tod_name in tods:
+        local_kwargs = dict(kwargs)
+        local_kwargs.update(tod_kwargs.get(tod_name, {}))
+        task_list.append((tod_name, local_kwargs))
+
+    calibration_diff_dict = {}
+    if workers <= 1 or len(task_list) <= 1:
+        for tod_name, local_kwargs in task_list:
+            calibration_diff_dict[tod_name] = update_network_prediction(curve_dict, tod_name, **local_kwargs)
+        return calibration_diff_dict
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        future_list = [executor.submit(_tod_network_prediction, curve_dict.select_tod(tod_name),
+                                       tod_name, local_kwargs)
+                       for tod_name, local_kwargs in task_list]
+        for (_, local_kwargs), future in zip(task_list, future_list):
+            tod_name, calibration_diff, movement_curve_dict, tod_profiler, calibration_cache = future.result()
+            calibration_diff_dict[tod_name] = calibration_diff
+            if tod_profiler is not None:
+                # the profiler may be specific to the tod (tod_kwargs)
+                local_kwargs["profiler"].merge(tod_profiler)
+            # the arrival calibrations of the worker are reused by the next predictions
+            curve_dict.calibration_cache.update(calibration_cache)
+            # merge back in place so that the references to the movement curves remain valid
+            for movement_id, new_movement_curve in movement_curve_dict.items():
+                movement_curve = curve_dict.get_movement_tod_curve(movement_id, tod_name)
+                movement_curve.__dict__.update(new_movement_curve.__dict__)
+    return calibration_diff_dict
+
+
+def _tod_network_prediction(tod_curve_dict, tod_name, kwargs):
+    """
+    Worker of update_network_prediction_all_tods, solve one tod in a separate process
+
+    :return: tod name, overall calibration difference, the updated movement curves, the profiler (if any)
+        & the calibration cache
+    """
+    if kwargs.get("profiler") is not None:
+        # the records are merged by the parent process, start from an empty profiler
+        kwargs["profiler"] = PredictionProfiler()
+    calibration_diff = update_network_prediction(tod_curve_dict, tod_name, **kwargs)
+    return tod_name, calibration_diff, tod_curve_dict.get_tod_movement_dict(tod_name), kwargs.get("profiler"), \
+        tod_curve_dict.calibration_cache
+
+
+class _DependencyScheduler(object):
+    """
+    Kahn-style bookkeeping of the movement dependencies of one TOD
+
+    Each movement keeps the number of upstream & conflicting movements not processed yet,
+    once a movement is processed, the counters of its dependents are decreased and
+    the movements without remaining dependencies are pushed to the ready queue.
+    The movements are identified by the dense integer ids of the movement registry of the dict,
+    the string ids are only used at the edges (ready queue output & reports).
+    """
+    def __init__(self, curve_dict, tod_name):
+        self.registry = curve_dict.movement_registry
+        self.movement_list = []           # movements of the tod, following the order of the dict
+        self.movement_key_list = []       # integer ids of movement_list
+        upstream_array_dict = {}
+        conflicting_array_dict = {}
+        for movement_id, movement_curve in curve_dict.get_tod_movement_dict(tod_name).items():
+            movement_key = self.registry.intern(movement_id)
+            self.movement_list.append(movement_id)
+            self.movement_key_list.append(movement_key)
+            upstream_array_dict[movement_key], conflicting_array_dict[movement_key] = \
+                curve_dict.get_dependency_arrays(movement_curve)
+
+        # lists indexed by the integer id, sized after all the dependencies are interned
+        registry_size = len(self.registry)
+        self.is_left_turn_list = [False] * registry_size
+        self.upstream_list = [[] for _ in range(registry_size)]      # unique upstream movements
+        self.conflicting_list = [[] for _ in range(registry_size)]   # unique conflicting movements
+        self.dependent_list = [[] for _ in range(registry_size)]     # [(dependent id, is_upstream), ...]
+        # number of dependencies that are not movements of this tod, they will never be processed
+        self.upstream_outside_list = [0] * registry_size
+        self.conflicting_outside_list = [0] * registry_size
+        in_tod_list = [False] * registry_size
+        for movement_key in self.movement_key_list:
+            in_tod_list[movement_key] = True
+        for movement_id, movement_key in zip(self.movement_list, self.movement_key_list):
+            movement_index = curve_dict.dict[movement_id][tod_name].movement_index
+            self.is_left_turn_list[movement_key] = movement_index is not None and movement_index % 2 == 1
+            self.upstream_list[movement_key] = upstream_array_dict[movement_key].tolist()
+            self.conflicting_list[movement_key] = conflicting_array_dict[movement_key].tolist()
+            for dependency_key in self.upstream_list[movement_key]:
+                self.dependent_list[dependency_key].append((movement_key, True))
+                self.upstream_outside_list[movement_key] += int(not in_tod_list[dependency_key])
+            for dependency_key in self.conflicting_list[movement_key]:
+                self.dependent_list[dependency_key].append((movement_key, False))
+                self.conflicting_outside_list[movement_key] += int(not in_tod_list[dependency_key])
+
+        self.processed_list = []
+        self.processed_flag_list = [False] * registry_size
+        self.upstream_remaining = [0] * registry_size
+        self.conflicting_remaining = [0] * registry_size
+        self.ready_queue = deque()
+        self.predicted_number = 0
+
+        # worklist bookkeeping, kept across the super iterations
+        self.step = 0
+        self.predicted_step_list = [None] * registry_size   # step of the last prediction
+        self.modified_step_list = [0] * registry_size       # step of the last significant change
+        self.published_list = [None] * registry_size        # departure prediction of the last change
+        self.reset()
+
+    def reset(self):
+        """
+        Restore the counters at the beginning of a super iteration
+
+        :return:
+        """
+        self.processed_list = []
+        self.processed_flag_list = [False] * len(self.processed_flag_list)
+        for movement_key in self.movement_key_list:
+            self.upstream_remaining[movement_key] = len(self.upstream_list[movement_key])
+            self.conflicting_remaining[movement_key] = len(self.conflicting_list[movement_key])
+        self.ready_queue = deque([movement_key for movement_key in self.movement_key_list
+                                  if self.is_ready(movement_key)])
+        self.predicted_number = 0
+
+    def seed(self, curve_dict, tod_name, changed_movement_list):
+        """
+        Warm start of the worklist, the current predictions are recorded as if predicted before the first
+            super iteration, except the ones of the changed movements
+
+        :param curve_dict:
+        :param tod_name:
+        :param changed_movement_list:
+        :return:
+        """
+        changed_movement_set = set(changed_movement_list)
+        for movement_id, movement_key in zip(self.movement_list, self.movement_key_list):
+            predict_list = curve_dict.dict[movement_id][tod_name].departure_curve.predict_list
+            if predict_list is None:
+                continue
+            self.published_list[movement_key] = np.array(predict_list, dtype=float)
+            if not (movement_id in changed_movement_set):
+                self.predicted_step_list[movement_key] = self.step
+
+    def get_movement_id(self, movement_key):
+        return self.registry.get_name(movement_key)
+
+    def get_movement_key(self, movement_id):
+        return self.registry.get_id(movement_id)
+
+    def is_processed(self, movement_key):
+        return self.processed_flag_list[movement_key]
+
+    def is_outdated(self, movement_key):
+        """
+        Whether any upstream or conflicting movement changed after the last prediction of this movement
+
+        :param movement_key:
+        :return:
+        """
+        predicted_step = self.predicted_step_list[movement_key]
+        if predicted_step is None:
+            return True
+        for dependency_key in self.upstream_list[movement_key]:
+            if self.modified_step_list[dependency_key] > predicted_step:
+                return True
+        for dependency_key in self.conflicting_list[movement_key]:
+            if self.modified_step_list[dependency_key] > predicted_step:
+                return True
+        return False
+
+    def record_prediction(self, movement_key, predict_list, tolerance=None):
+        """
+        Record a new departure prediction, the change is measured against the last recorded significant change
+            so that small drifts accumulate instead of being dropped
+
+        :param movement_key:
+        :param predict_list:
+        :param tolerance:
+        :return:
+        """
+        self.step += 1
+        self.predicted_number += 1
+        self.predicted_step_list[movement_key] = self.step
+        if tolerance is None:
+            return
+        predict_array = np.array(predict_list if predict_list is not None else [], dtype=float)
+        published_array = self.published_list[movement_key]
+        if published_array is not None and published_array.shape == predict_array.shape:
+            if predict_array.size == 0 or np.max(np.abs(predict_array - published_array)) <= tolerance:
+                return
+        self.published_list[movement_key] = predict_array
+        self.modified_step_list[movement_key] = self.step
+
+    def is_ready(self, movement_key):
+        return self.upstream_remaining[movement_key] == 0 and self.conflicting_remaining[movement_key] == 0
+
+    def is_augment_ready(self, movement_key):
+        """
+        Readiness when all the movements are augmented by the previous prediction (dependency loop mode),
+            conflicting movements (and upstream movements of the left turn) are then always available
+
+        :param movement_key:
+        :return:
+        """
+        if self.conflicting_outside_list[movement_key] > 0:
+            return False
+        if self.is_left_turn_list[movement_key]:
+            return self.upstream_outside_list[movement_key] == 0
+        return self.upstream_remaining[movement_key] == 0
+
+    def mark_processed(self, movement_key):
+        self.processed_list.append(self.registry.get_name(movement_key))
+        self.processed_flag_list[movement_key] = True
+        for dependent_key, is_upstream in self.dependent_list[movement_key]:
+            if is_upstream:
+                self.upstream_remaining[dependent_key] -= 1
+            else:
+                self.conflicting_remaining[dependent_key] -= 1
+            if self.is_ready(dependent_key) and not self.processed_flag_list[dependent_key]:
+                self.ready_queue.append(dependent_key)
+
+    def remaining_number(self):
+        return len(self.movement_list) - len(self.processed_list)
+
+    def get_unprocessed_dependencies(self):
+        unprocessed_movement_dict = {}
+        for movement_id, movement_key in zip(self.movement_list, self.movement_key_list):
+            if self.processed_flag_list[movement_key]:
+                continue
+            unprocessed_movement_dict[movement_id] = {}
+            if self.upstream_remaining[movement_key] > 0:
+                unprocessed_movement_dict[movement_id]["upstream"] = \
+                    self.registry.get_name_list(self.upstream_list[movement_key])
+            if self.conflicting_remaining[movement_key] > 0:
+                unprocessed_movement_dict[movement_id]["conflicting"] = \
+                    self.registry.get_name_list(self.conflicting_list[movement_key])
+        return unprocessed_movement_dict
+
+
+def _process_movement(curve_dict, tod_name, movement_key, scheduler, movement_metric_dict,
+                      green_dict, cycle_dict, global_cycle,
+                      through_cost_only, use_predicted_arrival,
+                      worklist_mode=False, worklist_tolerance=None):
+    """
+    Predict a single movement & collect its metric,
+        in worklist mode, the prediction is skipped if none of the inputs changed
+
+    :return: contribution of the movement to the overall calibration difference
+    """
+    movement_id = scheduler.get_movement_id(movement_key)
+    movement_curve = curve_dict.dict[movement_id][tod_name]
+    if (not worklist_mode) or scheduler.is_outdated(movement_key):
+        _predict_movement(curve_dict, movement_id, movement_curve, green_dict, cycle_dict,
+                          global_cycle, use_predicted_arrival)
+        scheduler.record_prediction(movement_key, movement_curve.departure_curve.predict_list,
+                                    worklist_tolerance)
+    scheduler.mark_processed(movement_key)
+
+    if through_cost_only:
+        if not (movement_curve.movement_index in [2, 4, 6, 8]):
+            return 0
+    with profile_stage(movement_curve, STAGE_METRICS):
+        return _movement_metric(movement_id, movement_curve, movement_metric_dict)
+
+
+def _movement_metric(movement_id, movement_curve, movement_metric_dict):
+    """
+    Delay metric of a movement & its contribution to the overall calibration difference
+    """
+    # local_calibration_diff = movement_curve.get_calibration_diff() * movement_curve.hourly_volume
+    local_calibration_diff = get_movement_calibration_diff(movement_curve) * \
+                             movement_curve.total_trajs
+    local_calibration_diff /= 3600  # convert second to hour
+
+    local_delay_metric = movement_curve.predicted_delay + \
+                         movement_curve.predicted_stop_ratio * 30
+    local_delay_metric *= movement_curve.total_trajs
+    movement_metric_dict[movement_id] = local_delay_metric
+
+    # attention: here is how we set the objective function
+    if local_calibration_diff >= 0:
+        return local_calibration_diff * local_calibration_diff
+    # a higher penalty is set here
+    return local_calibration_diff * local_calibration_diff * 4
+
+
+def _predict_movement(curve_dict, movement_id, movement_curve, green_dict, cycle_dict,
+                      global_cycle, use_predicted_arrival):
+    """
+    Arrival, permissive capacity & departure prediction of a single movement
+        (the offsets are set by _apply_offsets)
+    """
+    new_cycle_length = global_cycle
+    if movement_curve.junction_id in cycle_dict:
+        new_cycle_length = cycle_dict[movement_curve.junction_id]
+
+    new_green_info = None
+    if movement_id in green_dict:
+        new_green_info = green_dict[movement_id]
+
+    # the curves are re-binned with the new cycle length by _apply_cycle_lengths
+    # todo have to be careful about cycle lengths from upstream (TODs from upstream)
+
+    # get the arrival from the upstream
+    if use_predicted_arrival:
+        with profile_stage(movement_curve, STAGE_ARRIVAL_PREDICTION):
+            _movement_arrival_prediction(curve_dict, movement_curve, from_upstream=True,
+                                         from_upstream_prediction=True)
+    # get the permissive capacity from the conflicted movements
+    #   (a screening fidelity keeps the capacity of the last prediction if it is still valid)
+    permissive_capacity_list = movement_curve.permissive_capacity_list
+    if get_active_fidelity().permissive_update or permissive_capacity_list is None or \
+            len(permissive_capacity_list) != movement_curve.departure_curve.dimension:
+        with profile_stage(movement_curve, STAGE_PERMISSIVE_CAPACITY):
+            _update_movement_permissive_capacity_list(curve_dict, movement_curve,
+                                                      use_prediction=True,
+                                                      debug=False)
+
+    # departure prediction
+    update_movement_model(movement_curve, green_time=new_green_info,
+                          cycle_length=new_cycle_length,
+                          use_predicted_arrival=use_predicted_arrival)
+
+
+def _apply_cycle_lengths(curve_dict, tod_name, cycle_dict, global_cycle):
+    """
+    Re-bin the curves of the movements whose junction gets a new cycle length (cycle_dict, then global_cycle),
+        the minor origins un-merged by the re-binning are merged again
+
+    :param curve_dict:
+    :param tod_name:
+    :param cycle_dict: {"junction_id": cycle_length}
+    :param global_cycle:
+    :return:
+    """
+    for movement_curve in curve_dict.get_tod_movement_dict(tod_name).values():
+        new_cycle_length = (cycle_dict or {}).get(movement_curve.junction_id, global_cycle)
+        if (new_cycle_length is None) or new_cycle_length == movement_curve.cycle_length:
+            continue
+        update_movement_model(movement_curve, cycle_length=new_cycle_length, departure_prediction=False)
+        curve_dict.merge_minor_origins(movement_curve)
+
+
+def _apply_offsets(curve_dict, tod_name, offset_dict):
+    """
+    Set the additional offset of the movements of the junctions in the offset dict (junction index)
+
+    :param curve_dict:
+    :param tod_name:
+    :param offset_dict: {"junction_id": additional_offsets, ...}
+    :return:
+    """
+    for junction_id, additional_offset in offset_dict.items():
+        for movement_curve in curve_dict.get_junction_movement_dict(tod_name, junction_id).values():
+            movement_curve.additional_offset = additional_offset
+
+
 def _get_cali_diff(metric_dict1, metric_dict2, disp=False):
     if len(metric_dict1) != len(metric_dict2):
         if disp:
@@ -281,24 +651,18 @@ def _get_cali_diff(metric_dict1, metric_dict2, disp=False):
             total_metric += metric1 * metric1
             total_diff += (metric2 - metric1) ** 2
 
-        diff_ratio = total_diff / total_metric
+        if total_metric > 0:
+            diff_ratio = total_diff / total_metric
+        else:
+            # no metric (e.g., a network made only of a dependency loop) or all zero: converged if unchanged
+            diff_ratio = 0 if total_diff == 0 else 1e6
         if disp:
             print("Total metric:", total_metric)
             print("Total diff:", total_diff)
-            print("Diff ratio", total_diff / total_metric)
+            print("Diff ratio", diff_ratio)
         return diff_ratio
 
 
-def _isin(list1, list2):
-    if list1 is None:
-        return True
-    contained = True
-    for val in list1:
-        if not (val in list2):
-            return False
-    return contained
-
-
 def _set_penetration_rate(curve_dict, tod_name=None,
                           global_penetration_rate=None,
                           penetration_rate_dict=None,
@@ -316,22 +680,18 @@ def _set_penetration_rate(curve_dict, tod_name=None,
     if penetration_rate_dict is None:
         penetration_rate_dict = {}
 
-    for movement_id, movement_curve_dict in curve_dict.dict.items():
-        for local_tod, movement_curve in movement_curve_dict.items():
-            if tod_name is not None:
-                if local_tod != tod_name:
-                    continue
-
-            if movement_curve.movement_id in penetration_rate_dict.keys():
-                penetration_rate = penetration_rate_dict[movement_curve.movement_id]
-            elif global_penetration_rate is not None:
-                penetration_rate = global_penetration_rate
-            else:
-                penetration_rate = movement_curve.penetration_rate
-            if penetration_rate is None:
-                raise ValueError(f"Penetration rate of movement {movement_id} "
-                                 f"at {local_tod} is not set correctly "
-                                 f"(movement index: {movement_curve.movement_index})")
+    for movement_id, local_tod, movement_curve in _iter_movement_curves(curve_dict, tod_name):
+        if movement_curve.movement_id in penetration_rate_dict.keys():
+            penetration_rate = penetration_rate_dict[movement_curve.movement_id]
+        elif global_penetration_rate is not None:
+            penetration_rate = global_penetration_rate
+        else:
+            penetration_rate = movement_curve.penetration_rate
+        if penetration_rate is None:
+            raise ValueError(f"Penetration rate of movement {movement_id} "
+                             f"at {local_tod} is not set correctly "
+                             f"(movement index: {movement_curve.movement_index})")
+        with profile_stage(movement_curve, STAGE_PENETRATION):
             update_movement_model(movement_curve, penetration_rate=penetration_rate,
                                   departure_prediction=False)
     if arrival_calibration:
@@ -347,15 +707,28 @@ def _through_movements_update(curve_dict, tod_name=None):
     :return:
     """
     movement_list = []
+    for movement_id, local_tod, movement_curve in _iter_movement_curves(curve_dict, tod_name):
+        update_movement_model(movement_curve, update_prediction=True,
+                              use_predicted_arrival=False)
+        movement_list.append(movement_id)
+    return movement_list
+
+
+def _iter_movement_curves(curve_dict, tod_name=None):
+    """
+    Iterate (movement_id, tod_name, movement_curve) of a tod (use the tod index) or of all the tods
+
+    :param curve_dict:
+    :param tod_name:
+    :return:
+    """
+    if tod_name is not None:
+        for movement_id, movement_curve in curve_dict.get_tod_movement_dict(tod_name).items():
+            yield movement_id, tod_name, movement_curve
+        return
     for movement_id, movement_curve_dict in curve_dict.dict.items():
         for local_tod, movement_curve in movement_curve_dict.items():
-            if tod_name is not None:
-                if local_tod != tod_name:
-                    continue
-            update_movement_model(movement_curve, update_prediction=True,
-                                  use_predicted_arrival=False)
-            movement_list.append(movement_id)
-    return movement_list
+            yield movement_id, local_tod, movement_curve
 
 
 def _movement_arrival_prediction(net_dict, movement_curve,
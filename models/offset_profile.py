@@ -0,0 +1,142 @@
+"""
+Delay & stops of the movements affected by the offset of a junction as a function of this offset
+
+Changing the additional offset of a junction shifts the signal (and capacity) state of its movements relative to
+their arrivals, which changes their departures, hence the arrivals of the downstream movements & the permissive
+capacity of the conflicting movements. The fast profile starts from the current prediction and re-predicts only
+these affected movements for each candidate offset (see models.sensitivity): same movement model, fidelity &
+permissive capacity as update_network_prediction, and the same result on a network without dependency loop.
+The other movements keep their prediction, they do not depend on the offset of the junction.
+
+The candidate offsets are evaluated one at a time, there is no batched propagation of all the offsets at once:
+an offset is a circular shift of the capacity state of the junction only, the queue pmf recursion is not linear
+in the arrivals (no circular convolution) and the permissive capacity & the downstream arrivals change with the
+offset, so a batch of shifted rows is only exact for the protected movements of the junction.
+
+The exact profile runs update_network_prediction for each candidate offset; pick_offset screens all the offsets with
+the fast profile & recomputes the best candidates exactly.
+"""
+
+import numpy as np
+from models.net_model import update_network_prediction
+from models.sensitivity import get_perturbation_context, predict_affected_movements
+
+
+class OffsetProfile(object):
+    """
+    Predicted delay & stop ratio of the affected movements (rows) for each candidate offset (columns)
+    """
+    def __init__(self, junction_id, offset_array, movement_id_list, delay_array, stop_ratio_array,
+                 weight_array, exact=False):
+        self.junction_id = junction_id
+        self.offset_array = offset_array            # additional offset of the junction (s)
+        self.movement_id_list = movement_id_list    # movements of the junction & their dependents
+        self.delay_array = delay_array              # average delay (s), movement x offset
+        self.stop_ratio_array = stop_ratio_array    # stop ratio, movement x offset
+        self.weight_array = weight_array            # number of trajectories of each movement
+        self.exact = exact
+
+    def get_total_delay(self):
+        """
+        :return: total delay of the affected movements for each offset (h)
+        """
+        return np.sum(self.delay_array * self.weight_array[:, None], axis=0) / 3600
+
+    def get_total_stops(self):
+        return np.sum(self.stop_ratio_array * self.weight_array[:, None], axis=0)
+
+    def get_cost(self, stop_weight=30):
+        """
+        Same objective as the movement metric of update_network_prediction (delay + stops * stop_weight)
+
+        :param stop_weight: (s) per stop
+        :return: cost of each offset (h)
+        """
+        return self.get_total_delay() + self.get_total_stops() * stop_weight / 3600
+
+    def get_best_offsets(self, top_k=1, stop_weight=30):
+        """
+        :param top_k:
+        :param stop_weight:
+        :return: the top_k offsets with the lowest cost
+        """
+        order_array = np.argsort(self.get_cost(stop_weight), kind="stable")
+        return self.offset_array[order_array[:top_k]]
+
+    def to_df(self, stop_weight=30):
+        import pandas as pd
+        return pd.DataFrame({"offset (s)": self.offset_array,
+                             "delay (h)": self.get_total_delay(),
+                             "stops": self.get_total_stops(),
+                             "cost (h)": self.get_cost(stop_weight)})
+
+
+def get_offset_profile(net_dict, tod_name, junction_id, offset_list=None, exact=False, **prediction_kwargs):
+    """
+    Delay & stop ratio of the movements affected by the offset of a junction for every candidate offset,
+        the network should have been predicted (update_network_prediction) with the prediction arguments
+
+    :param net_dict:
+    :param tod_name:
+    :param junction_id:
+    :param offset_list: additional offsets of the junction (s), every resolution step within the cycle if None
+    :param exact: run update_network_prediction for each offset, otherwise re-predict the affected movements only
+        (one offset after the other, rolled back after each offset in both cases)
+    :param prediction_kwargs: arguments of update_network_prediction of the current prediction (the offset of the
+        junction in the offset_dict is replaced by the candidates)
+    :return: OffsetProfile
+    """
+    movement_dict = net_dict.get_junction_movement_dict(tod_name, junction_id)
+    if len(movement_dict) == 0:
+        raise ValueError(f"No movement of junction {junction_id} at {tod_name}")
+    first_curve = list(movement_dict.values())[0]
+    resolution = first_curve.resolution
+    if offset_list is None:
+        offset_list = [val * resolution for val in range(int(round(first_curve.cycle_length / resolution)))]
+    offset_array = np.array(offset_list, dtype=float)
+
+    context = get_perturbation_context(net_dict, tod_name, **prediction_kwargs)
+    movement_id_list = context.get_affected_movements(list(movement_dict.keys()))
+    weight_array = np.array([net_dict.get_movement_tod_curve(movement_id, tod_name).total_trajs
+                             for movement_id in movement_id_list], dtype=float)
+
+    offset_dict = dict(prediction_kwargs.pop("offset_dict", None) or {})
+    delay_array = np.zeros((len(movement_id_list), len(offset_array)))
+    stop_ratio_array = np.zeros((len(movement_id_list), len(offset_array)))
+    for offset_idx, offset in enumerate(offset_array):
+        with net_dict.trial(tod_name, None if exact else movement_id_list):
+            if exact:
+                offset_dict[junction_id] = float(offset)
+                update_network_prediction(net_dict, tod_name, offset_dict=offset_dict, **prediction_kwargs)
+            else:
+                for movement_curve in movement_dict.values():
+                    movement_curve.additional_offset = float(offset)
+                predict_affected_movements(net_dict, context, movement_id_list)
+            for movement_idx, movement_id in enumerate(movement_id_list):
+                movement_curve = net_dict.get_movement_tod_curve(movement_id, tod_name)
+                delay_array[movement_idx, offset_idx] = movement_curve.predicted_delay
+                stop_ratio_array[movement_idx, offset_idx] = movement_curve.predicted_stop_ratio
+    return OffsetProfile(junction_id, offset_array, movement_id_list, delay_array, stop_ratio_array,
+                         weight_array, exact=exact)
+
+
+def pick_offset(net_dict, tod_name, junction_id, top_k=3, stop_weight=30, offset_list=None, **prediction_kwargs):
+    """
+    Screen all the offsets with the fast profile & recompute the top_k candidates exactly
+
+    :param net_dict:
+    :param tod_name:
+    :param junction_id:
+    :param top_k: number of candidates recomputed with update_network_prediction
+    :param stop_weight:
+    :param offset_list:
+    :param prediction_kwargs: arguments of update_network_prediction of the current prediction
+    :return: best offset (s), fast profile, exact profile of the candidates
+    """
+    fast_profile = get_offset_profile(net_dict, tod_name, junction_id, offset_list=offset_list,
+                                      **prediction_kwargs)
+    candidate_array = fast_profile.get_best_offsets(top_k, stop_weight)
+    exact_profile = get_offset_profile(net_dict, tod_name, junction_id, offset_list=candidate_array,
+                                       exact=True, **prediction_kwargs)
+    best_offset = exact_profile.get_best_offsets(1, stop_weight)[0]
+    return float(best_offset), fast_profile, exact_profile
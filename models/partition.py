@@ -0,0 +1,121 @@
+"""
+Prediction of a network split into its connected components
+
+The movements of a regional network often form corridors that never interact through the upstream & conflicting
+movements (see MovementNetDict.get_connected_components). Each component is an independent problem: it is predicted
+with its own super iterations & convergence test, so that a slow component does not hold the others to
+max_super_iterations. The components are solved concurrently in separate processes if requested and the results
+are merged back to the network, as in update_network_prediction_all_tods.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from time import time
+
+import numpy as np
+from models.net_model import update_network_prediction
+from models.profiling import PredictionProfiler
+
+
+class ComponentReport(object):
+    """
+    Size & convergence of the prediction of each component
+    """
+    def __init__(self, tod_name):
+        self.tod_name = tod_name
+        self.record_list = []
+
+    def add_record(self, component_index, movement_id_list, junction_number, calibration_diff, stats_dict,
+                   elapsed_time):
+        self.record_list.append({"component": component_index,
+                                 "movements": len(movement_id_list),
+                                 "junctions": junction_number,
+                                 "super iterations": stats_dict.get("super_iterations"),
+                                 "converged": stats_dict.get("converged"),
+                                 "calibration diff": calibration_diff,
+                                 "time (s)": elapsed_time})
+
+    def get_calibration_diff(self):
+        return sum([record["calibration diff"] for record in self.record_list])
+
+    def to_df(self):
+        import pandas as pd
+        return pd.DataFrame(self.record_list)
+
+
+def update_network_prediction_by_component(net_dict, tod_name, workers=1, disp=False, **prediction_kwargs):
+    """
+    update_network_prediction of each connected component of a tod
+
+    :param net_dict:
+    :param tod_name:
+    :param workers: number of processes, the components are predicted one by one in the current process if <= 1,
+        cpu count if None
+    :param disp: display the report
+    :param prediction_kwargs: arguments of update_network_prediction (offsets & cycles of the junctions,
+        green times & penetration rates of the movements of any component)
+    :return: overall calibration difference (sum of the components), ComponentReport
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    component_list = net_dict.get_connected_components(tod_name)
+    report = ComponentReport(tod_name)
+
+    if workers <= 1 or len(component_list) <= 1:
+        for component_index, movement_id_list in enumerate(component_list):
+            # the movement curves are not copied, the component is predicted in place
+            component_net_dict = net_dict.select_tod(tod_name, movement_id_list)
+            report.add_record(component_index, movement_id_list, *_predict_component(component_net_dict, tod_name,
+                                                                                     prediction_kwargs))
+    else:
+        profiler = prediction_kwargs.get("profiler")
+        worker_kwargs = dict(prediction_kwargs)
+        if profiler is not None:
+            # the records are merged by the parent process, start from an empty profiler
+            worker_kwargs["profiler"] = PredictionProfiler()
+        with ProcessPoolExecutor(max_workers=min(workers, len(component_list))) as executor:
+            future_list = [executor.submit(_component_network_prediction,
+                                           net_dict.select_tod(tod_name, movement_id_list), tod_name, worker_kwargs)
+                           for movement_id_list in component_list]
+            for component_index, (movement_id_list, future) in enumerate(zip(component_list, future_list)):
+                junction_number, calibration_diff, stats_dict, elapsed_time, movement_curve_dict, \
+                    component_profiler, calibration_cache = future.result()
+                report.add_record(component_index, movement_id_list, junction_number, calibration_diff, stats_dict,
+                                  elapsed_time)
+                if component_profiler is not None:
+                    profiler.merge(component_profiler)
+                net_dict.calibration_cache.update(calibration_cache)
+                # merge back in place so that the references to the movement curves remain valid
+                for movement_id, new_movement_curve in movement_curve_dict.items():
+                    movement_curve = net_dict.get_movement_tod_curve(movement_id, tod_name)
+                    movement_curve.__dict__.update(new_movement_curve.__dict__)
+
+    calibration_diff = report.get_calibration_diff()
+    if disp:
+        print(f"{len(component_list)} connected components at {tod_name}, "
+              f"overall calibration difference {np.round(calibration_diff, 4)}")
+        print(report.to_df())
+    return calibration_diff, report
+
+
+def _predict_component(component_net_dict, tod_name, prediction_kwargs):
+    """
+    :return: number of junctions, calibration difference, convergence stats, elapsed time (s)
+    """
+    start_time = time()
+    stats_dict = {}
+    calibration_diff = update_network_prediction(component_net_dict, tod_name, stats_dict=stats_dict,
+                                                 **prediction_kwargs)
+    return len(component_net_dict.get_junction_list(tod_name)), calibration_diff, stats_dict, time() - start_time
+
+
+def _component_network_prediction(component_net_dict, tod_name, prediction_kwargs):
+    """
+    Worker of update_network_prediction_by_component, predict one component in a separate process
+
+    :return: outputs of _predict_component, the updated movement curves, the profiler (if any) & the calibration
+        cache of the worker
+    """
+    return _predict_component(component_net_dict, tod_name, prediction_kwargs) + \
+        (component_net_dict.get_tod_movement_dict(tod_name), prediction_kwargs.get("profiler"),
+         component_net_dict.calibration_cache)
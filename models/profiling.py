@@ -0,0 +1,191 @@
+"""
+Opt-in instrumentation of the network prediction
+
+Wall time & number of calls are recorded per (tod, movement, stage). The profiler is activated
+for the duration of update_network_prediction(..., profiler=PredictionProfiler()),
+when no profiler is active, profile_stage returns a shared no-op timer.
+"""
+
+import csv
+import json
+from contextlib import contextmanager
+from time import perf_counter
+
+STAGE_PENETRATION = "penetration update"
+STAGE_ARRIVAL_CALIBRATION = "arrival calibration"
+STAGE_ARRIVAL_PREDICTION = "arrival prediction"
+STAGE_PERMISSIVE_CAPACITY = "permissive capacity"
+STAGE_SIGNAL_STATE = "signal state"
+STAGE_DEPARTURE_ITERATION = "departure fixed-point iteration"
+STAGE_METRICS = "metrics"
+
+STAGE_LIST = [STAGE_PENETRATION, STAGE_ARRIVAL_CALIBRATION, STAGE_ARRIVAL_PREDICTION,
+              STAGE_PERMISSIVE_CAPACITY, STAGE_SIGNAL_STATE, STAGE_DEPARTURE_ITERATION, STAGE_METRICS]
+
+RECORD_FIELDS = ["tod_name", "movement_id", "junction_id", "stage", "calls", "total_time"]
+
+_active_profiler = None
+
+
+class PredictionProfiler(object):
+    """
+    Collection of the stage timings of the network prediction
+    """
+    def __init__(self):
+        self.stats_dict = {}        # key: (tod_name, movement_id, stage), val: [calls, total time]
+        self.junction_dict = {}     # key: movement_id, val: junction_id
+        self.wall_time = 0
+
+    @contextmanager
+    def activate(self):
+        """
+        Make this profiler the active one (not thread-safe, one active profiler per process)
+
+        :return:
+        """
+        global _active_profiler
+        previous_profiler = _active_profiler
+        _active_profiler = self
+        start_time = perf_counter()
+        try:
+            yield self
+        finally:
+            self.wall_time += perf_counter() - start_time
+            _active_profiler = previous_profiler
+
+    def stage(self, movement_tod, stage):
+        key = (movement_tod.tod_name, movement_tod.movement_id, stage)
+        self.junction_dict[movement_tod.movement_id] = movement_tod.junction_id
+        return _StageTimer(self, key)
+
+    def add(self, key, elapsed_time, calls=1):
+        stats = self.stats_dict.get(key)
+        if stats is None:
+            self.stats_dict[key] = [calls, elapsed_time]
+        else:
+            stats[0] += calls
+            stats[1] += elapsed_time
+
+    def merge(self, other):
+        """
+        Merge the records of another profiler (e.g., returned by a worker process)
+
+        :param other:
+        :return:
+        """
+        for key, (calls, elapsed_time) in other.stats_dict.items():
+            self.add(key, elapsed_time, calls)
+        self.junction_dict.update(other.junction_dict)
+        self.wall_time = max(self.wall_time, other.wall_time)
+        return self
+
+    def to_records(self):
+        """
+        :return: list of dict with the keys in RECORD_FIELDS
+        """
+        record_list = []
+        for (tod_name, movement_id, stage), (calls, elapsed_time) in self.stats_dict.items():
+            record_list.append({"tod_name": tod_name, "movement_id": movement_id,
+                                "junction_id": self.junction_dict.get(movement_id),
+                                "stage": stage, "calls": calls, "total_time": elapsed_time})
+        return record_list
+
+    def summary(self, by="stage"):
+        """
+        Aggregated calls & time
+
+        :param by: "stage", "movement_id", "junction_id" or "tod_name"
+        :return: {key: {"calls": , "total_time": }}, sorted by the total time (descending)
+        """
+        summary_dict = {}
+        for record in self.to_records():
+            local_key = record[by]
+            if not (local_key in summary_dict.keys()):
+                summary_dict[local_key] = {"calls": 0, "total_time": 0}
+            summary_dict[local_key]["calls"] += record["calls"]
+            summary_dict[local_key]["total_time"] += record["total_time"]
+        return dict(sorted(summary_dict.items(), key=lambda val: -val[1]["total_time"]))
+
+    def to_dict(self):
+        return {"wall_time": self.wall_time, "records": self.to_records()}
+
+    def to_json(self, file_path):
+        with open(file_path, "w") as temp_file:
+            json.dump(self.to_dict(), temp_file, indent=2)
+
+    def to_csv(self, file_path):
+        with open(file_path, "w", newline="") as temp_file:
+            writer = csv.DictWriter(temp_file, fieldnames=RECORD_FIELDS)
+            writer.writeheader()
+            writer.writerows(self.to_records())
+
+
+class _StageTimer(object):
+    __slots__ = ["profiler", "key", "start_time"]
+
+    def __init__(self, profiler, key):
+        self.profiler = profiler
+        self.key = key
+        self.start_time = None
+
+    def __enter__(self):
+        self.start_time = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.profiler.add(self.key, perf_counter() - self.start_time)
+        return False
+
+
+class _NullTimer(object):
+    __slots__ = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def get_active_profiler():
+    return _active_profiler
+
+
+@contextmanager
+def profile_batch(movement_tod_list, stage):
+    """
+    Timer of a stage computed for many movements at once, the time is split evenly among the movements,
+        no-op if there is no active profiler
+
+    :param movement_tod_list:
+    :param stage:
+    :return:
+    """
+    profiler = _active_profiler
+    if profiler is None or len(movement_tod_list) == 0:
+        yield
+        return
+    start_time = perf_counter()
+    try:
+        yield
+    finally:
+        elapsed_time = (perf_counter() - start_time) / len(movement_tod_list)
+        for movement_tod in movement_tod_list:
+            profiler.junction_dict[movement_tod.movement_id] = movement_tod.junction_id
+            profiler.add((movement_tod.tod_name, movement_tod.movement_id, stage), elapsed_time)
+
+
+def profile_stage(movement_tod, stage):
+    """
+    Timer of a stage of a movement, no-op if there is no active profiler
+
+    :param movement_tod:
+    :param stage:
+    :return:
+    """
+    if _active_profiler is None:
+        return _NULL_TIMER
+    return _active_profiler.stage(movement_tod, stage)
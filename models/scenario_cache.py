@@ -0,0 +1,294 @@
+"""
+On-disk cache of the network predictions of scenarios, shared across the sessions
+
+A scenario is the prediction of a tod with the arguments of update_network_prediction (offsets, green times, cycle
+lengths, penetration rates, ...). Its key is a content hash of the calibrated movements of the tod (spat, calibration
+& histograms, not the predictions of the previous runs), of the arguments and of the active fidelity. An entry stores
+the predicted curves & metrics of the movements as the padded arrays of models.compiled_network in a compressed
+.npz file. A hit applies the scenario inputs (penetration, offsets, green times & cycle lengths) and restores the
+predictions without running the model. The least recently used entries are removed above the size limit:
+    cache = ScenarioCache("cache/scenarios")
+    calibration_diff = cache.predict(net_dict, tod_name, offset_dict=offset_dict)
+"""
+
+import os
+from hashlib import blake2b
+
+import numpy as np
+from models.compiled_network import CompiledNetwork
+from models.fidelity import get_active_fidelity
+from models.movement_model import update_movement_model
+from models.net_model import update_network_prediction, _set_penetration_rate, _apply_offsets, \
+    _apply_cycle_lengths
+
+CACHE_FORMAT_VERSION = 1
+DEFAULT_MAX_CACHE_SIZE = 512 * 1024 * 1024     # bytes
+CACHE_FILE_SUFFIX = ".npz"
+
+# prediction outputs stored in an entry
+CACHE_CURVE_FIELD_LIST = ["arrival_predict", "departure_predict", "departure_agg_predict",
+                          "signal_state", "capacity_state", "permissive_capacity"]
+CACHE_SCALAR_FIELD_LIST = ["predicted_delay", "predicted_stop_ratio", "hourly_volume"]
+
+# inputs of the prediction, part of the key
+KEY_MOVEMENT_ATTRIBUTE_LIST = ["movement_id", "movement_index", "junction_id", "resolution", "departure_cycles",
+                               "number_of_dates", "cycle_length", "offset", "green_time", "additional_offset",
+                               "green_start_shift", "effective_green_change", "yellow_change_interval",
+                               "clearance_interval", "binary_green", "sat_flow_per_lane", "equivalent_lane_number",
+                               "upstream_movement_list", "conflicting_movement_list", "permissive_type",
+                               "gap_acceptance", "penetration_rate", "total_trajs", "total_stops",
+                               "total_stopped_trajs", "total_control_delay", "origin_diverge_dict",
+                               "origin_shift_dict"]
+# arguments of update_network_prediction without influence on the prediction
+IGNORED_ARGUMENT_LIST = ["profiler", "disp"]
+
+
+class ScenarioCache(object):
+    """
+    Least recently used cache of scenario predictions in a directory (one file per scenario)
+    """
+    def __init__(self, cache_dir, max_size=DEFAULT_MAX_CACHE_SIZE):
+        """
+        :param cache_dir: created if missing
+        :param max_size: (bytes) total size of the entries, the least recently used ones are removed above it
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def predict(self, net_dict, tod_name, **prediction_kwargs):
+        """
+        update_network_prediction with the cache: restore the prediction of a known scenario, otherwise
+            predict & store it
+
+        :param net_dict:
+        :param tod_name:
+        :param prediction_kwargs: arguments of update_network_prediction
+        :return: overall calibration difference
+        """
+        key = get_scenario_key(net_dict, tod_name, prediction_kwargs)
+        calibration_diff = self.load(net_dict, tod_name, key, prediction_kwargs)
+        if calibration_diff is not None:
+            self.hits += 1
+            return calibration_diff
+        self.misses += 1
+        calibration_diff = update_network_prediction(net_dict, tod_name, **prediction_kwargs)
+        self.store(net_dict, tod_name, key, calibration_diff)
+        return calibration_diff
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key + CACHE_FILE_SUFFIX)
+
+    def load(self, net_dict, tod_name, key, prediction_kwargs):
+        """
+        Restore the prediction of a scenario
+
+        :param net_dict:
+        :param tod_name:
+        :param key: get_scenario_key of the network before the prediction
+        :param prediction_kwargs: arguments of update_network_prediction of the scenario
+        :return: overall calibration difference, None if the scenario is not in the cache
+        """
+        path = self.get_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as entry:
+                entry_dict = {name: entry[name] for name in entry.files}
+        except (OSError, ValueError, EOFError):
+            # e.g., an entry removed or truncated by another process
+            return None
+        if entry_dict["movement_id"].tolist() != list(net_dict.get_tod_movement_dict(tod_name).keys()):
+            return None
+        # mark as recently used
+        os.utime(path)
+
+        _apply_scenario_inputs(net_dict, tod_name, prediction_kwargs)
+        set_prediction_arrays(net_dict, tod_name, entry_dict)
+        return float(entry_dict["calibration_diff"])
+
+    def store(self, net_dict, tod_name, key, calibration_diff):
+        """
+        Store the current prediction of a tod & remove the least recently used entries above the size limit
+
+        :param net_dict:
+        :param tod_name:
+        :param key: get_scenario_key of the network before the prediction
+        :param calibration_diff: output of update_network_prediction
+        :return: path of the entry
+        """
+        entry_dict = get_prediction_arrays(net_dict, tod_name)
+        entry_dict["calibration_diff"] = np.array(calibration_diff, dtype=float)
+
+        path = self.get_path(key)
+        # written under a temporary name & renamed, a reader never sees a partial entry
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as temp_file:
+            np.savez_compressed(temp_file, **entry_dict)
+        os.replace(temp_path, path)
+        self.evict()
+        return path
+
+    def get_entry_list(self):
+        """
+        :return: [(path, size, last use time), ...] from the least recently used
+        """
+        entry_list = []
+        for file_name in os.listdir(self.cache_dir):
+            if not file_name.endswith(CACHE_FILE_SUFFIX):
+                continue
+            path = os.path.join(self.cache_dir, file_name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entry_list.append((path, stat.st_size, stat.st_mtime))
+        return sorted(entry_list, key=lambda val: val[2])
+
+    def get_size(self):
+        return sum([size for _, size, _ in self.get_entry_list()])
+
+    def evict(self, max_size=None):
+        """
+        Remove the least recently used entries until the total size is within the limit
+
+        :param max_size: self.max_size if None
+        :return: number of removed entries
+        """
+        if max_size is None:
+            max_size = self.max_size
+        entry_list = self.get_entry_list()
+        total_size = sum([size for _, size, _ in entry_list])
+        removed_number = 0
+        for path, size, _ in entry_list:
+            if total_size <= max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+            removed_number += 1
+        return removed_number
+
+    def clear(self):
+        return self.evict(max_size=0)
+
+
+def get_scenario_key(net_dict, tod_name, prediction_kwargs, network_key=None):
+    """
+    Content hash of a scenario
+
+    :param net_dict:
+    :param tod_name:
+    :param prediction_kwargs: arguments of update_network_prediction
+    :param network_key: get_network_key of the tod (e.g., computed once for many scenarios), computed if None
+    :return: hex digest
+    """
+    if network_key is None:
+        network_key = get_network_key(net_dict, tod_name)
+    key_hash = blake2b(digest_size=20)
+    key_hash.update(network_key.encode())
+    key_hash.update(repr(_get_canonical({name: val for name, val in prediction_kwargs.items()
+                                         if not (name in IGNORED_ARGUMENT_LIST)})).encode())
+    key_hash.update(repr(_get_canonical(vars(get_active_fidelity()))).encode())
+    return key_hash.hexdigest()
+
+
+def get_network_key(net_dict, tod_name):
+    """
+    Content hash of the calibrated movements of a tod (the predictions are not part of it)
+
+    :param net_dict:
+    :param tod_name:
+    :return: hex digest
+    """
+    key_hash = blake2b(digest_size=20)
+    key_hash.update(repr((CACHE_FORMAT_VERSION, tod_name)).encode())
+    for movement_id, movement_curve in net_dict.get_tod_movement_dict(tod_name).items():
+        key_hash.update(repr([_get_canonical(getattr(movement_curve, attr, None))
+                              for attr in KEY_MOVEMENT_ATTRIBUTE_LIST]).encode())
+        for curve, curve_list in [(movement_curve.arrival_curve, "curve_list"),
+                                  (movement_curve.departure_curve, "curve_list")]:
+            key_hash.update(b"|")
+            if curve is not None and getattr(curve, curve_list) is not None:
+                key_hash.update(np.asarray(getattr(curve, curve_list), dtype=float).tobytes())
+        origin_curve_dict = movement_curve.arrival_curve.origin_curve_dict \
+            if movement_curve.arrival_curve is not None else {}
+        for origin_id in sorted(origin_curve_dict.keys(), key=str):
+            key_hash.update(repr(origin_id).encode())
+            key_hash.update(np.asarray(origin_curve_dict[origin_id], dtype=float).tobytes())
+    return key_hash.hexdigest()
+
+
+def get_prediction_arrays(net_dict, tod_name, prefix=""):
+    """
+    Predicted curves & metrics of the movements of a tod as padded arrays (e.g., for np.savez)
+
+    :param net_dict:
+    :param tod_name:
+    :param prefix: prefix of the array names
+    :return: {name: array}
+    """
+    compiled_network = CompiledNetwork(net_dict, tod_name, field_list=CACHE_CURVE_FIELD_LIST)
+    array_dict = {f"{prefix}movement_id": np.array(compiled_network.movement_id_list, dtype=str)}
+    for field in CACHE_CURVE_FIELD_LIST:
+        curve_array, length_array = compiled_network.get_field(field)
+        array_dict[f"{prefix}{field}_curve"] = curve_array
+        array_dict[f"{prefix}{field}_length"] = length_array
+    for attr in CACHE_SCALAR_FIELD_LIST:
+        array_dict[f"{prefix}{attr}"] = compiled_network.get_scalar(attr)
+    return array_dict
+
+
+def set_prediction_arrays(net_dict, tod_name, array_dict, prefix=""):
+    """
+    Restore the output of get_prediction_arrays
+
+    :param net_dict:
+    :param tod_name:
+    :param array_dict:
+    :param prefix:
+    :return: False (nothing restored) if the movements of the tod are not the ones of the arrays
+    """
+    if array_dict[f"{prefix}movement_id"].tolist() != list(net_dict.get_tod_movement_dict(tod_name).keys()):
+        return False
+    compiled_network = CompiledNetwork(net_dict, tod_name, field_list=CACHE_CURVE_FIELD_LIST)
+    for field in CACHE_CURVE_FIELD_LIST:
+        compiled_network.set_field(field, array_dict[f"{prefix}{field}_curve"],
+                                   array_dict[f"{prefix}{field}_length"])
+    for attr in CACHE_SCALAR_FIELD_LIST:
+        compiled_network.set_scalar(attr, array_dict[f"{prefix}{attr}"])
+    compiled_network.sync()
+    return True
+
+
+def _get_canonical(value):
+    """
+    Representation independent of the insertion order of the dicts & of the container types
+    """
+    if isinstance(value, dict):
+        return tuple(sorted([(str(key), _get_canonical(val)) for key, val in value.items()]))
+    if isinstance(value, (list, tuple)):
+        return tuple([_get_canonical(val) for val in value])
+    if isinstance(value, np.ndarray):
+        return _get_canonical(value.tolist())
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _apply_scenario_inputs(net_dict, tod_name, prediction_kwargs):
+    """
+    Same inputs as update_network_prediction without the prediction: cycle lengths (the histograms are re-binned),
+        penetration rates (& arrival calibration), offsets & green times
+    """
+    _apply_cycle_lengths(net_dict, tod_name, prediction_kwargs.get("cycle_dict"), prediction_kwargs.get("global_cycle"))
+    _set_penetration_rate(net_dict, tod_name, prediction_kwargs.get("global_p"), prediction_kwargs.get("p_dict"),
+                          arrival_calibration=True)
+    _apply_offsets(net_dict, tod_name, prediction_kwargs.get("offset_dict") or {})
+    green_dict = prediction_kwargs.get("green_dict") or {}
+    for movement_id, movement_curve in net_dict.get_tod_movement_dict(tod_name).items():
+        update_movement_model(movement_curve, green_time=green_dict.get(movement_id), departure_prediction=False)
@@ -0,0 +1,140 @@
+"""
+Multi-fidelity screening of candidate signal plans
+
+All the candidates are evaluated with a cheap fidelity (see models.fidelity), then only the top_k ones
+(and optionally a few check candidates spread over the ranking) are evaluated with the full model.
+The Spearman rank correlation between the two fidelities on the re-scored candidates tells whether
+the screening can be trusted for this network.
+"""
+
+from time import time
+
+import numpy as np
+from models.fidelity import PredictionFidelity
+from models.metrics import get_network_hourly_cost
+from models.net_model import update_network_prediction
+
+# the permissive capacity is still updated: it follows the offsets of the conflicting movements,
+#   keeping the one of the last prediction breaks the ranking of offset candidates
+DEFAULT_SCREENING_FIDELITY = PredictionFidelity(departure_steps=5, binary_green=True, max_super_iterations=1)
+
+
+class ScreeningResult(object):
+    def __init__(self, candidate_list, coarse_cost_array, full_cost_dict, coarse_time, full_time):
+        self.candidate_list = candidate_list
+        self.coarse_cost_array = coarse_cost_array      # cost of each candidate with the screening fidelity
+        self.full_cost_dict = full_cost_dict            # key: candidate index, val: cost with the full model
+        self.coarse_time = coarse_time
+        self.full_time = full_time
+        self.best_index = min(full_cost_dict.keys(), key=lambda val: (full_cost_dict[val], val))
+        self.best_candidate = candidate_list[self.best_index]
+        self.rank_correlation = get_rank_correlation(coarse_cost_array[list(full_cost_dict.keys())],
+                                                     list(full_cost_dict.values()))
+
+    def to_df(self):
+        import pandas as pd
+        return pd.DataFrame({"candidate": list(range(len(self.candidate_list))),
+                             "coarse cost (h)": self.coarse_cost_array,
+                             "full cost (h)": [self.full_cost_dict.get(idx, np.nan)
+                                               for idx in range(len(self.candidate_list))]})
+
+
+def screen_candidates(net_dict, tod_name, candidate_list, top_k=5, check_number=0, fidelity=None,
+                      stop_weight=30, disp=False, **prediction_kwargs):
+    """
+    Evaluate candidate plans with a cheap fidelity & re-score the best ones with the full model
+
+    :param net_dict:
+    :param tod_name:
+    :param candidate_list: list of dicts of update_network_prediction arguments,
+        e.g., {"offset_dict": {...}, "green_dict": {...}}
+    :param top_k: number of best screened candidates re-scored with the full model
+    :param check_number: number of other candidates (evenly spread over the screened ranking) re-scored
+        with the full model, to measure the rank correlation beyond the top ones
+    :param fidelity: PredictionFidelity of the screening, DEFAULT_SCREENING_FIDELITY if None
+    :param stop_weight: (s) per stop in the cost
+    :param disp:
+    :param prediction_kwargs: common arguments of update_network_prediction
+    :return: ScreeningResult
+    """
+    if len(candidate_list) == 0:
+        raise ValueError("No candidate to screen")
+    if fidelity is None:
+        fidelity = DEFAULT_SCREENING_FIDELITY
+
+    start_time = time()
+    coarse_cost_array = np.zeros(len(candidate_list))
+    with net_dict.trial(tod_name):
+        fidelity.apply(net_dict, tod_name)
+        with fidelity.activate():
+            for idx, candidate in enumerate(candidate_list):
+                coarse_cost_array[idx] = evaluate_candidate(net_dict, tod_name, candidate, stop_weight,
+                                                            **prediction_kwargs)
+    coarse_time = time() - start_time
+
+    order_array = np.argsort(coarse_cost_array, kind="stable")
+    rescore_list = order_array[:top_k].tolist()
+    remaining_array = order_array[top_k:]
+    if check_number > 0 and len(remaining_array) > 0:
+        check_index_array = np.unique(np.linspace(0, len(remaining_array) - 1,
+                                                  min(check_number, len(remaining_array))).astype(int))
+        rescore_list += remaining_array[check_index_array].tolist()
+
+    start_time = time()
+    full_cost_dict = {}
+    for idx in rescore_list:
+        full_cost_dict[idx] = evaluate_candidate(net_dict, tod_name, candidate_list[idx], stop_weight,
+                                                 **prediction_kwargs)
+    full_time = time() - start_time
+
+    result = ScreeningResult(candidate_list, coarse_cost_array, full_cost_dict, coarse_time, full_time)
+    if disp:
+        print(f"Screened {len(candidate_list)} candidates in {np.round(coarse_time, 3)} secs, "
+              f"re-scored {len(full_cost_dict)} in {np.round(full_time, 3)} secs")
+        print(f"Best candidate: {result.best_index}, cost {np.round(full_cost_dict[result.best_index], 4)} h")
+        print(f"Rank correlation between the fidelities: {np.round(result.rank_correlation, 3)}")
+    return result
+
+
+def evaluate_candidate(net_dict, tod_name, candidate, stop_weight=30, **prediction_kwargs):
+    """
+    Cost of a candidate plan, the network is rolled back afterwards
+
+    :param net_dict:
+    :param tod_name:
+    :param candidate: dict of update_network_prediction arguments
+    :param stop_weight:
+    :param prediction_kwargs:
+    :return: total delay + stops * stop_weight of the tod (h)
+    """
+    local_kwargs = dict(prediction_kwargs)
+    local_kwargs.update(candidate)
+    with net_dict.trial(tod_name):
+        update_network_prediction(net_dict, tod_name, **local_kwargs)
+        return sum(get_network_hourly_cost(net_dict, tod_name, stop_weight))
+
+
+def get_rank_correlation(value_list1, value_list2):
+    """
+    Spearman rank correlation (average ranks for the ties)
+
+    :param value_list1:
+    :param value_list2:
+    :return: nan if less than 2 values or a constant list
+    """
+    rank_array1 = _get_ranks(value_list1)
+    rank_array2 = _get_ranks(value_list2)
+    if len(rank_array1) < 2 or np.std(rank_array1) == 0 or np.std(rank_array2) == 0:
+        return np.nan
+    return float(np.corrcoef(rank_array1, rank_array2)[0, 1])
+
+
+def _get_ranks(value_list):
+    value_array = np.asarray(value_list, dtype=float)
+    order_array = np.argsort(value_array, kind="stable")
+    rank_array = np.empty(len(value_array))
+    rank_array[order_array] = np.arange(len(value_array))
+    for value in np.unique(value_array):
+        tie_mask = value_array == value
+        rank_array[tie_mask] = np.mean(rank_array[tie_mask])
+    return rank_array
@@ -0,0 +1,336 @@
+"""
+Finite-difference sensitivity of the network cost w.r.t. the offsets & the green splits of the junctions
+
+The gradient of a junction parameter is the central difference of the hourly cost (delay + stops) of two
+perturbed predictions (current value +/- step). The perturbations start from the prediction of the current
+timing: only the movements of the junction & the movements depending on them (downstream through the predicted
+arrivals, conflicting through the permissive capacity) are re-predicted in the dependency order of
+update_network_prediction. Once is exact without a dependency loop, otherwise the affected movements are iterated
+with the super iteration convergence test of update_network_prediction. The other movements keep their prediction
+and each perturbation is rolled back on the re-predicted movements only. The perturbations are evaluated on a
+process pool (see models.timing_optimizer).
+"""
+
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from models.fidelity import get_active_fidelity
+from models.metrics import get_network_hourly_cost
+from models.net_model import update_network_prediction, _DependencyScheduler, _predict_movement, _movement_metric, \
+    _get_cali_diff
+from models.timing_optimizer import JunctionTiming, DEFAULT_MIN_GREEN
+
+OFFSET_PARAMETER = "offset"
+SPLIT_PARAMETER = "major split"
+PARAMETER_LIST = [OFFSET_PARAMETER, SPLIT_PARAMETER]
+
+_worker_net_dict = None
+_worker_context = None
+
+
+class SensitivityResult(object):
+    """
+    Cost gradients of the junctions of a tod
+    """
+    def __init__(self, base_delay, base_stops, gradient_dict, step_dict, affected_dict):
+        self.base_delay = base_delay            # (h)
+        self.base_stops = base_stops            # (h equivalence)
+        self.gradient_dict = gradient_dict      # key: parameter, val: {junction_id: gradient (h/s)}
+        self.step_dict = step_dict              # key: parameter, val: perturbation step (s)
+        self.affected_dict = affected_dict      # key: junction_id, val: number of re-predicted movements
+
+    def get_base_cost(self):
+        return self.base_delay + self.base_stops
+
+    def get_gradient_dict(self, parameter=OFFSET_PARAMETER):
+        return self.gradient_dict.get(parameter, {})
+
+    def to_df(self):
+        import pandas as pd
+        junction_list = list(self.affected_dict.keys())
+        df_dict = {"junction": junction_list}
+        for parameter, gradient_dict in self.gradient_dict.items():
+            df_dict[f"{parameter} gradient (h/s)"] = [gradient_dict.get(junction_id, np.nan)
+                                                      for junction_id in junction_list]
+        df_dict["re-predicted movements"] = [self.affected_dict[junction_id] for junction_id in junction_list]
+        return pd.DataFrame(df_dict)
+
+
+class _PerturbationContext(object):
+    """
+    Prediction arguments & dependency order shared by the perturbations of a tod (sent once to each worker)
+    """
+    def __init__(self, net_dict, tod_name, green_dict, cycle_dict, global_cycle, use_predicted_arrival,
+                 stop_weight, through_cost_only=False, max_super_iterations=5, super_stopping_criteria=1e-8):
+        self.tod_name = tod_name
+        self.green_dict = green_dict
+        self.cycle_dict = cycle_dict
+        self.global_cycle = global_cycle
+        self.use_predicted_arrival = use_predicted_arrival
+        self.stop_weight = stop_weight
+        self.through_cost_only = through_cost_only
+        fidelity_super_iterations = get_active_fidelity().max_super_iterations
+        if fidelity_super_iterations is not None:
+            max_super_iterations = min(max_super_iterations, fidelity_super_iterations)
+        self.max_super_iterations = max_super_iterations
+        self.super_stopping_criteria = super_stopping_criteria
+
+        scheduler = _DependencyScheduler(net_dict, tod_name)
+        self.order_dict = {movement_id: idx for idx, movement_id in enumerate(_get_prediction_order(scheduler))}
+        # without the predicted arrivals, a movement only depends on its conflicting movements
+        self.dependent_dict = {}
+        for movement_id, movement_key in zip(scheduler.movement_list, scheduler.movement_key_list):
+            self.dependent_dict[movement_id] = \
+                [scheduler.get_movement_id(dependent_key)
+                 for dependent_key, is_upstream in scheduler.dependent_list[movement_key]
+                 if use_predicted_arrival or not is_upstream]
+
+    def get_affected_movements(self, movement_id_list):
+        """
+        :param movement_id_list: perturbed movements
+        :return: the perturbed movements & all their dependents, in the prediction order
+        """
+        affected_set = set(movement_id_list)
+        queue = deque(movement_id_list)
+        while queue:
+            for dependent_id in self.dependent_dict.get(queue.popleft(), []):
+                if not (dependent_id in affected_set):
+                    affected_set.add(dependent_id)
+                    queue.append(dependent_id)
+        return sorted(affected_set, key=lambda val: self.order_dict[val])
+
+    def has_loop(self, movement_id_list):
+        """
+        :param movement_id_list: movements in the prediction order
+        :return: True if one of the movements depends on a movement of the list predicted after it (or itself)
+        """
+        movement_id_set = set(movement_id_list)
+        for movement_id in movement_id_list:
+            for dependent_id in self.dependent_dict.get(movement_id, []):
+                if dependent_id in movement_id_set and self.order_dict[dependent_id] <= self.order_dict[movement_id]:
+                    return True
+        return False
+
+
+def get_cost_sensitivity(net_dict, tod_name, junction_list=None, parameter_list=None, offset_step=None,
+                         split_step=None, min_green=DEFAULT_MIN_GREEN, stop_weight=30, workers=None,
+                         update_base=True, disp=False, **prediction_kwargs):
+    """
+    Gradient of the hourly cost (delay + stops) of a tod w.r.t. the offset & the major street split of each junction
+
+    :param net_dict:
+    :param tod_name:
+    :param junction_list: all the junctions of the tod if None
+    :param parameter_list: subset of PARAMETER_LIST, all if None
+    :param offset_step: (s) resolution of the network if None
+    :param split_step: (s) resolution of the network if None
+    :param min_green: minimum green of the split perturbations (see JunctionTiming)
+    :param stop_weight: (s) per stop
+    :param workers: number of processes, default: cpu count, evaluated in the current process if <= 1
+    :param update_base: predict the network with the prediction arguments first (the network keeps this prediction),
+        False if the network is already predicted with them
+    :param disp:
+    :param prediction_kwargs: arguments of update_network_prediction of the current timing
+    :return: SensitivityResult
+    """
+    if junction_list is None:
+        junction_list = net_dict.get_junction_list(tod_name)
+    if parameter_list is None:
+        parameter_list = PARAMETER_LIST
+    for parameter in parameter_list:
+        if not (parameter in PARAMETER_LIST):
+            raise ValueError(f"Unknown parameter {parameter}, available: {PARAMETER_LIST}")
+    if offset_step is None:
+        offset_step = net_dict.resolution
+    if split_step is None:
+        split_step = net_dict.resolution
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if update_base:
+        update_network_prediction(net_dict, tod_name, **prediction_kwargs)
+    base_delay, base_stops = get_network_hourly_cost(net_dict, tod_name, stop_weight)
+    context = get_perturbation_context(net_dict, tod_name, stop_weight, **prediction_kwargs)
+
+    # perturbation tasks: (junction_id, additional offset, green dict of the junction), None if infeasible
+    task_list = []
+    task_index_dict = {}        # key: (parameter, junction_id), val: index of the - & + tasks
+    affected_dict = {}
+    for junction_id in junction_list:
+        movement_dict = net_dict.get_junction_movement_dict(tod_name, junction_id)
+        affected_dict[junction_id] = len(context.get_affected_movements(list(movement_dict.keys())))
+        if OFFSET_PARAMETER in parameter_list:
+            current_offset = list(movement_dict.values())[0].additional_offset or 0
+            task_index_dict[(OFFSET_PARAMETER, junction_id)] = (len(task_list), len(task_list) + 1)
+            task_list += [(junction_id, current_offset - offset_step, None),
+                          (junction_id, current_offset + offset_step, None)]
+        if SPLIT_PARAMETER in parameter_list:
+            timing = JunctionTiming(net_dict, tod_name, junction_id, min_green=min_green,
+                                    green_dict=context.green_dict)
+            task_index_dict[(SPLIT_PARAMETER, junction_id)] = (len(task_list), len(task_list) + 1)
+            for major_split in [timing.get_major_split() - split_step, timing.get_major_split() + split_step]:
+                timing_plan = timing.with_major_split(major_split)
+                task_list.append(None if timing_plan is None else
+                                 (junction_id, None, timing.get_green_dict(*timing_plan)))
+    feasible_list = [task for task in task_list if task is not None]
+
+    if workers <= 1 or len(feasible_list) <= 1:
+        result_list = [_evaluate_perturbation(net_dict, context, *task) for task in feasible_list]
+    else:
+        # the predicted network of the current timing is sent once to each worker
+        tod_net_dict = net_dict.select_tod(tod_name)
+        with ProcessPoolExecutor(max_workers=min(workers, len(feasible_list)),
+                                 initializer=_init_worker, initargs=(tod_net_dict, context)) as executor:
+            result_list = list(executor.map(_worker_evaluate_perturbation, feasible_list))
+
+    cost_list = []
+    result_iter = iter(result_list)
+    for task in task_list:
+        cost_list.append(np.nan if task is None else sum(next(result_iter)))
+
+    base_cost = base_delay + base_stops
+    gradient_dict = {parameter: {} for parameter in parameter_list}
+    for (parameter, junction_id), (lower_index, upper_index) in task_index_dict.items():
+        step = offset_step if parameter == OFFSET_PARAMETER else split_step
+        gradient_dict[parameter][junction_id] = _get_difference(cost_list[lower_index], base_cost,
+                                                                cost_list[upper_index], step)
+    result = SensitivityResult(base_delay, base_stops, gradient_dict,
+                               {OFFSET_PARAMETER: offset_step, SPLIT_PARAMETER: split_step}, affected_dict)
+    if disp:
+        print(f"Base cost of {tod_name}: {np.round(base_cost, 4)} h, {len(feasible_list)} perturbations, "
+              f"{sum([affected_dict[junction_id] for junction_id in junction_list])} re-predicted movements "
+              f"per perturbed parameter in total")
+        print(result.to_df())
+    return result
+
+
+def get_perturbation_context(net_dict, tod_name, stop_weight=30, **prediction_kwargs):
+    """
+    :param net_dict: predicted with the prediction arguments
+    :param tod_name:
+    :param stop_weight: (s) per stop
+    :param prediction_kwargs: arguments of update_network_prediction
+    :return: _PerturbationContext of the prediction
+    """
+    return _PerturbationContext(net_dict, tod_name, dict(prediction_kwargs.get("green_dict") or {}),
+                                dict(prediction_kwargs.get("cycle_dict") or {}),
+                                prediction_kwargs.get("global_cycle"),
+                                prediction_kwargs.get("use_predicted_arrival", True), stop_weight,
+                                through_cost_only=prediction_kwargs.get("through_cost_only", False),
+                                max_super_iterations=prediction_kwargs.get("max_super_iterations", 5),
+                                super_stopping_criteria=prediction_kwargs.get("super_stopping_criteria", 1e-8))
+
+
+def _get_difference(lower_cost, base_cost, upper_cost, step):
+    """
+    Central difference, one-sided if one of the perturbations is infeasible
+    """
+    if not np.isnan(lower_cost) and not np.isnan(upper_cost):
+        return (upper_cost - lower_cost) / (2 * step)
+    if not np.isnan(upper_cost):
+        return (upper_cost - base_cost) / step
+    if not np.isnan(lower_cost):
+        return (base_cost - lower_cost) / step
+    return np.nan
+
+
+def _get_prediction_order(scheduler):
+    """
+    Order of the movements of the first super iteration of update_network_prediction,
+        the movements of a dependency loop follow the augmented readiness (then the order of the dict)
+
+    :param scheduler: _DependencyScheduler
+    :return: list of movement ids
+    """
+    scheduler.reset()
+    order_list = []
+    while True:
+        while scheduler.ready_queue:
+            movement_key = scheduler.ready_queue.popleft()
+            if scheduler.is_processed(movement_key):
+                continue
+            order_list.append(scheduler.get_movement_id(movement_key))
+            scheduler.mark_processed(movement_key)
+        if scheduler.remaining_number() == 0:
+            break
+        unprocessed_list = [movement_key for movement_key in scheduler.movement_key_list
+                            if not scheduler.is_processed(movement_key)]
+        ready_list = [movement_key for movement_key in unprocessed_list if scheduler.is_augment_ready(movement_key)]
+        for movement_key in (ready_list or unprocessed_list[:1]):
+            if scheduler.is_processed(movement_key):
+                continue
+            order_list.append(scheduler.get_movement_id(movement_key))
+            scheduler.mark_processed(movement_key)
+    scheduler.reset()
+    return order_list
+
+
+def _evaluate_perturbation(net_dict, context, junction_id, additional_offset, junction_green_dict):
+    """
+    Hourly cost of a perturbed junction, only the affected movements are re-predicted & rolled back,
+        iterated as the super iterations of update_network_prediction if they contain a dependency loop
+
+    :param net_dict: predicted with the current timing
+    :param context: _PerturbationContext
+    :param junction_id:
+    :param additional_offset: new offset of the junction, unchanged if None
+    :param junction_green_dict: new green times of the movements of the junction, unchanged if None
+    :return: delay (h), stops (h equivalence)
+    """
+    tod_name = context.tod_name
+    movement_dict = net_dict.get_junction_movement_dict(tod_name, junction_id)
+    affected_list = context.get_affected_movements(list(movement_dict.keys()))
+    green_dict = context.green_dict
+    if junction_green_dict is not None:
+        green_dict = dict(green_dict)
+        green_dict.update(junction_green_dict)
+    with net_dict.trial(tod_name, affected_list):
+        if additional_offset is not None:
+            for movement_curve in movement_dict.values():
+                movement_curve.additional_offset = additional_offset
+        predict_affected_movements(net_dict, context, affected_list, green_dict)
+        return get_network_hourly_cost(net_dict, tod_name, context.stop_weight)
+
+
+def predict_affected_movements(net_dict, context, affected_list, green_dict=None):
+    """
+    Re-predict the affected movements of a perturbation in the dependency order, iterated as the super iterations
+        of update_network_prediction if they contain a dependency loop (the other movements keep their prediction)
+
+    :param net_dict:
+    :param context: _PerturbationContext
+    :param affected_list: output of context.get_affected_movements
+    :param green_dict: green times of the prediction, the ones of the context if None
+    :return: number of iterations
+    """
+    tod_name = context.tod_name
+    if green_dict is None:
+        green_dict = context.green_dict
+    super_iterations = context.max_super_iterations if context.has_loop(affected_list) else 1
+    prv_movement_metric_dict = {}
+    iteration = 0
+    for iteration in range(1, super_iterations + 1):
+        movement_metric_dict = {}
+        for movement_id in affected_list:
+            movement_curve = net_dict.dict[movement_id][tod_name]
+            _predict_movement(net_dict, movement_id, movement_curve, green_dict, context.cycle_dict,
+                              context.global_cycle, context.use_predicted_arrival)
+            if context.through_cost_only and not (movement_curve.movement_index in [2, 4, 6, 8]):
+                continue
+            _movement_metric(movement_id, movement_curve, movement_metric_dict)
+        if _get_cali_diff(prv_movement_metric_dict, movement_metric_dict) <= context.super_stopping_criteria:
+            break
+        prv_movement_metric_dict = movement_metric_dict
+    return iteration
+
+
+def _init_worker(net_dict, context):
+    global _worker_net_dict, _worker_context
+    _worker_net_dict = net_dict
+    _worker_context = context
+
+
+def _worker_evaluate_perturbation(task):
+    return _evaluate_perturbation(_worker_net_dict, _worker_context, *task)
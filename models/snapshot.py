@@ -0,0 +1,96 @@
+"""
+Snapshot & rollback of the prediction state of a network
+
+The prediction (update_network_prediction) replaces the spat parameters, the histograms (re-binned when
+the cycle length changes), the prob & predicted curves and the metrics of the movements by new objects.
+A snapshot keeps the references to the current objects, so taking a snapshot & rolling back cost a
+shallow copy of the attributes per movement, and the extra memory is at most one predicted state
+whatever the number of evaluated plans. The calibration data (raw trajectories & fine histograms)
+are shared between the snapshots, they are not modified by the prediction.
+"""
+
+from contextlib import contextmanager
+
+# shared by all the snapshots, not modified by the prediction
+SHARED_MOVEMENT_ATTRIBUTE_LIST = ["arrival_curve", "departure_curve", "fine_hist"]
+SHARED_CURVE_ATTRIBUTE_LIST = ["raw_data_list", "raw_data_dict"]
+
+
+class NetworkSnapshot(object):
+    """
+    Prediction state of the movements of a network (or of a tod)
+    """
+    def __init__(self, net_dict, tod_name=None, movement_id_list=None):
+        """
+        :param net_dict:
+        :param tod_name: all the tods if None
+        :param movement_id_list: only these movements of the tod (e.g., the movements re-predicted
+            after a local change), all the movements if None
+        """
+        self.tod_name = tod_name
+        # the network resolution follows the movements (e.g., a coarse screening fidelity)
+        self.resolution = net_dict.resolution
+        self.state_dict = {}        # key: (movement_id, tod_name), val: (movement, arrival, departure) state
+        for movement_curve in _iter_movement_curves(net_dict, tod_name, movement_id_list):
+            self.state_dict[(movement_curve.movement_id, movement_curve.tod_name)] = \
+                (_get_state(movement_curve, SHARED_MOVEMENT_ATTRIBUTE_LIST),
+                 _get_state(movement_curve.arrival_curve, SHARED_CURVE_ATTRIBUTE_LIST),
+                 _get_state(movement_curve.departure_curve, SHARED_CURVE_ATTRIBUTE_LIST))
+
+    def restore(self, net_dict):
+        """
+        Restore the state of the movements (the movements added after the snapshot are not modified)
+            & the resolution of the network
+
+        :param net_dict:
+        :return:
+        """
+        for (movement_id, tod_name), (movement_state, arrival_state, departure_state) in self.state_dict.items():
+            movement_curve = net_dict.get_movement_tod_curve(movement_id, tod_name)
+            if movement_curve is None:
+                continue
+            _set_state(movement_curve, movement_state)
+            _set_state(movement_curve.arrival_curve, arrival_state)
+            _set_state(movement_curve.departure_curve, departure_state)
+        net_dict.resolution = self.resolution
+        return net_dict
+
+
+def _iter_movement_curves(net_dict, tod_name, movement_id_list=None):
+    if movement_id_list is not None:
+        return [net_dict.get_movement_tod_curve(movement_id, tod_name) for movement_id in movement_id_list]
+    if tod_name is not None:
+        return list(net_dict.get_tod_movement_dict(tod_name).values())
+    return [movement_curve for movement_dict in net_dict.dict.values() for movement_curve in movement_dict.values()]
+
+
+def _get_state(obj, shared_attribute_list):
+    state = {}
+    for k, v in obj.__dict__.items():
+        if k in shared_attribute_list:
+            continue
+        # dicts are updated in place by the arrival calibration
+        state[k] = dict(v) if isinstance(v, dict) else v
+    return state
+
+
+def _set_state(obj, state):
+    for k, v in state.items():
+        setattr(obj, k, dict(v) if isinstance(v, dict) else v)
+
+
+@contextmanager
+def trial_context(net_dict, tod_name=None, movement_id_list=None):
+    """
+    Rollback the network at the end of the block, e.g., to evaluate a candidate plan
+
+    :param net_dict:
+    :param tod_name:
+    :param movement_id_list: only these movements of the tod, all the movements if None
+    :return:
+    """
+    snapshot = NetworkSnapshot(net_dict, tod_name, movement_id_list)
+    try:
+        yield snapshot
+    finally:
+        snapshot.restore(net_dict)
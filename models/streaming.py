@@ -0,0 +1,332 @@
+"""
+Streaming ingestion of trajectories
+
+The trajectories are added to the histograms of the movements one by one (or by micro-batches) without
+re-binning the history. The contribution of every date is kept in a bucket so that the old dates can be
+expired (rolling window) by subtracting their histograms & totals.
+
+Record (dict):
+    {"movement_id": , "tod_name": , "date": , "arrival_time": , "departure_time": ,
+     "origin_id": "null", "control_delay": departure - arrival, "stops": 0, "stop_delay": 0}
+    arrival & departure times are the time within the tod (as in raw_data_list)
+In the compact mode (MovementNetDict.compact), the trajectories are added to the fine histograms of the movement
+& of the bucket instead of the raw data.
+"""
+
+import numpy as np
+
+from models.fine_hist import FineHistogram
+from models.metrics import estimate_movement_delay
+from models.movement_model import get_arrival_hist_index, get_hist_indexes, \
+    _update_movement_hist_curves, _update_movement_prob_curves
+
+HISTORY_DATE = None         # date key of the trajectories loaded before the streaming
+TOTAL_ATTRIBUTE_LIST = ["total_trajs", "total_control_delay", "total_stopped_trajs",
+                        "total_stops", "total_stop_delay"]
+
+
+class StreamingIngestor(object):
+    """
+    Online update of the histograms, prob curves & ground truth totals of a network
+    """
+    def __init__(self, net_dict, window_days=None, expire_history=True):
+        """
+
+        :param net_dict: MovementNetDict, updated in place
+        :param window_days: number of streamed dates kept, no expiration if None
+        :param expire_history: expire the trajectories loaded before the streaming (of the movements
+            receiving streamed trajectories) once the window is full of streamed dates
+        """
+        self.net_dict = net_dict
+        self.window_days = window_days
+        self.expire_history = expire_history
+        self.bucket_dict = {}       # key: (movement_id, tod_name), val: {date: _DateBucket}
+        self.date_list = []         # streamed dates, sorted
+        # dates of the trajectories loaded before the streaming, removed from the network with the history
+        self.history_date_list = list(net_dict.date_list)
+        self.unknown_record_number = 0
+
+    def ingest_one(self, record):
+        """
+        :param record: see the module docstring
+        :return: list of (movement_id, tod_name) updated
+        """
+        return self.ingest([record])
+
+    def ingest(self, record_list):
+        """
+        Ingest a micro-batch, the prob curves are updated once per movement at the end of the batch
+
+        :param record_list:
+        :return: list of (movement_id, tod_name) updated, their prediction is outdated
+        """
+        touched_dict = {}
+        for record in record_list:
+            movement_curve = self.net_dict.get_movement_tod_curve(record["movement_id"], record["tod_name"])
+            if movement_curve is None:
+                self.unknown_record_number += 1
+                continue
+            bucket = self._get_bucket(movement_curve, record["date"])
+            self._add_record(movement_curve, bucket, record)
+            touched_dict[(movement_curve.movement_id, movement_curve.tod_name)] = movement_curve
+
+        if self.window_days is not None:
+            while len(self.date_list) > self.window_days:
+                touched_dict.update(self._expire_date(self.date_list[0]))
+            if self.expire_history and len(self.date_list) >= self.window_days:
+                touched_dict.update(self._expire_date(HISTORY_DATE))
+
+        for movement_curve in touched_dict.values():
+            _refresh_movement_curves(movement_curve, self.bucket_dict[(movement_curve.movement_id,
+                                                                       movement_curve.tod_name)])
+        return list(touched_dict.keys())
+
+    def expire_before(self, date):
+        """
+        Expire the streamed dates before a date (and the history if expire_history)
+
+        :param date:
+        :return: list of (movement_id, tod_name) updated
+        """
+        touched_dict = {}
+        for local_date in [val for val in self.date_list if val < date]:
+            touched_dict.update(self._expire_date(local_date))
+        if self.expire_history:
+            touched_dict.update(self._expire_date(HISTORY_DATE))
+        for movement_curve in touched_dict.values():
+            _refresh_movement_curves(movement_curve, self.bucket_dict[(movement_curve.movement_id,
+                                                                       movement_curve.tod_name)])
+        return list(touched_dict.keys())
+
+    def _get_bucket(self, movement_curve, date):
+        key = (movement_curve.movement_id, movement_curve.tod_name)
+        if not (key in self.bucket_dict.keys()):
+            self.bucket_dict[key] = {HISTORY_DATE: _history_bucket(movement_curve)}
+        movement_bucket_dict = self.bucket_dict[key]
+        if not (date in movement_bucket_dict.keys()):
+            movement_bucket_dict[date] = _DateBucket(movement_curve, number_of_dates=1)
+            if not (date in self.date_list):
+                self.date_list = sorted(self.date_list + [date])
+                if not (date in self.net_dict.date_list):
+                    self.net_dict.date_list.append(date)
+        return movement_bucket_dict[date]
+
+    def _add_record(self, movement_curve, bucket, record):
+        arrival_time = record["arrival_time"]
+        departure_time = record["departure_time"]
+        origin_id = record.get("origin_id", "null")
+        arrival_curve = movement_curve.arrival_curve
+        departure_curve = movement_curve.departure_curve
+
+        bucket.check_binning(movement_curve)
+        if movement_curve.fine_hist is not None:
+            # binned as the fine histogram will be folded
+            arrival_time = movement_curve.fine_hist.get_bin_center(arrival_time)
+            departure_time = movement_curve.fine_hist.get_bin_center(departure_time)
+        arrival_index, departure_index = get_hist_indexes(movement_curve, arrival_time, departure_time)
+        arrival_curve.curve_list[arrival_index] += 1
+        departure_curve.curve_list[departure_index] += 1
+        bucket.arrival_array[arrival_index] += 1
+        bucket.departure_array[departure_index] += 1
+        # the minor origins might have been merged into "null" by the calibration
+        origin_curve_dict = arrival_curve.origin_curve_dict
+        if not (origin_id in origin_curve_dict.keys()):
+            arrival_curve.set_origin_row(origin_id, np.zeros(arrival_curve.dimension, dtype=int))
+            origin_curve_dict = arrival_curve.origin_curve_dict
+        # the rows of the dict view are modified in place with the origin array
+        origin_curve_dict[origin_id][arrival_index] += 1
+        if not (origin_id in bucket.origin_array_dict.keys()):
+            bucket.origin_array_dict[origin_id] = np.zeros(arrival_curve.dimension)
+        bucket.origin_array_dict[origin_id][arrival_index] += 1
+
+        if movement_curve.fine_hist is not None:
+            movement_curve.fine_hist.add(arrival_time, departure_time, origin_id)
+            bucket.fine_hist.add(arrival_time, departure_time, origin_id)
+        else:
+            arrival_curve.raw_data_list.append(arrival_time)
+            departure_curve.raw_data_list.append(departure_time)
+            if not (origin_id in arrival_curve.raw_data_dict.keys()):
+                arrival_curve.raw_data_dict[origin_id] = []
+            arrival_curve.raw_data_dict[origin_id].append(arrival_time)
+            bucket.arrival_list.append(arrival_time)
+            bucket.departure_list.append(departure_time)
+            bucket.origin_list.append(origin_id)
+
+        stops = record.get("stops", 0)
+        total_dict = {"total_trajs": 1,
+                      "total_control_delay": record.get("control_delay", departure_time - arrival_time),
+                      "total_stopped_trajs": int(stops > 0),
+                      "total_stops": stops,
+                      "total_stop_delay": record.get("stop_delay", 0)}
+        for attr, val in total_dict.items():
+            setattr(movement_curve, attr, getattr(movement_curve, attr) + val)
+            bucket.total_dict[attr] += val
+
+    def _expire_date(self, date):
+        """
+        Subtract the bucket of a date from all the movements
+
+        :param date:
+        :return: {(movement_id, tod_name): movement_curve}
+        """
+        touched_dict = {}
+        for (movement_id, tod_name), movement_bucket_dict in self.bucket_dict.items():
+            if not (date in movement_bucket_dict.keys()):
+                continue
+            movement_curve = self.net_dict.get_movement_tod_curve(movement_id, tod_name)
+            bucket = movement_bucket_dict.pop(date)
+            bucket.check_binning(movement_curve)
+            _subtract_bucket(movement_curve, bucket, movement_bucket_dict)
+            touched_dict[(movement_id, tod_name)] = movement_curve
+        if date in self.date_list:
+            self.date_list.remove(date)
+            if date in self.net_dict.date_list:
+                self.net_dict.date_list.remove(date)
+        if date == HISTORY_DATE and len(touched_dict) > 0:
+            for history_date in self.history_date_list:
+                if history_date in self.net_dict.date_list and not (history_date in self.date_list):
+                    self.net_dict.date_list.remove(history_date)
+            self.history_date_list = []
+        return touched_dict
+
+
+class _DateBucket(object):
+    """
+    Contribution of a date to the curves of a movement
+    """
+    def __init__(self, movement_curve, number_of_dates=1):
+        self.number_of_dates = number_of_dates
+        self.binning = _get_binning(movement_curve)
+        self.arrival_array = np.zeros(movement_curve.arrival_curve.dimension)
+        self.departure_array = np.zeros(movement_curve.departure_curve.dimension)
+        self.origin_array_dict = {}
+        self.total_dict = {attr: 0 for attr in TOTAL_ATTRIBUTE_LIST}
+        # trajectories of the bucket, fine histogram in the compact mode
+        self.arrival_list = []
+        self.departure_list = []
+        self.origin_list = []
+        self.fine_hist = None
+        if movement_curve.fine_hist is not None:
+            self.fine_hist = FineHistogram(movement_curve.fine_hist.fine_resolution)
+
+    def check_binning(self, movement_curve):
+        """
+        Re-bin the trajectories of the bucket if the offset/cycle/resolution changed since the bucket was created
+            (the curves of the movement are re-binned by update_movement_model)
+
+        :param movement_curve:
+        :return:
+        """
+        if self.binning == _get_binning(movement_curve):
+            return
+        self.binning = _get_binning(movement_curve)
+        arrival_dimension = movement_curve.arrival_curve.dimension
+        departure_dimension = movement_curve.departure_curve.dimension
+        if self.fine_hist is not None:
+            origin_curve_dict, arrival_curve_list, departure_curve_list = \
+                self.fine_hist.fold(movement_curve.offset, movement_curve.cycle_length, movement_curve.resolution,
+                                    arrival_dimension, departure_dimension)
+            self.arrival_array = np.array(arrival_curve_list, dtype=float)
+            self.departure_array = np.array(departure_curve_list, dtype=float)
+            self.origin_array_dict = {origin_id: np.array(curve_list, dtype=float)
+                                      for origin_id, curve_list in origin_curve_dict.items()}
+            return
+        self.arrival_array = np.zeros(arrival_dimension)
+        self.departure_array = np.zeros(departure_dimension)
+        self.origin_array_dict = {}
+        for arrival_time, departure_time, origin_id in zip(self.arrival_list, self.departure_list,
+                                                           self.origin_list):
+            arrival_index, departure_index = get_hist_indexes(movement_curve, arrival_time, departure_time)
+            self.arrival_array[arrival_index] += 1
+            self.departure_array[departure_index] += 1
+            if not (origin_id in self.origin_array_dict.keys()):
+                self.origin_array_dict[origin_id] = np.zeros(arrival_dimension)
+            self.origin_array_dict[origin_id][get_arrival_hist_index(movement_curve, arrival_time)] += 1
+
+
+def _get_binning(movement_curve):
+    return (movement_curve.offset, movement_curve.cycle_length, movement_curve.resolution,
+            movement_curve.departure_cycles)
+
+
+def _history_bucket(movement_curve):
+    """
+    Bucket of the trajectories loaded before the streaming
+
+    :param movement_curve:
+    :return:
+    """
+    if movement_curve.arrival_curve.dimension is None:
+        _update_movement_hist_curves(movement_curve)
+    arrival_curve = movement_curve.arrival_curve
+    departure_curve = movement_curve.departure_curve
+    bucket = _DateBucket(movement_curve, number_of_dates=movement_curve.number_of_dates or 0)
+    bucket.arrival_array = np.array(arrival_curve.curve_list, dtype=float)
+    bucket.departure_array = np.array(departure_curve.curve_list, dtype=float)
+    bucket.origin_array_dict = {origin_id: np.array(curve_list, dtype=float)
+                                for origin_id, curve_list in arrival_curve.origin_curve_dict.items()}
+    bucket.total_dict = {attr: getattr(movement_curve, attr) for attr in TOTAL_ATTRIBUTE_LIST}
+    if movement_curve.fine_hist is not None:
+        bucket.fine_hist = movement_curve.fine_hist.copy()
+    else:
+        bucket.arrival_list = list(arrival_curve.raw_data_list)
+        bucket.departure_list = list(departure_curve.raw_data_list)
+        bucket.origin_list = arrival_curve.get_raw_origin_list()
+    return bucket
+
+
+def _subtract_bucket(movement_curve, bucket, remaining_bucket_dict):
+    """
+    Remove the contribution of a bucket from the curves of a movement
+
+    :param movement_curve:
+    :param bucket:
+    :param remaining_bucket_dict: {date: bucket} left for the movement, used to rebuild the raw data
+    :return:
+    """
+    arrival_curve = movement_curve.arrival_curve
+    departure_curve = movement_curve.departure_curve
+    arrival_curve.curve_list = _subtract_list(arrival_curve.curve_list, bucket.arrival_array)
+    departure_curve.curve_list = _subtract_list(departure_curve.curve_list, bucket.departure_array)
+    origin_curve_dict = arrival_curve.origin_curve_dict
+    for origin_id, origin_array in bucket.origin_array_dict.items():
+        if not (origin_id in origin_curve_dict.keys()):
+            # merged into the uncoordinated origin by the calibration
+            origin_id = "null"
+            if not (origin_id in origin_curve_dict.keys()):
+                continue
+        origin_curve_dict[origin_id][:] = _subtract_list(origin_curve_dict[origin_id], origin_array)
+    for attr in TOTAL_ATTRIBUTE_LIST:
+        setattr(movement_curve, attr, getattr(movement_curve, attr) - bucket.total_dict[attr])
+
+    if movement_curve.fine_hist is not None:
+        movement_curve.fine_hist.subtract(bucket.fine_hist)
+        return
+
+    arrival_list, departure_list, raw_data_dict = [], [], {}
+    for local_bucket in remaining_bucket_dict.values():
+        arrival_list += local_bucket.arrival_list
+        departure_list += local_bucket.departure_list
+        for arrival_time, origin_id in zip(local_bucket.arrival_list, local_bucket.origin_list):
+            raw_data_dict.setdefault(origin_id, []).append(arrival_time)
+    arrival_curve.raw_data_list = arrival_list
+    departure_curve.raw_data_list = departure_list
+    arrival_curve.raw_data_dict = raw_data_dict
+
+
+def _subtract_list(curve_list, bucket_array):
+    return np.maximum(np.array(curve_list) - bucket_array, 0).astype(int).tolist()
+
+
+def _refresh_movement_curves(movement_curve, movement_bucket_dict):
+    """
+    Update the number of dates, the aggregated curves & the prob curves after new trajectories
+
+    :param movement_curve:
+    :param movement_bucket_dict:
+    :return:
+    """
+    movement_curve.number_of_dates = sum([val.number_of_dates for val in movement_bucket_dict.values()])
+    movement_curve.hist_avg_delay = estimate_movement_delay(movement_curve, prob=False)
+    movement_curve.departure_curve.agg_curves()
+    _update_movement_prob_curves(movement_curve)
@@ -0,0 +1,571 @@
+"""
+Green split & cycle length optimization
+
+The signal timing of a junction follows the NEMA ring & barrier structure: the phases of a ring run one after the
+other, and both rings cross a barrier at the same time. The major street barrier contains the phases 1, 2, 5, 6
+and the minor street barrier the phases 3, 4, 7, 8. A candidate timing is converted to the green_dict of
+update_network_prediction. A permissive left turn runs with the opposing through phase. The splits are searched at two
+levels: the barrier split (major street vs minor street, the phases of a ring keep their shares) and the split of a
+phase within its ring (the other phases of the ring share the rest of the ring, the barriers are unchanged).
+
+The candidates are evaluated on a process pool. Each worker receives the network once (read-only calibration
+data) and evaluates every candidate in a trial (rolled back after the prediction). The outputs are the cost
+tables of plot.plotter.Plotter.plot_cost_wrt_green_split & plot_cost_wrt_cycle_length.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from models.metrics import get_network_hourly_cost
+from models.net_model import update_network_prediction
+from models.scenario_cache import get_network_key, get_scenario_key
+
+# barrier -> ring -> phases (movement index)
+RING_BARRIER_LIST = [[[1, 2], [5, 6]], [[3, 4], [7, 8]]]
+OPPOSING_THROUGH_DICT = {1: 6, 5: 2, 3: 8, 7: 4}
+DEFAULT_MIN_GREEN = 5
+
+GREEN_SPLIT_COLUMN = "major split (s)"
+PHASE_SPLIT_COLUMN = "phase split (s)"
+CYCLE_LENGTH_COLUMN = "cycle length (s)"
+GREEN_SPLIT_DELAY_COLUMN = "delay (h)"
+CYCLE_LENGTH_DELAY_COLUMN = "delay (hr)"
+STOP_COLUMN = "stops (hr equivalence)"
+GRADIENT_COLUMN = "gradient cost (h)"
+
+_worker_net_dict = None
+
+
+class JunctionTiming(object):
+    """
+    Ring & barrier timing of a junction, read from the current green times of its movements
+    """
+    def __init__(self, net_dict, tod_name, junction_id, min_green=DEFAULT_MIN_GREEN, green_dict=None):
+        """
+        :param net_dict:
+        :param tod_name:
+        :param junction_id:
+        :param min_green: minimum green (s) of each phase, the yellow & clearance intervals are added
+        :param green_dict: green times of update_network_prediction replacing the ones of the movements (if any)
+        """
+        if green_dict is None:
+            green_dict = {}
+        self.junction_id = junction_id
+        movement_dict = net_dict.get_junction_movement_dict(tod_name, junction_id)
+        if len(movement_dict) == 0:
+            raise ValueError(f"No movement of junction {junction_id} at {tod_name}")
+        self.cycle_length = list(movement_dict.values())[0].cycle_length
+
+        self.movement_phase_dict = {}       # key: movement_id, val: phase of its green time
+        self.phase_split_dict = {}          # key: phase, val: split (s)
+        self.min_split_dict = {}            # key: phase, val: minimum split (s)
+        phase_start_dict = {}
+        for movement_id, movement_curve in movement_dict.items():
+            phase = movement_curve.movement_index
+            if movement_curve.permissive_type == "lt_turn_permissive" and phase in OPPOSING_THROUGH_DICT.keys():
+                phase = OPPOSING_THROUGH_DICT[phase]
+            self.movement_phase_dict[movement_id] = phase
+            green_time = green_dict.get(movement_id, movement_curve.green_time)
+            if phase != movement_curve.movement_index or not green_time:
+                continue
+            green_start, split = green_time[0]
+            self.phase_split_dict[phase] = max(self.phase_split_dict.get(phase, 0), split)
+            phase_start_dict[phase] = green_start
+            self.min_split_dict[phase] = max(self.min_split_dict.get(phase, 0),
+                                             min_green + movement_curve.yellow_change_interval +
+                                             movement_curve.clearance_interval)
+        if len(self.phase_split_dict) == 0:
+            raise ValueError(f"No protected phase with a green time at junction {junction_id}")
+
+        # phases of each ring in each barrier, in the current sequence
+        self.barrier_ring_list = []
+        for barrier_rings in RING_BARRIER_LIST:
+            self.barrier_ring_list.append(
+                [sorted([phase for phase in ring if phase in self.phase_split_dict.keys()],
+                        key=lambda val: phase_start_dict[val]) for ring in barrier_rings])
+        # the barriers start with their earliest phase, the time between the end of a ring & the next barrier
+        #   (e.g., an unused left turn phase) is kept, the first barrier start is the reference of the offset
+        barrier_start_list = [min([phase_start_dict[phase] for ring in barrier for phase in ring])
+                              for barrier in self.barrier_ring_list if sum([len(ring) for ring in barrier]) > 0]
+        self.reference_start = barrier_start_list[0]
+        if len(barrier_start_list) == 2:
+            major_split = (barrier_start_list[1] - barrier_start_list[0]) % self.cycle_length
+        else:
+            major_split = self.cycle_length if len(self.barrier_ring_list[0][0] + self.barrier_ring_list[0][1]) \
+                else 0
+        self.barrier_length_list = [major_split, self.cycle_length - major_split]
+
+    def get_major_split(self):
+        return self.barrier_length_list[0]
+
+    def check_constraints(self, phase_split_dict, barrier_length_list, cycle_length):
+        """
+        :param phase_split_dict:
+        :param barrier_length_list: length (s) of each barrier
+        :param cycle_length:
+        :return: True if the minimum splits & the ring constraints (each ring within its barrier) are satisfied
+        """
+        for phase, split in phase_split_dict.items():
+            if split < self.min_split_dict[phase] - 1e-6:
+                return False
+        for barrier, barrier_length in zip(self.barrier_ring_list, barrier_length_list):
+            for ring in barrier:
+                if sum([phase_split_dict[phase] for phase in ring]) > barrier_length + 1e-6:
+                    return False
+        return abs(sum(barrier_length_list) - cycle_length) <= 1e-6
+
+    def get_phase_splits(self, barrier_length_list):
+        """
+        Splits with the given barrier lengths: each ring keeps its share of the barrier & the time above
+            the minimum splits of a ring is shared in proportion to the current splits
+
+        :param barrier_length_list: length (s) of each barrier
+        :return: phase split dict, None if infeasible
+        """
+        phase_split_dict = {}
+        for barrier, current_length, barrier_length in \
+                zip(self.barrier_ring_list, self.barrier_length_list, barrier_length_list):
+            for ring in barrier:
+                if len(ring) == 0:
+                    continue
+                min_length = sum([self.min_split_dict[phase] for phase in ring])
+                current_ring_length = sum([self.phase_split_dict[phase] for phase in ring])
+                ring_length = current_ring_length * barrier_length / max(current_length, 1e-6)
+                if ring_length < min_length - 1e-6:
+                    return None
+                current_extra = current_ring_length - min_length
+                for phase in ring:
+                    if current_extra > 0:
+                        share = (self.phase_split_dict[phase] - self.min_split_dict[phase]) / current_extra
+                    else:
+                        share = 1 / len(ring)
+                    phase_split_dict[phase] = self.min_split_dict[phase] + share * (ring_length - min_length)
+        return phase_split_dict
+
+    def with_major_split(self, major_split, cycle_length=None):
+        """
+        :param major_split: length of the major street barrier (s), the minor barrier gets the rest of the cycle
+        :param cycle_length: current cycle if None
+        :return: phase split dict & barrier lengths, None if infeasible
+        """
+        if cycle_length is None:
+            cycle_length = self.cycle_length
+        if not (0 < major_split <= cycle_length):
+            return None
+        barrier_length_list = [major_split, cycle_length - major_split]
+        phase_split_dict = self.get_phase_splits(barrier_length_list)
+        if phase_split_dict is None or not self.check_constraints(phase_split_dict, barrier_length_list,
+                                                                  cycle_length):
+            return None
+        return phase_split_dict, barrier_length_list
+
+    def get_ring(self, phase):
+        """
+        :param phase:
+        :return: index of the barrier & phases of the ring of a phase
+        """
+        for barrier_index, barrier in enumerate(self.barrier_ring_list):
+            for ring in barrier:
+                if phase in ring:
+                    return barrier_index, ring
+        raise ValueError(f"Phase {phase} has no split at junction {self.junction_id}")
+
+    def with_phase_split(self, phase, split):
+        """
+        Split of a phase within its ring: the ring length & the barriers are unchanged, the time above the minimum
+            splits of the other phases of the ring is shared in proportion to their current splits
+
+        :param phase:
+        :param split: (s)
+        :return: phase split dict & barrier lengths, None if infeasible
+        """
+        _, ring = self.get_ring(phase)
+        other_list = [val for val in ring if val != phase]
+        ring_length = sum([self.phase_split_dict[val] for val in ring])
+        min_length = sum([self.min_split_dict[val] for val in other_list])
+        current_extra = sum([self.phase_split_dict[val] for val in other_list]) - min_length
+        remaining_length = ring_length - split
+        if remaining_length < min_length - 1e-6 or (len(other_list) == 0 and abs(remaining_length) > 1e-6):
+            return None
+        phase_split_dict = dict(self.phase_split_dict)
+        phase_split_dict[phase] = split
+        for other_phase in other_list:
+            if current_extra > 0:
+                share = (self.phase_split_dict[other_phase] - self.min_split_dict[other_phase]) / current_extra
+            else:
+                share = 1 / len(other_list)
+            phase_split_dict[other_phase] = self.min_split_dict[other_phase] + share * (remaining_length - min_length)
+        barrier_length_list = list(self.barrier_length_list)
+        if not self.check_constraints(phase_split_dict, barrier_length_list, self.cycle_length):
+            return None
+        return phase_split_dict, barrier_length_list
+
+    def get_sweep_phases(self):
+        """
+        :return: phases whose split can change within their ring (rings of at least two phases)
+        """
+        return [phase for barrier in self.barrier_ring_list for ring in barrier if len(ring) > 1 for phase in ring]
+
+    def with_cycle_length(self, cycle_length):
+        """
+        :param cycle_length:
+        :return: phase split dict & barrier lengths scaled to the new cycle, None if infeasible
+        """
+        return self.with_major_split(self.barrier_length_list[0] * cycle_length / self.cycle_length, cycle_length)
+
+    def get_green_dict(self, phase_split_dict, barrier_length_list, cycle_length=None):
+        """
+        :param phase_split_dict:
+        :param barrier_length_list:
+        :param cycle_length: current cycle if None
+        :return: {movement_id: [[green start, split]]} for update_network_prediction
+        """
+        if cycle_length is None:
+            cycle_length = self.cycle_length
+        phase_green_dict = {}
+        barrier_start = self.reference_start
+        for barrier, barrier_length in zip(self.barrier_ring_list, barrier_length_list):
+            for ring in barrier:
+                green_start = barrier_start
+                for phase in ring:
+                    phase_green_dict[phase] = [[float(green_start % cycle_length), float(phase_split_dict[phase])]]
+                    green_start += phase_split_dict[phase]
+            barrier_start += barrier_length
+        return {movement_id: phase_green_dict[phase] for movement_id, phase in self.movement_phase_dict.items()
+                if phase in phase_green_dict.keys()}
+
+
+class CostSweep(object):
+    """
+    Hourly delay & stops of the candidates of a sweep
+    """
+    def __init__(self, x_column, delay_column, x_array, delay_array, stop_array, current_x, candidate_list):
+        self.x_column = x_column
+        self.delay_column = delay_column
+        self.x_array = x_array
+        self.delay_array = delay_array
+        self.stop_array = stop_array
+        self.current_x = current_x
+        self.candidate_list = candidate_list
+
+    def get_cost_array(self):
+        return self.delay_array + self.stop_array
+
+    def get_best(self):
+        """
+        :return: best x, candidate (prediction arguments) & cost
+        """
+        cost_array = self.get_cost_array()
+        best_index = int(np.nanargmin(cost_array))
+        return float(self.x_array[best_index]), self.candidate_list[best_index], float(cost_array[best_index])
+
+    def get_gradient(self):
+        """
+        Central difference of the cost around the current value (one-sided at the bounds)
+
+        :return: (h/s)
+        """
+        feasible_mask = ~np.isnan(self.get_cost_array())
+        x_array = self.x_array[feasible_mask]
+        cost_array = self.get_cost_array()[feasible_mask]
+        if len(x_array) < 2:
+            return np.nan
+        index = int(np.argmin(np.abs(x_array - self.current_x)))
+        lower_index = max(index - 1, 0)
+        upper_index = min(index + 1, len(x_array) - 1)
+        return float((cost_array[upper_index] - cost_array[lower_index]) /
+                     (x_array[upper_index] - x_array[lower_index]))
+
+    def get_bar_df(self):
+        import pandas as pd
+        return pd.DataFrame({self.x_column: self.x_array, self.delay_column: self.delay_array,
+                             STOP_COLUMN: self.stop_array})
+
+    def get_line_df(self):
+        """
+        :return: tangent line of the cost at the current value
+        """
+        import pandas as pd
+        current_cost = np.interp(self.current_x, self.x_array, self.get_cost_array())
+        return pd.DataFrame({self.x_column: self.x_array,
+                             GRADIENT_COLUMN: current_cost + self.get_gradient() * (self.x_array - self.current_x)})
+
+
+def sweep_green_split(net_dict, tod_name, junction_id, major_split_list=None, step=None,
+                      min_green=DEFAULT_MIN_GREEN, stop_weight=30, workers=None, checkpoint=None,
+                      **prediction_kwargs):
+    """
+    Cost of the tod w.r.t. the major street split of a junction (the minor street gets the rest of the cycle)
+
+    :param net_dict:
+    :param tod_name:
+    :param junction_id:
+    :param major_split_list: major barrier lengths (s), all the feasible ones with the step if None
+    :param step: (s) resolution of the network if None
+    :param min_green:
+    :param stop_weight:
+    :param workers: number of processes
+    :param checkpoint: models.checkpoint.RunCheckpoint of the evaluated candidates
+    :param prediction_kwargs: other arguments of update_network_prediction
+    :return: CostSweep, the bar_df & line_df of Plotter.plot_cost_wrt_green_split are its get_bar_df() & get_line_df()
+    """
+    timing = JunctionTiming(net_dict, tod_name, junction_id, min_green=min_green,
+                            green_dict=prediction_kwargs.get("green_dict"))
+    if step is None:
+        step = net_dict.resolution
+    if major_split_list is None:
+        major_split_list = np.arange(step, timing.cycle_length, step)
+    x_array = np.array(major_split_list, dtype=float)
+
+    candidate_list = []
+    for major_split in x_array:
+        timing_plan = timing.with_major_split(major_split)
+        if timing_plan is None:
+            candidate_list.append(None)
+            continue
+        green_dict = dict(prediction_kwargs.get("green_dict") or {})
+        green_dict.update(timing.get_green_dict(*timing_plan))
+        candidate_list.append({"green_dict": green_dict})
+    delay_array, stop_array = evaluate_candidates(net_dict, tod_name, candidate_list, stop_weight=stop_weight,
+                                                  workers=workers, checkpoint=checkpoint, **prediction_kwargs)
+    return _feasible_sweep(GREEN_SPLIT_COLUMN, GREEN_SPLIT_DELAY_COLUMN, x_array, delay_array, stop_array,
+                           timing.get_major_split(), candidate_list)
+
+
+def sweep_phase_split(net_dict, tod_name, junction_id, phase, split_list=None, step=None,
+                      min_green=DEFAULT_MIN_GREEN, stop_weight=30, workers=None, checkpoint=None,
+                      **prediction_kwargs):
+    """
+    Cost of the tod w.r.t. the split of a phase within its ring (see JunctionTiming.with_phase_split)
+
+    :param net_dict:
+    :param tod_name:
+    :param junction_id:
+    :param phase: NEMA phase with a split at the junction
+    :param split_list: splits (s) of the phase, all the feasible ones with the step (& the current one) if None
+    :param step: (s) resolution of the network if None
+    :param min_green:
+    :param stop_weight:
+    :param workers: number of processes
+    :param checkpoint: models.checkpoint.RunCheckpoint of the evaluated candidates
+    :param prediction_kwargs: other arguments of update_network_prediction
+    :return: CostSweep
+    """
+    timing = JunctionTiming(net_dict, tod_name, junction_id, min_green=min_green,
+                            green_dict=prediction_kwargs.get("green_dict"))
+    if step is None:
+        step = net_dict.resolution
+    if split_list is None:
+        _, ring = timing.get_ring(phase)
+        ring_length = sum([timing.phase_split_dict[val] for val in ring])
+        # the current split is a candidate, a coordinate search never increases the cost
+        split_list = np.union1d(np.arange(timing.min_split_dict[phase], ring_length + step / 2, step),
+                                [timing.phase_split_dict[phase]])
+    x_array = np.array(split_list, dtype=float)
+
+    candidate_list = []
+    for split in x_array:
+        timing_plan = timing.with_phase_split(phase, split)
+        if timing_plan is None:
+            candidate_list.append(None)
+            continue
+        green_dict = dict(prediction_kwargs.get("green_dict") or {})
+        green_dict.update(timing.get_green_dict(*timing_plan))
+        candidate_list.append({"green_dict": green_dict})
+    delay_array, stop_array = evaluate_candidates(net_dict, tod_name, candidate_list, stop_weight=stop_weight,
+                                                  workers=workers, checkpoint=checkpoint, **prediction_kwargs)
+    return _feasible_sweep(PHASE_SPLIT_COLUMN, GREEN_SPLIT_DELAY_COLUMN, x_array, delay_array, stop_array,
+                           timing.phase_split_dict[phase], candidate_list)
+
+
+def sweep_cycle_length(net_dict, tod_name, cycle_length_list, junction_list=None, min_green=DEFAULT_MIN_GREEN,
+                       stop_weight=30, workers=None, checkpoint=None, **prediction_kwargs):
+    """
+    Cost of the tod w.r.t. the common cycle length of the junctions, the splits are scaled with the cycle
+
+    :param net_dict:
+    :param tod_name:
+    :param cycle_length_list: multiples of the resolution (s)
+    :param junction_list: all the junctions of the tod if None, a subset is rejected (the junctions of a
+        coordinated network share the cycle length)
+    :param min_green:
+    :param stop_weight:
+    :param workers:
+    :param checkpoint: models.checkpoint.RunCheckpoint of the evaluated candidates
+    :param prediction_kwargs:
+    :return: CostSweep, the bar_df & line_df of Plotter.plot_cost_wrt_cycle_length are its get_bar_df() & get_line_df()
+    """
+    all_junction_list = net_dict.get_junction_list(tod_name)
+    if junction_list is None:
+        junction_list = all_junction_list
+    elif set(junction_list) != set(all_junction_list):
+        raise ValueError(f"The cycle length is swept for all the junctions of {tod_name}, "
+                         f"mixed cycle lengths are not supported: {sorted(set(all_junction_list) - set(junction_list))}"
+                         f" are not in the junction list")
+    timing_list = [JunctionTiming(net_dict, tod_name, junction_id, min_green=min_green)
+                   for junction_id in junction_list]
+    x_array = np.array(cycle_length_list, dtype=float)
+    resolution = net_dict.resolution
+    if np.any(np.abs(x_array / resolution - np.round(x_array / resolution)) > 1e-6):
+        raise ValueError(f"The cycle lengths should be multiples of the resolution {resolution}: {cycle_length_list}")
+
+    candidate_list = []
+    for cycle_length in x_array:
+        green_dict = dict(prediction_kwargs.get("green_dict") or {})
+        cycle_dict = dict(prediction_kwargs.get("cycle_dict") or {})
+        for timing in timing_list:
+            timing_plan = timing.with_cycle_length(cycle_length)
+            if timing_plan is None:
+                green_dict = None
+                break
+            green_dict.update(timing.get_green_dict(*timing_plan, cycle_length))
+            cycle_dict[timing.junction_id] = int(cycle_length)
+        candidate_list.append(None if green_dict is None else {"green_dict": green_dict, "cycle_dict": cycle_dict})
+    delay_array, stop_array = evaluate_candidates(net_dict, tod_name, candidate_list, stop_weight=stop_weight,
+                                                  workers=workers, checkpoint=checkpoint, **prediction_kwargs)
+    current_cycle = float(np.mean([timing.cycle_length for timing in timing_list]))
+    return _feasible_sweep(CYCLE_LENGTH_COLUMN, CYCLE_LENGTH_DELAY_COLUMN, x_array, delay_array, stop_array,
+                           current_cycle, candidate_list)
+
+
+def optimize_green_splits(net_dict, tod_name, junction_list=None, step=None, passes=1, phase_splits=True,
+                          min_green=DEFAULT_MIN_GREEN, stop_weight=30, workers=None, checkpoint=None,
+                          **prediction_kwargs):
+    """
+    Coordinate search of the splits of several junctions (e.g., a corridor): each junction is swept in turn with
+        the best splits of the others, first the major split then the split of each phase within its ring
+
+    :param net_dict:
+    :param tod_name:
+    :param junction_list: all the junctions of the tod if None
+    :param step:
+    :param passes: number of passes over the junctions
+    :param phase_splits: sweep the phase splits within the rings after the major split, major split only if False
+    :param min_green:
+    :param stop_weight:
+    :param workers:
+    :param checkpoint: models.checkpoint.RunCheckpoint, the best plan is saved after each junction, a restarted
+        search follows the same path without evaluating the recorded candidates again
+    :param prediction_kwargs:
+    :return: green dict of the best splits, cost (h), {junction_id: best major split}
+        (the phase splits are in the green dict)
+    """
+    if junction_list is None:
+        junction_list = net_dict.get_junction_list(tod_name)
+    green_dict = dict(prediction_kwargs.pop("green_dict", None) or {})
+    best_split_dict = {}
+    best_cost = np.nan
+    for pass_index in range(passes):
+        for junction_id in junction_list:
+            sweep = sweep_green_split(net_dict, tod_name, junction_id, step=step, min_green=min_green,
+                                      stop_weight=stop_weight, workers=workers, checkpoint=checkpoint,
+                                      green_dict=green_dict, **prediction_kwargs)
+            best_split_dict[junction_id], best_candidate, best_cost = sweep.get_best()
+            green_dict = best_candidate["green_dict"]
+            if phase_splits:
+                timing = JunctionTiming(net_dict, tod_name, junction_id, min_green=min_green, green_dict=green_dict)
+                for phase in timing.get_sweep_phases():
+                    sweep = sweep_phase_split(net_dict, tod_name, junction_id, phase, step=step, min_green=min_green,
+                                              stop_weight=stop_weight, workers=workers, checkpoint=checkpoint,
+                                              green_dict=green_dict, **prediction_kwargs)
+                    _, best_candidate, best_cost = sweep.get_best()
+                    green_dict = best_candidate["green_dict"]
+            if checkpoint is not None:
+                checkpoint.set_best(green_dict=green_dict, cost=best_cost, split_dict=best_split_dict,
+                                    pass_index=pass_index, junction_id=junction_id)
+                checkpoint.save()
+    return green_dict, best_cost, best_split_dict
+
+
+def evaluate_candidates(net_dict, tod_name, candidate_list, stop_weight=30, workers=None, checkpoint=None,
+                        **prediction_kwargs):
+    """
+    Hourly delay & stops of each candidate (None for an infeasible candidate)
+
+    :param net_dict:
+    :param tod_name:
+    :param candidate_list: list of dicts of update_network_prediction arguments
+    :param stop_weight:
+    :param workers: number of processes, default: cpu count, evaluated in the current process if <= 1
+    :param checkpoint: models.checkpoint.RunCheckpoint, the candidates in its table are not evaluated again
+        & the new ones are recorded as soon as they are evaluated
+    :param prediction_kwargs: common arguments of update_network_prediction
+    :return: delay array (h), stop array (h equivalence), nan for the infeasible candidates
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    task_list = []
+    for candidate in candidate_list:
+        if candidate is None:
+            task_list.append(None)
+            continue
+        local_kwargs = dict(prediction_kwargs)
+        local_kwargs.update(candidate)
+        task_list.append(local_kwargs)
+    feasible_list = [task for task in task_list if task is not None]
+
+    result_dict = {}        # key: index in feasible_list, val: (delay, stops)
+    key_list = [None] * len(feasible_list)
+    if checkpoint is not None:
+        # the network is hashed once for all the candidates
+        network_key = get_network_key(net_dict, tod_name)
+        for idx, task in enumerate(feasible_list):
+            key_list[idx] = f"{get_scenario_key(net_dict, tod_name, task, network_key)}-{stop_weight}"
+            if checkpoint.get_result(key_list[idx]) is not None:
+                result_dict[idx] = checkpoint.get_result(key_list[idx])
+    pending_list = [idx for idx in range(len(feasible_list)) if not (idx in result_dict.keys())]
+
+    if workers <= 1 or len(pending_list) <= 1:
+        result_iter = (_evaluate_candidate(net_dict, tod_name, feasible_list[idx], stop_weight)
+                       for idx in pending_list)
+        _collect_results(pending_list, result_iter, result_dict, key_list, checkpoint)
+    else:
+        # the network is sent once to each worker instead of once per candidate
+        tod_net_dict = net_dict.select_tod(tod_name)
+        with ProcessPoolExecutor(max_workers=min(workers, len(pending_list)),
+                                 initializer=_init_worker, initargs=(tod_net_dict,)) as executor:
+            result_iter = executor.map(_worker_evaluate_candidate, [tod_name] * len(pending_list),
+                                       [feasible_list[idx] for idx in pending_list],
+                                       [stop_weight] * len(pending_list))
+            _collect_results(pending_list, result_iter, result_dict, key_list, checkpoint)
+
+    delay_array = np.full(len(task_list), np.nan)
+    stop_array = np.full(len(task_list), np.nan)
+    feasible_index = 0
+    for idx, task in enumerate(task_list):
+        if task is not None:
+            delay_array[idx], stop_array[idx] = result_dict[feasible_index]
+            feasible_index += 1
+    return delay_array, stop_array
+
+
+def _collect_results(index_list, result_iter, result_dict, key_list, checkpoint):
+    for idx, result in zip(index_list, result_iter):
+        result_dict[idx] = result
+        if checkpoint is not None:
+            checkpoint.record(key_list[idx], result)
+
+
+def _evaluate_candidate(net_dict, tod_name, prediction_kwargs, stop_weight):
+    with net_dict.trial(tod_name):
+        update_network_prediction(net_dict, tod_name, **prediction_kwargs)
+        return get_network_hourly_cost(net_dict, tod_name, stop_weight)
+
+
+def _init_worker(net_dict):
+    global _worker_net_dict
+    _worker_net_dict = net_dict
+
+
+def _worker_evaluate_candidate(tod_name, prediction_kwargs, stop_weight):
+    return _evaluate_candidate(_worker_net_dict, tod_name, prediction_kwargs, stop_weight)
+
+
+def _feasible_sweep(x_column, delay_column, x_array, delay_array, stop_array, current_x, candidate_list):
+    feasible_mask = ~np.isnan(delay_array)
+    if not np.any(feasible_mask):
+        raise ValueError("No feasible candidate, check the minimum green & the sweep range")
+    return CostSweep(x_column, delay_column, x_array[feasible_mask], delay_array[feasible_mask],
+                     stop_array[feasible_mask], current_x,
+                     [candidate for candidate, feasible in zip(candidate_list, feasible_mask) if feasible])
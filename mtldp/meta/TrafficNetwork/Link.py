@@ -3,10 +3,9 @@ from __future__ import annotations
 
 from typing import List, TYPE_CHECKING, Any, Dict
 
-import pandas as pd
-
 
 if TYPE_CHECKING:
+    import pandas as pd
     from .types import Direction
     from .Arterial import Arterial
     from .Geometry import Geometry
@@ -79,6 +78,7 @@ class Link:
         return link_dict
 
     def to_df(self, attr="all") -> pd.DataFrame:
+        import pandas as pd
         link_dict = self.to_dict(attr=attr)
         return pd.DataFrame(link_dict, index=[0])
 
@@ -3,11 +3,10 @@ from __future__ import annotations
 
 from typing import TYPE_CHECKING, List, Dict, Any
 
-import pandas as pd
-
 from .Geometry import Geometry
 
 if TYPE_CHECKING:
+    import pandas as pd
     from .types import Turn
     from .Arterial import Arterial
     from .LaneSet import LaneSet
@@ -87,5 +86,6 @@ class Movement:
         return movement_dict
 
     def to_df(self, attr: str = "all") -> pd.DataFrame:
+        import pandas as pd
         movement_dict = self.to_dict(attr=attr)
         return pd.DataFrame(movement_dict, index=[0])
@@ -1,20 +1,24 @@
+from __future__ import annotations
+
 from pathlib import Path
-from typing import Literal, Dict
+from typing import Literal, Dict, TYPE_CHECKING
 
-from matplotlib import pyplot as plt
 import numpy as np
-from matplotlib.collections import LineCollection
-from mtldp.meta.TrafficNetwork import Arterial
 
-from models.net_dict_classes import MovementNetDict
 from pts import pts
-from models.movement_tod_classes import MovementTOD
+
+if TYPE_CHECKING:
+    from mtldp.meta.TrafficNetwork import Arterial
+    from models.net_dict_classes import MovementNetDict
+    from models.movement_tod_classes import MovementTOD
 
 Direction = Literal[-1, 1]
 
 
 def corridor_time_space_diagram(movement_dict: MovementNetDict, tod_name: str,
                                 corridor: Arterial, output_path: Path, prefix: str):
+    from matplotlib import pyplot as plt
+
     for direction, oneway in corridor.oneways.items():
         if direction in ["N", "n", "E", "e"]:
             plot_dir: Direction = -1
@@ -80,6 +84,8 @@ def draw_movement_pts(ax, linewidth: float,
                       y_location: float, jam_density: float, repeat_cycles: int,
                       upstream_length: float, downstream_length: float,
                       stop_bar_distance: float, upstream_prediction: bool):
+    from matplotlib.collections import LineCollection
+
     # Extract data
     segments, alphas = get_pts_components(movement_curve,
                                           upstream_prediction=upstream_prediction,
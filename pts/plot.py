@@ -2,8 +2,6 @@
 from typing import List
 
 import numpy as np
-from matplotlib import pyplot as plt
-from matplotlib.collections import LineCollection
 
 LINE_WIDTH = 1.5
 SIGNAL_BAR_WIDTH = 5
@@ -122,6 +120,9 @@ def plot_pts(x_origin: int,
             green_bars.append([[t_to_x(idx * cycle + red, 0), n_to_y(-1)], [t_to_x((idx + 1) * cycle, 0), n_to_y(-1)]])
 
     if not dryrun:
+        from matplotlib import pyplot as plt
+        from matplotlib.collections import LineCollection
+
         fig = plt.figure(figsize=(9, 4))
         ax = fig.add_subplot(1, 1, 1)
         ax.set_xlim([t_to_x(0, max_queue), x_origin + duration])
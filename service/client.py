@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Local client of the what-if prediction service
+
+Example:
+    async with PredictionClient(socket_path="/tmp/osaas.sock") as client:
+        response = await client.what_if("MD", "MD", offset_dict={"62300620": -22})
+"""
+import asyncio
+import json
+from itertools import count
+
+from service.prediction_service import DEFAULT_SOCKET_PATH
+
+
+class PredictionClient(object):
+    """
+    Several requests can be in flight on the same connection, the responses are matched by id
+    """
+    def __init__(self, socket_path=DEFAULT_SOCKET_PATH, host="127.0.0.1", port=None):
+        self.socket_path = socket_path
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+        self.pending_dict = {}      # key: request id, val: future of the response
+        self.id_counter = count()
+        self.read_task = None
+
+    async def connect(self):
+        if self.port is not None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        else:
+            self.reader, self.writer = await asyncio.open_unix_connection(self.socket_path)
+        self.read_task = asyncio.create_task(self._read_responses())
+        return self
+
+    async def _read_responses(self):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                break
+            response_dict = json.loads(line)
+            future = self.pending_dict.pop(response_dict.get("id"), None)
+            if future is not None and not future.done():
+                future.set_result(response_dict)
+        for future in self.pending_dict.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Connection closed by the prediction service"))
+        self.pending_dict = {}
+
+    async def request(self, request_dict):
+        """
+        Send a raw request & wait for the response
+
+        :param request_dict:
+        :return: response dict
+        """
+        request_dict = dict(request_dict)
+        request_id = next(self.id_counter)
+        request_dict["id"] = request_id
+        future = asyncio.get_running_loop().create_future()
+        self.pending_dict[request_id] = future
+        self.writer.write((json.dumps(request_dict) + "\n").encode())
+        await self.writer.drain()
+        return await future
+
+    async def what_if(self, network, tod_name, offset_dict=None, green_dict=None, cycle_dict=None,
+                      global_cycle=None, global_p=None, p_dict=None, movements=None):
+        """
+        Predict the network under a timing plan, see update_network_prediction for the arguments
+
+        :return: response dict
+        """
+        return await self.request({"network": network, "tod_name": tod_name,
+                                   "offset_dict": offset_dict, "green_dict": green_dict,
+                                   "cycle_dict": cycle_dict, "global_cycle": global_cycle,
+                                   "global_p": global_p, "p_dict": p_dict, "movements": movements})
+
+    async def stats(self):
+        return await self.request({"command": "stats"})
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            await self.writer.wait_closed()
+        if self.read_task is not None:
+            await self.read_task
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
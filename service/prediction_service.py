@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""
+Long-running what-if prediction service
+
+The calibrated networks are loaded & predicted once in every worker, then the what-if requests
+(offsets, green times, cycle lengths) are answered by re-predicting the warm networks.
+Requests & responses are newline-delimited JSON over a Unix socket (or TCP), see service.client.
+
+Usage:
+    python -m service.prediction_service --network MD=data/demo/MD_calibrated_curves.json \
+        --socket /tmp/osaas.sock --workers 2
+
+Request:
+    {"id": 1, "network": "MD", "tod_name": "MD", "offset_dict": {"junction_id": 10},
+     "green_dict": {"movement_id": [[0, 50]]}, "cycle_dict": {"junction_id": 100}, "global_cycle": null}
+    {"id": 2, "command": "stats"}
+Response:
+    {"id": 1, "status": "ok", "calibration_diff": ..., "movements": {"movement_id": {...}},
+     "latency": {"queue": ..., "compute": ..., "total": ...}}
+"""
+import argparse
+import asyncio
+import json
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from time import time
+
+import numpy as np
+
+from models.net_dict_classes import MovementNetDict
+from models.net_model import update_network_prediction
+
+DEFAULT_SOCKET_PATH = "/tmp/osaas_prediction.sock"
+DEFAULT_WORKLIST_TOLERANCE = 1e-6
+
+_worker_state = None
+
+
+class WarmNetworkState(object):
+    """
+    Calibrated networks kept in the memory of a worker, with the timing plan they were calibrated with
+    """
+    def __init__(self, network_path_dict, worklist_tolerance=DEFAULT_WORKLIST_TOLERANCE):
+        self.worklist_tolerance = worklist_tolerance
+        self.network_dict = {}          # key: network name, val: MovementNetDict
+        self.base_offset_dict = {}      # key: (network name, tod), val: {junction_id: additional offset}
+        self.base_cycle_dict = {}       # key: (network name, tod), val: {junction_id: cycle length}
+        self.base_green_dict = {}       # key: (network name, tod), val: {movement_id: green time}
+        self.base_p_dict = {}           # key: (network name, tod), val: {movement_id: penetration rate}
+        for network_name, network_path in network_path_dict.items():
+            self.network_dict[network_name] = load_network(network_path)
+            for tod_name in self.network_dict[network_name].tod_index.keys():
+                self._calibrate(network_name, tod_name)
+
+    def _calibrate(self, network_name, tod_name):
+        net_dict = self.network_dict[network_name]
+        base_offset_dict, base_cycle_dict = {}, {}
+        for junction_id in net_dict.get_junction_list(tod_name):
+            movement_curve = next(iter(net_dict.get_junction_movement_dict(tod_name, junction_id).values()))
+            base_offset_dict[junction_id] = movement_curve.additional_offset
+            base_cycle_dict[junction_id] = movement_curve.cycle_length
+        base_green_dict = {movement_id: movement_curve.green_time
+                           for movement_id, movement_curve in net_dict.get_tod_movement_dict(tod_name).items()}
+        self.base_offset_dict[(network_name, tod_name)] = base_offset_dict
+        self.base_cycle_dict[(network_name, tod_name)] = base_cycle_dict
+        self.base_green_dict[(network_name, tod_name)] = base_green_dict
+        self.base_p_dict[(network_name, tod_name)] = \
+            {movement_id: movement_curve.penetration_rate
+             for movement_id, movement_curve in net_dict.get_tod_movement_dict(tod_name).items()}
+        update_network_prediction(net_dict, tod_name)
+
+    def predict(self, request_dict):
+        """
+        Re-predict a network under a what-if timing plan, the parameters not in the request
+            are the ones of the calibrated plan. The worklist starts from the movements changed by the request
+            & the network is rolled back to its calibrated state afterwards (no state is kept between requests)
+
+        :param request_dict:
+        :return: response dict (without latency)
+        """
+        network_name = request_dict["network"]
+        tod_name = request_dict["tod_name"]
+        if not (network_name in self.network_dict.keys()):
+            raise KeyError(f"Unknown network {network_name}, available: {list(self.network_dict.keys())}")
+        net_dict = self.network_dict[network_name]
+        if not (tod_name in net_dict.tod_index.keys()):
+            raise KeyError(f"Unknown tod {tod_name} of network {network_name}")
+
+        offset_dict = dict(self.base_offset_dict[(network_name, tod_name)])
+        offset_dict.update(request_dict.get("offset_dict") or {})
+        cycle_dict = dict(self.base_cycle_dict[(network_name, tod_name)])
+        cycle_dict.update(request_dict.get("cycle_dict") or {})
+        green_dict = dict(self.base_green_dict[(network_name, tod_name)])
+        green_dict.update(request_dict.get("green_dict") or {})
+        global_cycle = request_dict.get("global_cycle")
+        if global_cycle is not None:
+            # global cycle has a lower priority than the cycle dict of the request
+            cycle_dict = {junction_id: global_cycle for junction_id in cycle_dict.keys()}
+            cycle_dict.update(request_dict.get("cycle_dict") or {})
+        global_p = request_dict.get("global_p")
+        p_dict = dict(request_dict.get("p_dict") or {})
+        if global_p is None:
+            # the penetration rates of the previous requests are not kept
+            p_dict = dict(self.base_p_dict[(network_name, tod_name)])
+            p_dict.update(request_dict.get("p_dict") or {})
+
+        movement_list = request_dict.get("movements")
+        movement_result_dict = {}
+        with net_dict.trial(tod_name):
+            calibration_diff = update_network_prediction(net_dict, tod_name,
+                                                         offset_dict=offset_dict,
+                                                         green_dict=green_dict,
+                                                         cycle_dict=cycle_dict,
+                                                         global_p=global_p,
+                                                         p_dict=p_dict,
+                                                         worklist_tolerance=self.worklist_tolerance,
+                                                         changed_movement_list=_get_changed_movements(
+                                                             net_dict, tod_name, request_dict))
+            for movement_id, movement_curve in net_dict.get_tod_movement_dict(tod_name).items():
+                if (movement_list is not None) and not (movement_id in movement_list):
+                    continue
+                movement_result_dict[movement_id] = {"junction_id": movement_curve.junction_id,
+                                                     "predicted_delay": float(movement_curve.predicted_delay),
+                                                     "predicted_stop_ratio":
+                                                         float(movement_curve.predicted_stop_ratio),
+                                                     "hourly_volume": movement_curve.hourly_volume}
+        return {"status": "ok", "calibration_diff": float(calibration_diff),
+                "movements": movement_result_dict}
+
+
+def _get_changed_movements(net_dict, tod_name, request_dict):
+    """
+    Movements whose inputs are changed by a request: the movements of the junctions with a new offset or cycle,
+        the ones with a new green time or penetration rate & the movements calibrated on one of the latter
+        (new upstream departure histogram)
+
+    :param net_dict:
+    :param tod_name:
+    :param request_dict:
+    :return: list of movement ids
+    """
+    movement_dict = net_dict.get_tod_movement_dict(tod_name)
+    if request_dict.get("global_p") is not None:
+        return list(movement_dict.keys())
+    if request_dict.get("global_cycle") is not None:
+        cycle_junction_set = set(net_dict.get_junction_list(tod_name))
+    else:
+        cycle_junction_set = set((request_dict.get("cycle_dict") or {}).keys())
+    junction_set = cycle_junction_set | set((request_dict.get("offset_dict") or {}).keys())
+    # departure histograms used by the arrival calibration of the downstream movements
+    histogram_set = set((request_dict.get("p_dict") or {}).keys())
+    histogram_set.update(movement_id for movement_id, movement_curve in movement_dict.items()
+                         if movement_curve.junction_id in cycle_junction_set)
+    changed_set = set((request_dict.get("green_dict") or {}).keys()) | histogram_set
+    for movement_id, movement_curve in movement_dict.items():
+        if (movement_curve.junction_id in junction_set) or \
+                any(upstream_id in histogram_set for upstream_id in movement_curve.upstream_movement_list or []):
+            changed_set.add(movement_id)
+    return [movement_id for movement_id in movement_dict.keys() if movement_id in changed_set]
+
+
+def load_network(network_path):
+    with open(network_path, "r") as temp_file:
+        calibrated_dict = json.load(temp_file)
+    return MovementNetDict().from_dict(calibrated_dict)
+
+
+def _init_worker(network_path_dict, worklist_tolerance):
+    global _worker_state
+    _worker_state = WarmNetworkState(network_path_dict, worklist_tolerance)
+
+
+def _worker_ping():
+    return _worker_state is not None
+
+
+def _worker_predict(request_dict, submit_time):
+    start_time = time()
+    response_dict = _worker_state.predict(request_dict)
+    response_dict["latency"] = {"queue": start_time - submit_time, "compute": time() - start_time}
+    return response_dict
+
+
+class PredictionService(object):
+    """
+    asyncio server dispatching the what-if requests to a pool of warm workers
+    """
+    def __init__(self, network_path_dict, workers=1, worklist_tolerance=DEFAULT_WORKLIST_TOLERANCE):
+        """
+
+        :param network_path_dict: {network name: path of the calibrated curve json}
+        :param workers: number of worker processes, the requests are served by a thread of this process if 0
+        :param worklist_tolerance: see update_network_prediction
+        """
+        self.network_path_dict = network_path_dict
+        self.workers = workers
+        if workers > 0:
+            self.executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                                initargs=(network_path_dict, worklist_tolerance))
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=1, initializer=_init_worker,
+                                               initargs=(network_path_dict, worklist_tolerance))
+        self.latency_list = []
+        self.server = None
+
+    async def handle_request(self, request_dict):
+        """
+        :param request_dict:
+        :return: response dict with the same id
+        """
+        submit_time = time()
+        request_id = request_dict.get("id")
+        command = request_dict.get("command", "predict")
+        if command == "ping":
+            return {"id": request_id, "status": "ok"}
+        if command == "stats":
+            return {"id": request_id, "status": "ok", "stats": self.get_latency_stats()}
+        if command != "predict":
+            return {"id": request_id, "status": "error", "error": f"Unknown command {command}"}
+
+        loop = asyncio.get_running_loop()
+        try:
+            response_dict = await loop.run_in_executor(self.executor, _worker_predict, request_dict, submit_time)
+        except Exception as error:
+            return {"id": request_id, "status": "error", "error": repr(error)}
+        response_dict["id"] = request_id
+        response_dict["latency"]["total"] = time() - submit_time
+        self.latency_list.append(response_dict["latency"]["total"])
+        return response_dict
+
+    def get_latency_stats(self):
+        if len(self.latency_list) == 0:
+            return {"requests": 0}
+        latency_array = np.array(self.latency_list)
+        return {"requests": len(self.latency_list),
+                "mean": float(np.mean(latency_array)),
+                "p50": float(np.percentile(latency_array, 50)),
+                "p95": float(np.percentile(latency_array, 95)),
+                "max": float(np.max(latency_array))}
+
+    async def warm_up(self):
+        """
+        Make sure all the workers have loaded & calibrated the networks before serving
+
+        :return:
+        """
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self.executor, _worker_ping)
+                               for _ in range(max(self.workers, 1))])
+
+    async def _handle_connection(self, reader, writer):
+        write_lock = asyncio.Lock()
+        task_set = set()
+
+        async def _respond(request_dict):
+            response_dict = await self.handle_request(request_dict)
+            async with write_lock:
+                writer.write((json.dumps(response_dict) + "\n").encode())
+                await writer.drain()
+
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                request_dict = json.loads(line)
+            except json.JSONDecodeError as error:
+                request_dict = {"command": "invalid", "error": repr(error)}
+            # requests of the same connection are served concurrently, responses are matched by id
+            task = asyncio.create_task(_respond(request_dict))
+            task_set.add(task)
+            task.add_done_callback(task_set.discard)
+        if task_set:
+            await asyncio.gather(*task_set)
+        writer.close()
+
+    async def start(self, socket_path=None, host="127.0.0.1", port=None):
+        """
+        Start listening on a Unix socket (or TCP if port is provided)
+
+        :return:
+        """
+        await self.warm_up()
+        if port is not None:
+            self.server = await asyncio.start_server(self._handle_connection, host=host, port=port)
+        else:
+            self.server = await asyncio.start_unix_server(self._handle_connection,
+                                                          path=socket_path or DEFAULT_SOCKET_PATH)
+        return self.server
+
+    async def serve_forever(self, socket_path=None, host="127.0.0.1", port=None):
+        server = await self.start(socket_path=socket_path, host=host, port=port)
+        async with server:
+            await server.serve_forever()
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        self.executor.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="What-if prediction service")
+    parser.add_argument("--network", nargs="+", required=True,
+                        help="name=path of the calibrated curve json, e.g., MD=data/demo/MD_calibrated_curves.json")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET_PATH)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=None, help="listen on TCP instead of the Unix socket")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--worklist-tolerance", type=float, default=DEFAULT_WORKLIST_TOLERANCE)
+    args = parser.parse_args()
+
+    network_path_dict = {}
+    for network_info in args.network:
+        network_name, network_path = network_info.split("=", 1)
+        network_path_dict[network_name] = network_path
+    service = PredictionService(network_path_dict, workers=args.workers,
+                                worklist_tolerance=args.worklist_tolerance)
+    print(f"Serving {list(network_path_dict.keys())} on "
+          f"{args.socket if args.port is None else f'{args.host}:{args.port}'}")
+    asyncio.run(service.serve_forever(socket_path=args.socket, host=args.host, port=args.port))
+
+
+if __name__ == '__main__':
+    main()
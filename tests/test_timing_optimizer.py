@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+from benchmarks.synthetic_network import generate_synthetic_network, SYNTHETIC_TOD_NAME
+from models.metrics import get_network_hourly_cost
+from models.movement_model import update_movement_model
+from models.net_model import update_network_prediction
+from models.timing_optimizer import sweep_cycle_length
+
+
+def _get_network():
+    net_dict = generate_synthetic_network(3, seed=1)
+    net_dict.check_network_topology()
+    return net_dict
+
+
+def test_sweep_cycle_length_matches_fresh_prediction():
+    net_dict = _get_network()
+    update_network_prediction(net_dict, SYNTHETIC_TOD_NAME)
+    cost_sweep = sweep_cycle_length(net_dict, SYNTHETIC_TOD_NAME, [80, 100, 120], workers=1)
+    for cycle_length, delay, stops, candidate in zip(cost_sweep.x_array, cost_sweep.delay_array,
+                                                     cost_sweep.stop_array, cost_sweep.candidate_list):
+        # fresh network whose signal plan has the candidate cycle length before the calibration
+        fresh_net_dict = _get_network()
+        for movement_curve in fresh_net_dict.get_tod_movement_dict(SYNTHETIC_TOD_NAME).values():
+            update_movement_model(movement_curve, cycle_length=int(cycle_length), departure_prediction=False)
+            fresh_net_dict.merge_minor_origins(movement_curve)
+        update_network_prediction(fresh_net_dict, SYNTHETIC_TOD_NAME, green_dict=candidate["green_dict"])
+        fresh_delay, fresh_stops = get_network_hourly_cost(fresh_net_dict, SYNTHETIC_TOD_NAME)
+        assert np.isclose(delay, fresh_delay, rtol=1e-9), cycle_length
+        assert np.isclose(stops, fresh_stops, rtol=1e-9), cycle_length
+
+
+def test_sweep_cycle_length_rejects_junction_subset():
+    net_dict = _get_network()
+    junction_list = net_dict.get_junction_list(SYNTHETIC_TOD_NAME)
+    with pytest.raises(ValueError):
+        sweep_cycle_length(net_dict, SYNTHETIC_TOD_NAME, [80, 100], junction_list=junction_list[:1], workers=1)